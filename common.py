@@ -3,14 +3,81 @@ import time
 import json
 import base64
 import os
+import re
+import math
+import hashlib
+import threading
+import functools
+import collections
+import queue
+import random
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
 
 import config
 
 current_path = os.path.abspath(os.curdir)
 
+# Параметры пула HTTP-соединений к REST API (config.URL).
+# Значения берутся из config, если они там заданы, иначе используются значения по умолчанию.
+http_pool_size = int(getattr(config, 'http_pool_size', 16))  # макс. кол-во keep-alive соединений к одному хосту
+http_pool_block = bool(getattr(config, 'http_pool_block', False))  # ждать свободное соединение вместо создания лишнего
+http_connect_timeout = float(getattr(config, 'http_connect_timeout', 10))  # таймаут установки соединения, сек
+http_read_timeout = float(getattr(config, 'http_read_timeout', 300))  # таймаут чтения ответа, сек
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Возвращает общий для процесса requests.Session с пулом keep-alive соединений.
+
+    Сессия создаётся один раз (потокобезопасно) и переиспользуется всеми вызовами send_rest и login_admin,
+    поэтому TCP-соединение и рукопожатие с config.URL не повторяются на каждый запрос.
+
+    Returns:
+        requests.Session: Общая сессия.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=http_pool_size, pool_block=http_pool_block)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers.update({"Accept": "application/json", "Connection": "keep-alive"})
+                _session = session
+    return _session
+
+
+def close_session():
+    """
+    Закрывает общую сессию и все соединения пула. Следующий запрос создаст новую сессию.
+    """
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def get_timeout(timeout=None):
+    """
+    Возвращает таймаут запроса в формате requests: (connect, read).
+
+    Args:
+        timeout (float | tuple, optional): Таймаут конкретного вызова. Если не задан - берутся значения из config.
+    """
+    if timeout is None:
+        return http_connect_timeout, http_read_timeout
+    return timeout
+
 
 def get_value_config_param(key, par):
     for unit in par:
@@ -60,6 +127,7 @@ def load_config_params(schema_name, name_function):
     return []
 
 
+@functools.lru_cache(maxsize=None)
 def get_computer_name():
     st = socket.gethostbyname(socket.gethostname())
     st = '' if st == '127.0.0.1' else st
@@ -71,6 +139,9 @@ def write_log_db(level, src, msg, schema_name='urban', page=None, file_name='',
     """
     Логирует сообщение в консоль и/или базу данных.
 
+    При log_async (по умолчанию) сообщение ставится в очередь log_writer и функция сразу возвращается:
+    вывод в консоль и пакетная запись в БД выполняются фоновым потоком.
+
     Args:
         level (str): Уровень логирования (например, ERROR, INFO).
         src (str): Источник сообщения.
@@ -84,37 +155,34 @@ def write_log_db(level, src, msg, schema_name='urban', page=None, file_name='',
         write_to_console (bool): Логировать ли в консоль.
         token (str, optional): Токен для авторизации.
     """
-    # Формируем части сообщения
-    st_td = f"td={td:.1f} sec;" if td else ''
-    st_file_name = f"file={file_name};" if file_name else ''
-    st_law_id = f"law_id={law_id};" if law_id else ''
-    st_page = f"page={page};" if page else ''
+    if log_async:
+        log_writer.put({
+            "level": level, "src": src, "msg": msg, "schema_name": schema_name, "page": page,
+            "file_name": file_name, "law_id": law_id, "td": td, "write_to_db": write_to_db,
+            "write_to_console": write_to_console, "token": token, "at": time.time()})
+        return
 
     # Логирование в консоль
     if write_to_console:
-        print(f"{time.asctime(time.gmtime())}: {level}; {src}; {st_td} {st_page} {st_law_id} ",
-              st_file_name.replace('\n', ''), msg.replace('\m', ''), flush=True)
+        print_log(level, src, msg, page, file_name, law_id, td)
 
     # Если логирование в базу данных не требуется
     if not write_to_db:
         return
 
-    # Получение токена, если он не передан
+    # Получение токена, если он не передан (из кэша менеджера токенов, без повторного логина)
     answer = ''
     if token is None:
-        answer, is_ok, token, _ = login_admin()
+        token = get_admin_token()
+        is_ok = token is not None
+        if not is_ok:
+            answer = token_manager.last_error
     else:
         is_ok = True
 
     # Логирование в базу данных
     if is_ok:
-        page = page or 'NULL'
-        law_id = law_id or ''
-        file_name = file_name or get_computer_name()
-        td = 'NULL' if td is None else f"{td:.1f}"
-        datas = (msg, file_name)
-        query = f"select {schema_name}.pw_logs('{level}', '{src}', %s, {page}, '{law_id}', %s, {td})"
-        params = {"script": query, "datas": datas}
+        params = get_log_params(level, src, msg, schema_name, page, file_name, law_id, td)
         answer, is_ok, _ = send_rest('v2/execute', 'PUT', params=params, token_user=token)
 
         if not is_ok:
@@ -123,60 +191,458 @@ def write_log_db(level, src, msg, schema_name='urban', page=None, file_name='',
         print(f"{time.ctime()} ERROR write_log_db {answer}", flush=True)
 
 
+def print_log(level, src, msg, page=None, file_name='', law_id='', td=None, at=None):
+    """
+    Выводит сообщение лога в консоль (формат write_log_db).
+
+    Args:
+        at (float, optional): Время сообщения (time.time()); по умолчанию - текущее.
+    """
+    # Формируем части сообщения
+    st_td = f"td={td:.1f} sec;" if td else ''
+    st_file_name = f"file={file_name};" if file_name else ''
+    st_law_id = f"law_id={law_id};" if law_id else ''
+    st_page = f"page={page};" if page else ''
+    print(f"{time.asctime(time.gmtime(at))}: {level}; {src}; {st_td} {st_page} {st_law_id} ",
+          st_file_name.replace('\n', ''), msg.replace('\m', ''), flush=True)
+
+
+def get_log_call(level, src, msg, schema_name='urban', page=None, file_name='', law_id='', td=None):
+    """
+    Формирует вызов функции pw_logs для одного сообщения лога.
+
+    Returns:
+        tuple: (выражение вызова pw_logs с подстановками %s, значения подстановок).
+    """
+    page = page or 'NULL'
+    law_id = law_id or ''
+    file_name = file_name or get_computer_name()
+    td = 'NULL' if td is None else f"{td:.1f}"
+    return f"{schema_name}.pw_logs('{level}', '{src}', %s, {page}, '{law_id}', %s, {td})", (msg, file_name)
+
+
+def get_log_params(level, src, msg, schema_name='urban', page=None, file_name='', law_id='', td=None):
+    """
+    Формирует параметры запроса v2/execute для записи сообщения в лог БД (функция pw_logs).
+
+    Returns:
+        dict: Параметры {"script": ..., "datas": ...} для send_rest('v2/execute', 'PUT', ...).
+    """
+    call, datas = get_log_call(level, src, msg, schema_name, page, file_name, law_id, td)
+    return {"script": "select " + call, "datas": datas}
+
+
+def get_log_batch_params(records):
+    """
+    Формирует параметры одного запроса v2/execute, записывающего в лог БД несколько сообщений
+    (select pw_logs(...), pw_logs(...), ...).
+
+    Args:
+        records (list): Записи очереди LogWriter.
+    """
+    calls, datas = [], []
+    for rec in records:
+        call, data = get_log_call(rec['level'], rec['src'], rec['msg'], rec['schema_name'], rec['page'],
+                                  rec['file_name'], rec['law_id'], rec['td'])
+        calls.append(call)
+        datas.extend(data)
+    return {"script": "select " + ", ".join(calls), "datas": datas}
+
+
+# Параметры фоновой записи лога
+log_async = bool(getattr(config, 'log_async', True))  # False - писать лог синхронно, как раньше
+log_queue_size = int(getattr(config, 'log_queue_size', 10000))  # при переполнении новые сообщения отбрасываются
+log_batch_size = int(getattr(config, 'log_batch_size', 100))  # макс. сообщений в одном запросе v2/execute
+log_flush_interval = float(getattr(config, 'log_flush_interval', 1))  # макс. задержка записи в БД, сек
+# доля сообщений уровня, записываемых в БД, например {'info': 0.1}; не указанные уровни пишутся все
+log_sample_rates = {k.lower(): v for k, v in getattr(config, 'log_sample_rates', {}).items()}
+log_fallback_file = getattr(config, 'log_fallback_file', os.path.join(current_path, 'log_fallback.jsonl'))
+
+
+class LogWriter:
+    """
+    Фоновая запись лога: сообщения копятся в ограниченной очереди, поток выводит их в консоль и пишет в БД
+    пакетами одним запросом v2/execute. Если API недоступно - пакет дописывается в локальный файл
+    log_fallback_file и отправляется в БД после восстановления связи.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue(log_queue_size)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.count_written = 0  # записано в БД
+        self.count_fallback = 0  # записано в локальный файл
+        self.count_dropped = collections.Counter()  # отброшено из-за переполнения очереди, по уровням
+        self.count_sampled = collections.Counter()  # не записано в БД из-за sampling, по уровням
+
+    def put(self, record):
+        """
+        Ставит сообщение в очередь (не блокируется). Возвращает False, если очередь переполнена.
+        """
+        if self.thread is None:
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.count_dropped[record['level']] += 1
+            return False
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='log_writer', daemon=True)
+                self.thread.start()
+                atexit.register(self.flush)
+
+    def flush(self, timeout=10):
+        """
+        Ждёт записи всех сообщений, поставленных в очередь (не дольше timeout секунд).
+        """
+        if self.thread is None:
+            return
+        done = threading.Event()
+        try:
+            self.queue.put(done, timeout=timeout)
+        except queue.Full:
+            return
+        done.wait(timeout)
+
+    def get_stats(self):
+        return {"written": self.count_written, "fallback": self.count_fallback,
+                "dropped": dict(self.count_dropped), "sampled": dict(self.count_sampled),
+                "queue": self.queue.qsize()}
+
+    def _run(self):
+        while True:
+            batch, events = [], []
+            item = self.queue.get()
+            deadline = time.monotonic() + log_flush_interval
+            while True:
+                if isinstance(item, threading.Event):
+                    events.append(item)
+                else:
+                    batch.append(item)
+                if len(batch) >= log_batch_size or events:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as err:
+                print(f"{time.ctime()} ERROR log_writer {err}", flush=True)
+            for event in events:
+                event.set()
+
+    def _write(self, batch):
+        records = []
+        for rec in batch:
+            if rec['write_to_console']:
+                print_log(rec['level'], rec['src'], rec['msg'], rec['page'], rec['file_name'], rec['law_id'],
+                          rec['td'], rec['at'])
+            if not rec['write_to_db']:
+                continue
+            rate = log_sample_rates.get(str(rec['level']).lower())
+            if rate is not None and random.random() >= rate:
+                self.count_sampled[rec['level']] += 1
+                continue
+            records.append(rec)
+        if records:
+            if self._send(records):
+                self._resend_fallback()
+            else:
+                self._save_fallback(records)
+
+    def _send(self, records):
+        token = next((rec['token'] for rec in records if rec['token'] is not None), None) or get_admin_token()
+        if token is None:
+            print(f"{time.ctime()} ERROR write_log_db {token_manager.last_error}", flush=True)
+            return False
+        answer, is_ok, _ = send_rest('v2/execute', 'PUT', params=get_log_batch_params(records), token_user=token)
+        if not is_ok:
+            print(f"{time.ctime()} ERROR write_log_db {answer}", flush=True)
+            return False
+        self.count_written += len(records)
+        return True
+
+    def _save_fallback(self, records):
+        try:
+            with open(log_fallback_file, 'a', encoding='utf-8') as f:
+                for rec in records:
+                    rec = dict(rec, token=None)
+                    f.write(json.dumps(rec, ensure_ascii=False) + '\n')
+            self.count_fallback += len(records)
+        except Exception as err:
+            print(f"{time.ctime()} ERROR log_writer fallback {err}", flush=True)
+
+    def _resend_fallback(self):
+        sending_file = log_fallback_file + '.sending'
+        # файл остался после остановки во время отправки - отправляется первым, иначе os.replace его затрёт
+        if os.path.exists(sending_file) and not self._resend_file(sending_file):
+            return
+        if not os.path.exists(log_fallback_file):
+            return
+        try:
+            os.replace(log_fallback_file, sending_file)
+        except Exception as err:
+            print(f"{time.ctime()} ERROR log_writer fallback {err}", flush=True)
+            return
+        self._resend_file(sending_file)
+
+    def _resend_file(self, sending_file):
+        """
+        Отправляет сообщения файла в БД и удаляет его; неотправленные дописываются в log_fallback_file.
+
+        :return: True, если отправлены все сообщения.
+        """
+        try:
+            with open(sending_file, 'r', encoding='utf-8') as f:
+                records = [json.loads(line) for line in f if line.strip()]
+        except Exception as err:
+            print(f"{time.ctime()} ERROR log_writer fallback {err}", flush=True)
+            return False
+        is_ok = True
+        for i in range(0, len(records), log_batch_size):
+            if not self._send(records[i:i + log_batch_size]):
+                self._save_fallback(records[i:])
+                is_ok = False
+                break
+        os.remove(sending_file)
+        return is_ok
+
+
+log_writer = LogWriter()
+
+
+def flush_logs(timeout=10):
+    """
+    Дожидается записи накопленных сообщений лога (вызывать перед завершением процесса).
+    """
+    log_writer.flush(timeout)
+
+
+def _get_low_bytes(text):
+    """
+    Младшие байты кодов символов строки (ord(c) % 256) без цикла по символам.
+    """
+    return text.encode('utf-32-le')[::4]
+
+
+def _shift_bytes(data, key, sign):
+    """
+    Прибавляет (sign=1) или вычитает (sign=-1) по модулю 256 циклически повторяемый ключ.
+
+    Байты с одинаковой позицией в ключе обрабатываются одним bytes.translate по таблице сдвига.
+    """
+    key = _get_low_bytes(key)
+    out = bytearray(data)
+    for i, k in enumerate(key):
+        out[i::len(key)] = data[i::len(key)].translate(_get_shift_table((sign * k) % 256))
+    return bytes(out)
+
+
+@functools.lru_cache(maxsize=256)
+def _get_shift_table(shift):
+    return bytes((b + shift) % 256 for b in range(256))
+
+
+@functools.lru_cache(maxsize=None)
 def decode(key, enc):
     # раскодировать
-    dec = []
+    # результат кэшируется на время жизни процесса (раскодируются только секреты из config)
     enc = base64.urlsafe_b64decode(enc).decode()
-    for i in range(len(enc)):
-        key_c = key[i % len(key)]
-        dec_c = chr((256 + ord(enc[i]) - ord(key_c)) % 256)
-        dec.append(dec_c)
-    return "".join(dec)
+    return _shift_bytes(_get_low_bytes(enc), key, -1).decode('latin-1')
 
 
 def encode(key, text):
-    enc = []
-    for i in range(len(text)):
-        key_c = key[i % len(key)]
-        enc_c = chr((ord(text[i]) + ord(key_c)) % 256)
-        enc.append(enc_c)
-    return base64.urlsafe_b64encode("".join(enc).encode()).decode()
+    enc = _shift_bytes(_get_low_bytes(text), key, 1).decode('latin-1')
+    return base64.urlsafe_b64encode(enc.encode()).decode()
+
+
+def get_login_request():
+    """
+    Формирует URL и JSON-тело запроса v1/login администратора.
+    """
+    txt_z = {"login": "superadmin", "password": decode('abcd', config.kirill), "rememberMe": True}
+    return config.URL + 'v1/login', {"params": txt_z}
+
 
+def parse_login_answer(txt, result):
+    """
+    Разбирает ответ v1/login.
 
-def login_admin():
-    result = False
+    Returns:
+        tuple: (txt, result, token_admin, lang_admin) - как login_admin.
+    """
     token_admin = ''
     lang_admin = ''
-    txt_z = {"login": "superadmin", "password": decode('abcd', config.kirill), "rememberMe": True}
     try:
-        headers = {"Accept": "application/json"}
-        response = requests.request(
-            'POST', config.URL + 'v1/login', headers=headers,
-            json={"params": txt_z}
-            )
+        if result:
+            js = json.loads(txt)
+            if "accessToken" in js:
+                token_admin = js["accessToken"]
+            if 'lang' in js:
+                lang_admin = js['lang']
+        else:
+            return txt, result, None, lang_admin
+    except Exception as err:
+        txt = f'Error occurred: : {err}'
+    return txt, result, token_admin, lang_admin
+
+
+def login_admin(timeout=None):
+    url, js = get_login_request()
+    try:
+        response = get_session().request('POST', url, json=js, timeout=get_timeout(timeout))
     except HTTPError as err:
         txt = f'HTTP error occurred: {err}'
     except Exception as err:
         txt = f'Other error occurred: : {err}'
     else:
-        try:
-            txt = response.text
-            result = response.ok
-            if result:
-                js = json.loads(txt)
-                if "accessToken" in js:
-                    token_admin = js["accessToken"]
-                if 'lang' in js:
-                    lang_admin = js['lang']
-            else:
-                token = None
-                return txt, result, token
-        except Exception as err:
-            txt = f'Error occurred: : {err}'
-    return txt, result, token_admin, lang_admin
+        return parse_login_answer(response.text, response.ok)
+    return txt, False, '', ''
+
+
+# Параметры кэширования токена администратора
+token_ttl = float(getattr(config, 'token_ttl', 3600))  # время жизни токена, если его нельзя узнать из самого токена, сек
+token_refresh_margin = float(getattr(config, 'token_refresh_margin', 60))  # обновлять токен заранее, за N сек до истечения
+token_retry_delay = float(getattr(config, 'token_retry_delay', 5))  # пауза перед повторным логином после ошибки, сек
+
+
+def get_token_expires_at(token, default_ttl=None):
+    """
+    Определяет момент истечения токена (time.time()).
+
+    Если токен - JWT с полем exp, используется оно, иначе - текущее время + default_ttl.
+    """
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+        if exp:
+            return float(exp)
+    except Exception:
+        pass
+    return time.time() + (token_ttl if default_ttl is None else default_ttl)
+
+
+class AdminTokenManager:
+    """
+    Кэш токена администратора (accessToken из v1/login).
 
+    Логин выполняется один раз, токен хранится в памяти и обновляется заранее, до истечения срока.
+    Одновременные обращения из потоков/корутин ждут один общий логин, а не делают каждый свой.
+    """
+
+    def __init__(self, login_func=None):
+        self.login_func = login_func or login_admin
+        self.lock = threading.Lock()
+        self.token = None
+        self.expires_at = 0.0
+        self.failed_at = 0.0
+        self.last_error = ''
+        self.count_login = 0
+
+    def peek(self):
+        """
+        Возвращает действующий токен из кэша без обращения к API или None.
+        """
+        token = self.token
+        if token is not None and time.time() < self.expires_at - token_refresh_margin:
+            return token
+        return None
+
+    def get(self, force=False):
+        """
+        Возвращает токен администратора, при необходимости выполняя логин.
+
+        :param force: Выполнить логин, даже если в кэше есть действующий токен.
+        :return: Токен или None, если логин не удался.
+        """
+        if not force:
+            token = self.peek()
+            if token is not None:
+                return token
+        with self.lock:
+            # пока ждали блокировку, другой поток мог уже обновить токен
+            if not force:
+                token = self.peek()
+                if token is not None:
+                    return token
+            if self.throttled():
+                return None
+            return self._login()
+
+    def refresh(self, stale_token):
+        """
+        Обновляет токен, отвергнутый API (401). Если токен уже обновлён другим потоком - возвращает новый.
+        """
+        with self.lock:
+            if self.token is not None and self.token != stale_token:
+                return self.token
+            return self._login()
+
+    def is_managed(self, token):
+        return token is not None and token == self.token
+
+    def invalidate(self):
+        with self.lock:
+            self.token = None
+            self.expires_at = 0.0
+
+    def throttled(self):
+        """
+        True, если последний логин не удался менее token_retry_delay секунд назад.
+        """
+        return time.time() - self.failed_at < token_retry_delay
+
+    def _login(self):
+        txt, is_ok, token, _ = self.login_func()
+        return self.store(txt, is_ok, token)
+
+    def store(self, txt, is_ok, token):
+        """
+        Запоминает результат логина (в т.ч. выполненного асинхронно, см. common_async.get_token).
+
+        :return: Токен или None, если логин не удался.
+        """
+        self.count_login += 1
+        if not is_ok or not token:
+            self.token = None
+            self.expires_at = 0.0
+            self.failed_at = time.time()
+            self.last_error = txt
+            print(f"{time.ctime()} ERROR login_admin {txt}", flush=True)
+            return None
+        self.token = token
+        self.expires_at = get_token_expires_at(token)
+        self.failed_at = 0.0
+        self.last_error = ''
+        return token
+
+
+token_manager = AdminTokenManager()
+
+
+def get_admin_token(force=False):
+    """
+    Возвращает кэшированный токен администратора (см. AdminTokenManager.get).
+    """
+    return token_manager.get(force)
 
-def send_rest(mes, directive="GET", params=None, lang='', token_user=None):
+
+def get_rest_request(mes, directive="GET", params=None, lang='', token_user=None):
+    """
+    Формирует URL и JSON-тело запроса к REST API (общая часть send_rest и common_async.send_rest).
+
+    Returns:
+        tuple: (url, js) - полный URL запроса и тело запроса.
+    """
     js = {}
     if token_user is not None:
         js['token'] = token_user
@@ -193,9 +659,19 @@ def send_rest(mes, directive="GET", params=None, lang='', token_user=None):
         if type(params) is not str:
             params = json.dumps(params, ensure_ascii=False)
         js['params'] = params  # дополнительно заданные параметры
+    return config.URL + mes.replace(' ', '+'), js
+
+
+def send_rest(mes, directive="GET", params=None, lang='', token_user=None, timeout=None):
+    url, js = get_rest_request(mes, directive, params, lang, token_user)
     try:
-        headers = {"Accept": "application/json"}
-        response = requests.request(directive, config.URL + mes.replace(' ', '+'), headers=headers, json=js)
+        response = get_session().request(directive, url, json=js, timeout=get_timeout(timeout))
+        if response.status_code == 401 and token_manager.is_managed(token_user):
+            # токен из кэша отвергнут - один раз перелогиниваемся и повторяем запрос
+            token_user = token_manager.refresh(token_user)
+            if token_user is not None:
+                js['token'] = token_user
+                response = get_session().request(directive, url, json=js, timeout=get_timeout(timeout))
     except HTTPError as err:
         txt = f'HTTP error occurred: {err}'
         return txt, False, None
@@ -206,6 +682,337 @@ def send_rest(mes, directive="GET", params=None, lang='', token_user=None):
         return response.text, response.ok, '<' + str(response.status_code) + '> - ' + response.reason
 
 
+class LruTtlCache:
+    """
+    Ограниченный по размеру LRU-кэш с временем жизни записей (потокобезопасный).
+
+    Args:
+        maxsize (int): Максимальное количество записей; при переполнении вытесняются давно не использованные.
+        ttl (float, optional): Время жизни записи в секундах (None - без ограничения).
+    """
+
+    def __init__(self, maxsize=10000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.data = collections.OrderedDict()  # ключ -> (значение, момент истечения)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key)
+            if item is not None:
+                if item[1] is None or item[1] > time.monotonic():
+                    self.data.move_to_end(key)
+                    self.hits += 1
+                    return item[0]
+                del self.data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            self.data[key] = (value, expires_at)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            item = self.data.pop(key, None)
+            return default if item is None else item[0]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self.data)
+
+
+class BloomFilter:
+    """
+    Фильтр Блума: компактное множество с ложноположительными ответами.
+
+    `key in bloom` == False означает, что ключ точно не добавлялся; True - что ключ, вероятно, добавлялся
+    (ошибка не более error_rate при количестве ключей до capacity).
+
+    Args:
+        capacity (int): Ожидаемое количество ключей.
+        error_rate (float): Допустимая доля ложноположительных ответов.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(1, int(capacity))
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))  # бит
+        self.count_hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _get_positions(self, key):
+        digest = hashlib.blake2b(str(key).encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.count_hashes)]
+
+    def add(self, key):
+        for position in self._get_positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._get_positions(key))
+
+    def __len__(self):
+        return self.count
+
+
+def get_entity_params(object_code, rows, schema_name=None):
+    """
+    Формирует параметры многострочного запроса v2/entity (список строк в "values").
+
+    Args:
+        object_code (str): Код объекта (discord_messages, discord_members, ...).
+        rows (list): Список пар (values, datas); подстановки '%s' всех строк заполняются по порядку
+            из общего datas (части разделяются '~~~', поэтому datas строки собирается через inc_datas).
+        schema_name (str, optional): Схема; по умолчанию config.schema_name.
+
+    Returns:
+        dict: Параметры для send_rest('v2/entity', 'PUT', ...).
+    """
+    params = {
+        "schema_name": schema_name or config.schema_name,
+        "object_code": object_code,
+        "values": [values for values, _ in rows],
+    }
+    datas = '~~~'.join(datas for _, datas in rows if datas)
+    if datas:
+        params['datas'] = datas
+    return params
+
+
+# Пакетная запись строк (put_entities): ограничения одного запроса v2/entity и кол-во одновременных запросов
+bulk_max_rows = int(getattr(config, 'bulk_max_rows', 500))
+bulk_max_bytes = int(getattr(config, 'bulk_max_bytes', 1 << 20))
+bulk_concurrency = int(getattr(config, 'bulk_concurrency', 4))
+
+
+class BulkResult:
+    """
+    Результат пакетной записи put_entities.
+
+    Attributes:
+        ids (list): id записи в БД для каждой строки (в порядке строк), None - строка не записана.
+        errors (list): Текст ошибки для каждой строки, None - строка записана.
+        rejected (list): True - строка отвергнута API (4xx), повтор не поможет; False - не записана
+            из-за сбоя сети или сервера (или записана).
+        count_requests (int): Выполнено запросов v2/entity.
+    """
+
+    def __init__(self, count):
+        self.ids = [None] * count
+        self.errors = [None] * count
+        self.rejected = [False] * count
+        self.count_requests = 0
+
+    @property
+    def ok(self):
+        return not any(self.errors)
+
+    @property
+    def count_errors(self):
+        return sum(1 for error in self.errors if error)
+
+    def get_first_error(self):
+        return next((error for error in self.errors if error), None)
+
+
+def iter_entity_chunks(object_code, rows, max_rows=None, max_bytes=None, schema_name=None):
+    """
+    Делит строки на части для многострочных запросов v2/entity по количеству строк и размеру тела.
+
+    Каждая строка кодируется в JSON один раз; параметры части собираются из готовых строк.
+
+    Args:
+        object_code (str): Код объекта.
+        rows (iterable): Строки: словари values или пары (values, datas).
+        max_rows (int, optional): Максимум строк в части (по умолчанию bulk_max_rows).
+        max_bytes (int, optional): Максимальный размер параметров части в байтах (по умолчанию bulk_max_bytes).
+        schema_name (str, optional): Схема; по умолчанию config.schema_name.
+
+    Yields:
+        tuple: (индекс первой строки части, список строк части [(values, datas)], параметры - строка JSON).
+    """
+    max_rows = max_rows or bulk_max_rows
+    max_bytes = max_bytes or bulk_max_bytes
+    head = '{"schema_name": %s, "object_code": %s, "values": [' % (
+        json.dumps(schema_name or config.schema_name), json.dumps(object_code))
+    chunk, encoded, size, first = [], [], len(head), 0
+
+    def get_params():
+        datas = '~~~'.join(datas for _, datas in chunk if datas)
+        return head + ', '.join(encoded) + ']' + (
+            ', "datas": ' + json.dumps(datas, ensure_ascii=False) if datas else '') + '}'
+
+    for index, row in enumerate(rows):
+        values, datas = row if isinstance(row, tuple) else (row, '')
+        value_json = json.dumps(values, ensure_ascii=False)
+        row_size = len(value_json.encode()) + (len(datas.encode()) + 3 if datas else 0) + 2
+        if chunk and (len(chunk) >= max_rows or size + row_size > max_bytes):
+            yield first, chunk, get_params()
+            chunk, encoded, size, first = [], [], len(head), index
+        chunk.append((values, datas))
+        encoded.append(value_json)
+        size += row_size
+    if chunk:
+        yield first, chunk, get_params()
+
+
+def apply_entity_answer(result, object_code, first, chunk, ans, is_ok, status, schema_name=None):
+    """
+    Заносит ответ на запрос части в BulkResult (общая часть put_entities и common_async.put_entities).
+
+    Часть из нескольких строк, отвергнутая API (4xx), делится пополам: ошибка сводится к отдельным строкам,
+    остальные строки записываются.
+
+    Returns:
+        list: Половины отвергнутой части для повторной отправки [(индекс первой строки, строки, параметры)];
+            пустой список - ответ окончательный.
+    """
+    rejected = bool(status and status.startswith('<4'))
+    if is_ok:
+        try:
+            answer = json.loads(ans)
+        except ValueError:
+            answer = []
+        for i, (values, _) in enumerate(chunk):
+            data = answer[i] if isinstance(answer, list) and i < len(answer) else {}
+            result.ids[first + i] = data.get('id', values.get('id')) if isinstance(data, dict) else values.get('id')
+        return []
+    if len(chunk) == 1 or not rejected:
+        for i in range(len(chunk)):
+            result.errors[first + i] = ans or 'error'
+            result.rejected[first + i] = rejected
+        return []
+    half = len(chunk) // 2
+    parts = []
+    for start, part in ((first, chunk[:half]), (first + half, chunk[half:])):
+        _, part, params = next(iter_entity_chunks(object_code, part, len(part), float('inf'), schema_name))
+        parts.append((start, part, params))
+    return parts
+
+
+def put_entities(object_code, rows, token_user=None, max_rows=None, max_bytes=None, concurrency=None,
+                 schema_name=None):
+    """
+    Записывает строки одного объекта многострочными запросами v2/entity; части отправляются параллельно
+    (не более concurrency запросов одновременно). Часть, отвергнутая API (4xx), делится пополам и
+    повторяется, пока ошибка не будет сведена к отдельным строкам, - остальные строки записываются.
+
+    Args:
+        object_code (str): Код объекта.
+        rows (iterable): Строки: словари values или пары (values, datas).
+        token_user (str, optional): Токен; по умолчанию - из token_manager.
+
+    Returns:
+        BulkResult: id и ошибки по каждой строке.
+    """
+    rows = list(rows)
+    result = BulkResult(len(rows))
+    if not rows:
+        return result
+    if token_user is None:
+        token_user = get_admin_token()
+
+    def send(first, chunk, params):
+        ans, is_ok, status = send_rest('v2/entity', 'PUT', params=params, token_user=token_user)
+        parts = apply_entity_answer(result, object_code, first, chunk, ans, is_ok, status, schema_name)
+        return 1 + sum(send(*part) for part in parts)
+
+    chunks = iter_entity_chunks(object_code, rows, max_rows, max_bytes, schema_name)
+    concurrency = concurrency or bulk_concurrency
+    if concurrency <= 1:
+        result.count_requests = sum(send(*chunk_info) for chunk_info in chunks)
+    else:
+        with ThreadPoolExecutor(concurrency) as pool:
+            result.count_requests = sum(pool.map(lambda chunk_info: send(*chunk_info), chunks))
+    return result
+
+
+# Постраничное чтение v2/select (iter_select): строк в странице
+select_page_size = int(getattr(config, 'select_page_size', 5000))
+
+
+def get_select_page_mes(table, where=None, last_id=None, page_size=None, schema_name=None):
+    """
+    Формирует запрос страницы v2/select: строки с id больше last_id по возрастанию id (keyset-пагинация).
+    """
+    conditions = [f'({where})'] if where else []
+    if last_id is not None:
+        conditions.append(f'id>{last_id}')
+    mes = 'v2/select/{schema}/{table}?column_order=id&limit={limit}'.format(
+        schema=schema_name or config.schema_name, table=table, limit=page_size or select_page_size)
+    if conditions:
+        mes += '&where=' + ' and '.join(conditions)
+    return mes
+
+
+def get_select_columns(columns):
+    """
+    Параметры колонок для постраничного чтения: id нужен для перехода к следующей странице.
+    """
+    if not columns:
+        return None
+    columns = [column.strip() for column in columns.split(',')] if isinstance(columns, str) else list(columns)
+    if 'id' not in columns:
+        columns.insert(0, 'id')
+    return {"columns": ','.join(columns)}
+
+
+def is_last_page(page, page_size=None):
+    # страница больше лимита - API вернул все строки сразу (limit не поддержан), дальше читать нечего
+    return len(page) != (page_size or select_page_size)
+
+
+def iter_select(table, where=None, columns=None, page_size=None, token_user=None, schema_name=None):
+    """
+    Читает таблицу постранично (по page_size строк, keyset по id) и возвращает строки по одной.
+
+    В памяти одновременно находится только одна страница, поэтому полный просмотр большой таблицы
+    не требует загрузки всего ответа. Строки, добавленные или изменённые во время чтения, не пропускаются
+    и не повторяются (в отличие от limit/offset), если их id не меньше уже прочитанных.
+
+    Args:
+        table (str): Таблица (например, 'nsi_list').
+        where (str, optional): Условие отбора, как в параметре where v2/select.
+        columns (str | list, optional): Колонки (id добавляется автоматически).
+        page_size (int, optional): Строк в странице (по умолчанию select_page_size).
+
+    Yields:
+        dict: Строка таблицы.
+
+    Raises:
+        RuntimeError: Ошибка запроса к API.
+    """
+    params = get_select_columns(columns)
+    last_id = None
+    while True:
+        mes = get_select_page_mes(table, where, last_id, page_size, schema_name)
+        ans, is_ok, _ = send_rest(mes, params=params, token_user=token_user)
+        if not is_ok:
+            raise RuntimeError(f'Ошибка чтения {table}: {ans}')
+        page = json.loads(ans)
+        yield from page
+        if is_last_page(page, page_size):
+            return
+        last_id = page[-1]['id']
+
+
 def get_duration(td):
     """
     Преобразует длительность в секундах в строку формата "дни часы:минуты:секунды".
@@ -334,39 +1141,106 @@ def inc_datas(datas, value, translate=False):
              or the non-empty input if one is missing, or an empty string if both are missing.
     """
     val = str(value).strip() if value is not None else ''
-    while '~~~~' in val:
-        # Replace multiple tildes with a double tilde to avoid issues with the separator
-        val = val.replace('~~~~', '~~')  # Normalize value to avoid issues with separator
-    while '~~~' in val:
-        val = val.replace('~~~', '~~')
+    if '~~~' in val:
+        # Replace runs of 3+ tildes with a double tilde to avoid issues with the separator
+        val = _re_tilde_run.sub('~~', val)
     # val = val.replace('#', ' ')  # Replace hash with space to avoid issues with the separator
     # val = val.replace("'", "\'")  # Remove newlines for consistency
     if translate:
         val = translate_to_base(val)  # Translate special characters to base format
-    return f'{datas}~~~{val}' if datas and value else datas or val
+    if val.startswith('~'):
+        val = ' ' + val  # '~' at the edge would merge with the separator ('~~text~~' -> ' ~~text~~ ')
+    if val.endswith('~'):
+        val = val + ' '
+    return f'{datas}~~~{val}' if datas and val else datas or val
+
+
+# Коды специальных символов в строках datas: символ -> маркер '~код~'.
+base_codes = {
+    '(': '~A~', ')': '~B~', '@': '~a1~', '\n': '~LF~',
+    ',': '~a2~', '=': '~a3~', '"': '~a4~', "'": '~a5~',
+    ':': '~a6~', '/': '~b1~', '\t': '~TAB~', '\r': '~R~',
+    # Дополнительные специальные символы
+    ';': '~a7~', '\\': '~b2~', '%': '~a8~', '_': '~a9~',
+    '[': '~C~', ']': '~D~', '{': '~E~', '}': '~F~',
+    '$': '~G~', '&': '~H~', '|': '~I~',
+    '\0': '~Z~',
+}
+_base_items = tuple(base_codes.items())
+_from_base = {code[1:-1]: char for char, code in base_codes.items()}  # 'A' -> '('
+_re_tilde_run = re.compile('~{3,}')
+
+
+def _from_base_parts(parts, final=True):
+    """
+    Раскодирует строку, разбитую по '~', за один проход слева направо: '~код~' заменяется символом,
+    остальные '~' остаются как есть (закрывающая '~' маркера не может открыть следующий маркер).
+
+    :param parts: Результат st.split('~').
+    :param final: False - строка не закончилась (потоковый режим): незавершённый маркер в конце не раскодируется.
+    :return: (раскодированный текст, нераскодированный остаток для следующей части)
+    """
+    out = [parts[0]]
+    i, n = 1, len(parts)
+    while i < n:
+        if not final and i == n - 1:
+            return ''.join(out), '~' + parts[i]  # маркер может продолжиться в следующей части
+        part = parts[i]
+        if i + 1 < n and part in _from_base:
+            out.append(_from_base[part])
+            out.append(parts[i + 1])
+            i += 2
+        else:
+            out.append('~')
+            out.append(part)
+            i += 1
+    return ''.join(out), ''
 
 
 def translate_from_base(st):
-    if st and type(st) == str:
-        st = st.replace('~A~', '(').replace('~B~', ')').replace('~a1~', '@').replace('~LF~', '\n')
-        st = st.replace('~a2~', ',').replace('~a3~', '=').replace('~a4~', '"').replace('~a5~', "'")
-        st = st.replace('~a6~', ':').replace('~b1~', '/').replace('~TAB~', '\t').replace('~R~', '\r')
-        # Дополнительные специальные символы
-        st = st.replace('~a7~', ';').replace('~b2~', '\\').replace('~a8~', '%').replace('~a9~', '_')
-        st = st.replace('~C~', '[').replace('~D~', ']').replace('~E~', '{').replace('~F~', '}')
-        st = st.replace('~G~', '$').replace('~H~', '&').replace('~I~', '|')
-        st = st.replace('~Z~', '\0')
+    """
+    Восстанавливает специальные символы из маркеров '~код~' за один проход слева направо.
+    """
+    if st and type(st) == str and '~' in st:
+        st = _from_base_parts(st.split('~'))[0]
     return st
 
 
 def translate_to_base(st):
+    """
+    Заменяет специальные символы маркерами '~код~'.
+
+    Заменяются только символы, которые есть в строке (проверка `in` без копирования), поэтому обычное
+    сообщение копируется несколько раз, а не 25.
+    """
     if st and type(st) == str:
-        st = st.replace('(', '~A~').replace(')', '~B~').replace('@', '~a1~').replace('\n', '~LF~')
-        st = st.replace(',', '~a2~').replace('=', '~a3~').replace('"', '~a4~').replace("'", '~a5~')
-        st = st.replace(':', '~a6~').replace('/', '~b1~').replace('\t', '~TAB~').replace('\r', '~R~')
-        # Дополнительные специальные символы
-        st = st.replace(';', '~a7~').replace('\\', '~b2~').replace('%', '~a8~').replace('_', '~a9~')
-        st = st.replace('[', '~C~').replace(']', '~D~').replace('{', '~E~').replace('}', '~F~')
-        st = st.replace('$', '~G~').replace('&', '~H~').replace('|', '~I~')
-        st = st.replace('\0', '~Z~')
+        for char, code in _base_items:
+            if char in st:
+                st = st.replace(char, code)
     return st
+
+
+def iter_translate_to_base(chunks):
+    """
+    Потоковый вариант translate_to_base для больших текстов: кодирует части по мере поступления.
+    """
+    for chunk in chunks:
+        if chunk:
+            yield translate_to_base(chunk)
+
+
+def iter_translate_from_base(chunks):
+    """
+    Потоковый вариант translate_from_base: результат совпадает с translate_from_base(''.join(chunks)).
+
+    Незавершённый маркер в конце части переносится в следующую часть.
+    """
+    tail = ''
+    for chunk in chunks:
+        if not chunk:
+            continue
+        text, tail = _from_base_parts((tail + chunk).split('~'), final=False)
+        if text:
+            yield text
+    if tail:
+        yield translate_from_base(tail)
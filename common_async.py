@@ -0,0 +1,224 @@
+"""
+Асинхронные (asyncio) аналоги send_rest, login_admin, write_log_db, put_entities и iter_select из common.
+
+Используют общий aiohttp.ClientSession с пулом keep-alive соединений и ограничение на количество
+одновременных запросов, поэтому корутины бота не занимают потоки пула run_in_executor на время запроса к БД.
+"""
+import time
+import json
+import asyncio
+
+import aiohttp
+
+import common
+import config
+
+async_rest_concurrency = int(getattr(config, 'async_rest_concurrency', 64))  # макс. кол-во одновременных запросов
+async_keepalive_timeout = float(getattr(config, 'async_keepalive_timeout', 60))  # время жизни простаивающего соединения
+
+_state = None
+
+
+class _LoopState:
+    """
+    Сессия и примитивы синхронизации, привязанные к конкретному event loop.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.session = None
+        self.semaphore = asyncio.Semaphore(async_rest_concurrency)
+        self.login_lock = asyncio.Lock()
+
+
+def get_state():
+    global _state
+    loop = asyncio.get_running_loop()
+    if _state is None or _state.loop is not loop:
+        _state = _LoopState(loop)
+    return _state
+
+
+def get_session():
+    """
+    Возвращает общий для текущего event loop aiohttp.ClientSession (создаётся при первом обращении).
+    """
+    state = get_state()
+    if state.session is None or state.session.closed:
+        connector = aiohttp.TCPConnector(limit=common.http_pool_size, keepalive_timeout=async_keepalive_timeout)
+        state.session = aiohttp.ClientSession(connector=connector, headers={"Accept": "application/json"})
+    return state.session
+
+
+async def close_session():
+    """
+    Закрывает общую сессию (вызывается при остановке бота).
+    """
+    if _state is not None and _state.session is not None:
+        await _state.session.close()
+        _state.session = None
+
+
+def get_timeout(timeout=None):
+    timeout = common.get_timeout(timeout)
+    if isinstance(timeout, tuple):
+        return aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+    return aiohttp.ClientTimeout(total=timeout)
+
+
+async def _request(directive, url, js, timeout=None):
+    state = get_state()
+    async with state.semaphore:
+        async with get_session().request(directive, url, json=js, timeout=get_timeout(timeout)) as response:
+            return await response.text(), response.ok, response.status, response.reason
+
+
+async def login_admin(timeout=None):
+    """
+    Асинхронный аналог common.login_admin.
+
+    :return: (txt, result, token_admin, lang_admin)
+    """
+    url, js = common.get_login_request()
+    try:
+        txt, result, _, _ = await _request('POST', url, js, timeout)
+    except Exception as err:
+        return f'Other error occurred: : {err}', False, '', ''
+    return common.parse_login_answer(txt, result)
+
+
+async def get_token(force=False):
+    """
+    Возвращает токен администратора из общего кэша common.token_manager.
+
+    Действующий токен берётся из памяти; при отсутствии или скором истечении выполняется один общий для всех
+    корутин логин.
+    """
+    manager = common.token_manager
+    token = None if force else manager.peek()
+    if token is not None:
+        return token
+    async with get_state().login_lock:
+        token = None if force else manager.peek()
+        if token is not None:
+            return token
+        if manager.throttled():
+            return None
+        txt, is_ok, token, _ = await login_admin()
+        return manager.store(txt, is_ok, token)
+
+
+async def refresh_token(stale_token):
+    """
+    Обновляет токен, отвергнутый API (401). Если токен уже обновлён другой корутиной - возвращает новый.
+    """
+    manager = common.token_manager
+    async with get_state().login_lock:
+        if manager.token is not None and manager.token != stale_token:
+            return manager.token
+        txt, is_ok, token, _ = await login_admin()
+        return manager.store(txt, is_ok, token)
+
+
+async def send_rest(mes, directive="GET", params=None, lang='', token_user=None, timeout=None):
+    """
+    Асинхронный аналог common.send_rest.
+
+    :return: (текст ответа, признак успеха, '<код> - причина')
+    """
+    url, js = common.get_rest_request(mes, directive, params, lang, token_user)
+    try:
+        txt, is_ok, status, reason = await _request(directive, url, js, timeout)
+        if status == 401 and common.token_manager.is_managed(token_user):
+            # токен из кэша отвергнут - один раз перелогиниваемся и повторяем запрос
+            token_user = await refresh_token(token_user)
+            if token_user is not None:
+                js['token'] = token_user
+                txt, is_ok, status, reason = await _request(directive, url, js, timeout)
+    except Exception as err:
+        txt = f'Other error occurred: {err}'
+        return txt, False, None
+    return txt, is_ok, '<' + str(status) + '> - ' + str(reason)
+
+
+async def write_log_db(level, src, msg, schema_name='urban', page=None, file_name='', law_id='', td=None,
+                       write_to_db=True, write_to_console=True, token=None):
+    """
+    Асинхронный аналог common.write_log_db (параметры те же).
+
+    При common.log_async сообщение только ставится в очередь common.log_writer (без ожидания).
+    """
+    if common.log_async:
+        common.write_log_db(level, src, msg, schema_name, page, file_name, law_id, td, write_to_db,
+                            write_to_console, token)
+        return
+    if write_to_console:
+        common.print_log(level, src, msg, page, file_name, law_id, td)
+    if not write_to_db:
+        return
+
+    answer = ''
+    if token is None:
+        token = await get_token()
+        if token is None:
+            answer = common.token_manager.last_error
+    if token is not None:
+        params = common.get_log_params(level, src, msg, schema_name, page, file_name, law_id, td)
+        answer, is_ok, _ = await send_rest('v2/execute', 'PUT', params=params, token_user=token)
+        if is_ok:
+            return
+    print(f"{time.ctime()} ERROR write_log_db {answer}", flush=True)
+
+
+async def put_entities(object_code, rows, token_user=None, max_rows=None, max_bytes=None, concurrency=None,
+                       schema_name=None):
+    """
+    Асинхронный аналог common.put_entities (части отправляются параллельно, не более concurrency).
+
+    :return: common.BulkResult - id и ошибки по каждой строке.
+    """
+    rows = list(rows)
+    result = common.BulkResult(len(rows))
+    if not rows:
+        return result
+    if token_user is None:
+        token_user = await get_token()
+    semaphore = asyncio.Semaphore(concurrency or common.bulk_concurrency)
+
+    async def send(first, chunk, params):
+        ans, is_ok, status = await send_rest('v2/entity', 'PUT', params=params, token_user=token_user)
+        parts = common.apply_entity_answer(result, object_code, first, chunk, ans, is_ok, status, schema_name)
+        count = 1
+        for part in parts:
+            count += await send(*part)
+        return count
+
+    async def send_chunk(first, chunk, params):
+        async with semaphore:
+            return await send(first, chunk, params)
+
+    counts = await asyncio.gather(*(send_chunk(*chunk_info) for chunk_info in common.iter_entity_chunks(
+        object_code, rows, max_rows, max_bytes, schema_name)))
+    result.count_requests = sum(counts)
+    return result
+
+
+async def iter_select(table, where=None, columns=None, page_size=None, token_user=None, schema_name=None):
+    """
+    Асинхронный аналог common.iter_select: постраничное чтение таблицы (keyset по id), строки по одной.
+
+    :raises RuntimeError: Ошибка запроса к API.
+    """
+    params = common.get_select_columns(columns)
+    last_id = None
+    while True:
+        mes = common.get_select_page_mes(table, where, last_id, page_size, schema_name)
+        ans, is_ok, _ = await send_rest(mes, params=params, token_user=token_user)
+        if not is_ok:
+            raise RuntimeError(f'Ошибка чтения {table}: {ans}')
+        page = json.loads(ans)
+        for row in page:
+            yield row
+        if common.is_last_page(page, page_size):
+            return
+        last_id = page[-1]['id']
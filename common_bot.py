@@ -2,34 +2,58 @@
 Общие модули для бота (custom_bot).
 """
 import json
+import time
 import datetime
 
-import asyncio
+import discord
 
 import common
 import config
-from common import send_rest, write_log_db
+import common_async
 
 source = "custom_bot"
 
-async def insert_member(member, token=None):
+# Кэш соответствия Discord ID (snowflake) -> id записи в БД. Эти id практически не меняются,
+# поэтому повторные select'ы nsi_discord_members / nsi_discord_channels на каждое сообщение не нужны.
+id_cache_size = int(getattr(config, 'id_cache_size', 100000))
+id_cache_ttl = float(getattr(config, 'id_cache_ttl', 86400))
+member_ids = common.LruTtlCache(id_cache_size, id_cache_ttl)
+channel_ids = common.LruTtlCache(id_cache_size, id_cache_ttl)
+
+# Фильтр Блума кодов сообщений, уже записанных в БД (load_message_index). Если загружен, exist_messages
+# не обращается к БД за сообщениями, которых точно нет в фильтре. Фильтр - снимок БД на момент загрузки:
+# сообщения новее (их мог записать работающий бот) проверяются запросом.
+message_index_capacity = int(getattr(config, 'message_index_capacity', 2000000))
+message_index_error_rate = float(getattr(config, 'message_index_error_rate', 0.01))
+message_index = None
+message_index_cutoff = 0  # snowflake времени загрузки фильтра: отсутствие в фильтре верно только для кодов меньше
+count_index_skips = 0  # запросов exist_messages, не выполненных благодаря message_index
+
+# Очередь отложенной записи (write_behind.WriteBehindQueue). Если задана, строки discord_messages,
+# discord_his_status_members и discord_his_count_members пишутся пакетами в фоне, иначе - сразу.
+writer = None
+# Накопитель счётчиков discord_his_count_members (member_counts.MemberCountStore). Если задан, присоединения
+# и уходы суммируются в строку за дату, иначе на каждое событие пишется отдельная строка.
+counts = None
+
+
+async def get_token():
     """
-    Добавляет участника в БД, если он отсутствует.
+    Возвращает токен администратора из общего кэша common.token_manager.
 
-    :param member: Объект участника, полученный из Discord API.
-    :type member: Discord.member
-    :param token: Токен для доступа к БД. Если не указан, будет получен через common.login_admin().
-    :type token: Str, optional
-    :return: True, если участник успешно добавлен в БД, False, если участник уже существует,
-             None в случае ошибки.
-    :rtype: Bool | None
+    Действующий токен берётся из памяти без обращения к API; логин выполняется только
+    при отсутствии или скором истечении токена, и одновременные корутины ждут один общий логин.
     """
-    loop = asyncio.get_running_loop()
-    # Если токен не передан, выполняется авторизация администратора для получения токена.
-    if token is None:
-        _, _, token, _ = await loop.run_in_executor(
-            None, lambda: common.login_admin())
+    return await common_async.get_token()
+
+
+def get_member_values(member):
+    """
+    Формирует значения записи discord_members для участника.
 
+    :param member: Объект участника, полученный из Discord API.
+    :return: Словарь values для v2/entity.
+    """
     values = {
         "member_id": str(member.id),
         "sh_name": member.name,
@@ -42,6 +66,39 @@ async def insert_member(member, token=None):
         values["join_at"] = join_at
     except:
         pass
+    return values
+
+
+async def put_entities(object_code, rows, token=None, chunk_size=None):
+    """
+    Записывает несколько строк одного объекта многострочными запросами v2/entity (см. common_async.put_entities).
+
+    :param object_code: Код объекта.
+    :param rows: Строки: словари values или пары (values, datas).
+    :param token: Токен для доступа к БД.
+    :param chunk_size: Максимум строк в одном запросе (по умолчанию common.bulk_max_rows).
+    :return: common.BulkResult - id и ошибки по каждой строке.
+    """
+    return await common_async.put_entities(object_code, rows, token, max_rows=chunk_size)
+
+
+async def insert_member(member, token=None):
+    """
+    Добавляет участника в БД, если он отсутствует.
+
+    :param member: Объект участника, полученный из Discord API.
+    :type member: Discord.member
+    :param token: Токен для доступа к БД. Если не указан, будет взят из кэша через get_token().
+    :type token: Str, optional
+    :return: True, если участник успешно добавлен в БД, False, если участник уже существует,
+             None в случае ошибки.
+    :rtype: Bool | None
+    """
+    # Если токен не передан, он берётся из кэша (авторизация только при необходимости).
+    if token is None:
+        token = await get_token()
+
+    values = get_member_values(member)
 
     params = {
         "schema_name": config.schema_name,
@@ -50,49 +107,71 @@ async def insert_member(member, token=None):
     }
 
     # Проверка наличия участника в БД по его ID.
-    ans, is_ok, _ = await loop.run_in_executor(
-        None, lambda: send_rest("v2/select/{schema}/nsi_discord_members?where=member_id='{member_id}'".format(
-            schema=config.schema_name, member_id=member.id)))
+    ans, is_ok, _ = await common_async.send_rest(
+        "v2/select/{schema}/nsi_discord_members?where=member_id='{member_id}'".format(
+            schema=config.schema_name, member_id=member.id))
     if not is_ok:
         # Логирование ошибки при получении данных участника из БД.
-        await loop.run_in_executor(
-        None, lambda: write_log_db('ERROR', source,
+        await common_async.write_log_db(
+            'ERROR', source,
             '❌ Ошибка при получении участника {} из БД: {}'.format(member.id, ans),
             file_name=common.get_computer_name(), token=token
-        ))
+        )
         return None
 
     # Преобразование ответа в JSON.
     ans = json.loads(ans)
 
     # Если участник отсутствует в БД, выполняется его добавление.
-    if len(ans) == 0:
+    if len(ans) > 0:
+        member_ids.set(str(member.id), ans[0]['id'])
+    else:
         # Запись участника в БД.
-        ans, is_ok, _ = await loop.run_in_executor(
-        None, lambda: send_rest("v2/entity", 'PUT', params=params, token_user=token))
+        ans, is_ok, _ = await common_async.send_rest("v2/entity", 'PUT', params=params, token_user=token)
         if not is_ok:
             # Логирование ошибки при записи данных участника в БД.
-            await loop.run_in_executor(
-        None, lambda: write_log_db(
+            await common_async.write_log_db(
                 'ERROR', source,
                 '❌ Ошибка при записи участника {} в БД: {}'.format(member.id, ans),
                 file_name=common.get_computer_name(), token=token
-            ))
+            )
             return None
         else:
-            await loop.run_in_executor(
-                None, lambda: write_log_db(
-                    'info', source,
-                    '😇 Новый участник {} {}'.format(member.id, member.display_name),
-                    file_name=common.get_computer_name(), token=token
-                ))
+            await common_async.write_log_db(
+                'info', source,
+                '😇 Новый участник {} {}'.format(member.id, member.display_name),
+                file_name=common.get_computer_name(), token=token
+            )
         ans = json.loads(ans)
+        member_ids.set(str(member.id), ans[0]['id'])
         if "join_at" in values:
             await write_value_join_member(member, 1, int(ans[0]['id']),  token, False)
         return True  # Участник успешно добавлен в БД.
-    else:
-        # Участник уже существует в БД.
+    # Участник уже существует в БД.
+    return False
+
+async def update_member(member, token=None):
+    """
+    Обновляет имя участника в БД (on_member_update).
+
+    :param member: Объект участника после изменения.
+    :return: True при успешной записи, False при ошибке или если участника нет в БД.
+    """
+    if token is None:
+        token = await get_token()
+    id = await get_author_id(member.id)
+    if id is None:
+        return False
+    params = {"schema_name": config.schema_name, "object_code": "discord_members",
+              "values": {"id": id, "sh_name": member.name, "display_name": member.display_name}}
+    ans, is_ok, _ = await common_async.send_rest('v2/entity', 'PUT', token_user=token, params=params)
+    if not is_ok:
+        await common_async.write_log_db(
+            'ERROR', source, f'❌ Ошибка при обновлении участника {member.id} {member.display_name} в БД: {ans}',
+            file_name=common.get_computer_name(), token=token)
         return False
+    return True
+
 
 async def write_value_join_member(member, value, id=None, token=None, in_log=False):
     """
@@ -104,20 +183,12 @@ async def write_value_join_member(member, value, id=None, token=None, in_log=Fal
     :param token: Токен для доступа к БД.
     :param in_log: Признак записи в лог факта присоединении или покидании участника сервера.
     """
-    loop = asyncio.get_running_loop()
     if token is None:
-        _, _, token, _ = await loop.run_in_executor(
-            None, lambda: common.login_admin())
+        token = await get_token()
     if id is None:
-        ans, is_ok, _ = await loop.run_in_executor(
-            None, lambda: send_rest("v2/select/{schema}/nsi_discord_members?where=member_id='{member_id}'".format(
-                schema=config.schema_name, member_id=member.id)))
-        if not is_ok:
-            return False
-        ans = json.loads(ans)
-        if len(ans) == 0:
+        id = await get_author_id(member.id)  # Получаем ID участника из БД (или из кэша).
+        if id is None:
             return False
-        id = ans[0]['id']  # Получаем ID участника из БД.
 
     params = {"schema_name": config.schema_name, "object_code": "discord_members",
               "values": {
@@ -127,18 +198,18 @@ async def write_value_join_member(member, value, id=None, token=None, in_log=Fal
     if value == -1:
         params["values"]["remove_at"] = datetime.datetime.utcnow().isoformat()
     # Обновление информации о присоединении участника в БД.
-    ans, is_ok, _ = await loop.run_in_executor(None, lambda: send_rest('v2/entity', 'PUT', token_user=token, params=params))
+    ans, is_ok, _ = await common_async.send_rest('v2/entity', 'PUT', token_user=token, params=params)
     if not is_ok:
-        await loop.run_in_executor(None, lambda: write_log_db(
+        await common_async.write_log_db(
             'ERROR', source, f'❌ Ошибка при обновлении участника {member.id} {member.display_name} в БД: {ans}',
-            file_name=common.get_computer_name(), token=token))
+            file_name=common.get_computer_name(), token=token)
         return False
 
     if in_log:
-        await loop.run_in_executor(None, lambda: write_log_db(
+        await common_async.write_log_db(
             'INFO', source,
             f'📌 Участник {member.id} {member.display_name} присоединился к серверу' if value == 1 else f'Участник {member.id} {member.display_name} покинул сервер',
-            file_name=common.get_computer_name(), token=token))
+            file_name=common.get_computer_name(), token=token)
 
     # формируем запись в discord_his_count_members
     if value == 1:
@@ -146,12 +217,12 @@ async def write_value_join_member(member, value, id=None, token=None, in_log=Fal
     else:
         date = datetime.datetime.utcnow().strftime("%Y-%m-%d")
     # hour = int(member.joined_at.isoformat().split('T')[1][:2]) if member.joined_at else 0
-    # ans, is_ok, _ = await loop.run_in_executor(None, lambda: send_rest(
-    #     "v2/select/{schema}/nsi_discord_his_count_members?where=date='{date}'".format(schema=config.schema_name, date=date)))
+    # ans, is_ok, _ = await common_async.send_rest(
+    #     "v2/select/{schema}/nsi_discord_his_count_members?where=date='{date}'".format(schema=config.schema_name, date=date))
     # if not is_ok:
-    #     await loop.run_in_executor(None, lambda: write_log_db(
+    #     await common_async.write_log_db(
     #         'ERROR', source, f'❌ Ошибка при формировании истории кол-ва участников {member.id} в БД: {ans}',
-    #         file_name=common.get_computer_name(), token=token))
+    #         file_name=common.get_computer_name(), token=token)
     #     return False
 
     params = {
@@ -164,6 +235,13 @@ async def write_value_join_member(member, value, id=None, token=None, in_log=Fal
             "count_remove": 1 if value == -1 else 0,
         }
     }
+    if counts is not None:
+        counts.add(member.joined_at if value == 1 else datetime.datetime.utcnow(),
+                   count_join=params["values"]["count_join"], count_remove=params["values"]["count_remove"])
+        return True
+    if writer is not None:
+        await writer.put("discord_his_count_members", params["values"])
+        return True
     # ans = json.loads(ans)
     # if len(ans) > 0:
         # Если запись есть, то обновляем её
@@ -172,20 +250,18 @@ async def write_value_join_member(member, value, id=None, token=None, in_log=Fal
         #     params["values"]['count_join'] += data['count_join']
         #     params["values"]['count_remove'] += data['count_remove']
         #     params['values']['id'] = data['id']  # ID записи для обновления
-    ans, is_ok, _ = await loop.run_in_executor(None, lambda: send_rest("v2/entity", 'PUT', params=params, token_user=token))
+    ans, is_ok, _ = await common_async.send_rest("v2/entity", 'PUT', params=params, token_user=token)
     if not is_ok:
-        await loop.run_in_executor(None, lambda: write_log_db(
+        await common_async.write_log_db(
             'ERROR', source, f'❌ Ошибка при создании истории кол-ва участников {member.id} в БД: {ans}',
-            file_name=common.get_computer_name(), token=token))
+            file_name=common.get_computer_name(), token=token)
         return False
     return True
 
 
 async def insert_status_member(member, token=None):
-    loop = asyncio.get_running_loop()
-
     if token is None:
-        _, _, token, _ = await loop.run_in_executor(None, lambda: common.login_admin())
+        token = await get_token()
 
     at_date_time = datetime.datetime.utcnow().isoformat()
     values = {
@@ -194,30 +270,30 @@ async def insert_status_member(member, token=None):
         "status": member.status.value,  # 'online', 'offline', 'idle', 'dnd'
         "at_date_time": at_date_time,
     }
+    if writer is not None:
+        await writer.put("discord_his_status_members", values)
+        return True
     params = {
         "schema_name": config.schema_name,
         "object_code": "discord_his_status_members",
         "values": values
     }
 
-    ans, is_ok, _ = await loop.run_in_executor(
-        None, lambda: send_rest("v2/entity", 'PUT', params=params, token_user=token))
+    ans, is_ok, _ = await common_async.send_rest("v2/entity", 'PUT', params=params, token_user=token)
     if not is_ok:
         # Логирование ошибки при записи данных участника в БД.
-        await loop.run_in_executor(
-        None, lambda: write_log_db(
+        await common_async.write_log_db(
             'ERROR', source,
             '❌ Ошибка при записи статуса участника {} в БД: {}'.format(member.id, ans),
             file_name=common.get_computer_name(), token=token
-        ))
+        )
         return None
     # else:
-    #     await loop.run_in_executor(
-    #     None, lambda: write_log_db(
+    #     await common_async.write_log_db(
     #         'info', source,
     #         '✅ Участник {member} сменил статус на [{status}]'.format(member=member.display_name, status=member.status.value),
     #         file_name=common.get_computer_name(), token=token
-    #     ))
+    #     )
     return True
 
 
@@ -228,12 +304,16 @@ async def get_author_id(author_id):
     :param author_id: Код автора.
     :return: ID автора, если он существует, иначе None.
     """
+    id = member_ids.get(str(author_id))
+    if id is not None:
+        return id
     query = f"v2/select/{config.schema_name}/nsi_discord_members?where=member_id='{author_id}'"
-    ans, is_ok, _ = common.send_rest(query, params={"columns": "id"})
+    ans, is_ok, _ = await common_async.send_rest(query, params={"columns": "id"})
 
     if is_ok:
         ans = json.loads(ans)
         if ans:
+            member_ids.set(str(author_id), ans[0]['id'])
             return ans[0]['id']
     return None
 
@@ -245,25 +325,97 @@ async def get_channel_id(channel_id):
     :param channel_id: Код канала.
     :return: ID канала, если он существует, иначе None.
     """
+    id = channel_ids.get(str(channel_id))
+    if id is not None:
+        return id
     query = f"v2/select/{config.schema_name}/nsi_discord_channels?where=code='{channel_id}'"
-    ans, is_ok, _ = common.send_rest(query, params={"columns": "id"})
+    ans, is_ok, _ = await common_async.send_rest(query, params={"columns": "id"})
 
     if is_ok:
         ans = json.loads(ans)
         if ans:
+            channel_ids.set(str(channel_id), ans[0]['id'])
             return ans[0]['id']
     return None
 
 
+async def warm_id_cache():
+    """
+    Заполняет кэш id участников и каналов постраничным чтением таблиц (вызывается в on_ready).
+
+    :return: (кол-во участников, кол-во каналов), загруженных в кэш.
+    """
+    count_members, count_channels = 0, 0
+    try:
+        async for data in common_async.iter_select('nsi_discord_members', columns='id,member_id'):
+            member_ids.set(str(data['member_id']), data['id'])
+            count_members += 1
+        async for data in common_async.iter_select('nsi_discord_channels', columns='id,code'):
+            channel_ids.set(str(data['code']), data['id'])
+            count_channels += 1
+    except RuntimeError as er:
+        print(time.ctime(), f'{source}: {er}', flush=True)
+    return min(count_members, id_cache_size), min(count_channels, id_cache_size)
+
+
+def forget_member(member_id):
+    """
+    Удаляет участника из кэша id (on_member_remove).
+    """
+    member_ids.pop(str(member_id))
+
+
+def forget_channel(channel_id):
+    """
+    Удаляет канал из кэша id (on_guild_channel_delete).
+    """
+    channel_ids.pop(str(channel_id))
+
+
+async def load_message_index(capacity=None):
+    """
+    Заполняет message_index кодами всех сообщений из БД (постранично, только колонка message_id).
+
+    :param capacity: Ожидаемое количество сообщений (по умолчанию message_index_capacity).
+    :return: Количество загруженных кодов или None при ошибке.
+    """
+    global message_index, message_index_cutoff
+    cutoff = discord.utils.time_snowflake(datetime.datetime.now(datetime.timezone.utc))
+    index = common.BloomFilter(capacity or message_index_capacity, message_index_error_rate)
+    try:
+        async for data in common_async.iter_select('nsi_discord_messages', columns='message_id'):
+            index.add(str(data['message_id']))
+    except RuntimeError as er:
+        await common_async.write_log_db(
+            'Error', 'discord', f'❌ {er}', file_name=common.get_computer_name(), law_id='messages')
+        return None
+    message_index = index
+    message_index_cutoff = cutoff
+    return len(index)
+
+
+def add_to_message_index(message_id):
+    if message_index is not None:
+        message_index.add(str(message_id))
+
+
+def is_absent_in_index(message_id):
+    """
+    True, если сообщения точно нет в БД: фильтр загружен, кода в нём нет и сообщение старше загрузки фильтра.
+    """
+    return (message_index is not None and int(message_id) < message_index_cutoff
+            and str(message_id) not in message_index)
+
+
 async def exist_message(message_id):
-    loop = asyncio.get_running_loop()
-    ans, is_ok, _ = await loop.run_in_executor(
-            None, lambda: common.send_rest("v2/select/{schema}/nsi_discord_messages?where=message_id='{message_id}'".format(
-            schema=config.schema_name, message_id=message_id)))
+    if is_absent_in_index(message_id):
+        return False  # точно нет в БД
+    ans, is_ok, _ = await common_async.send_rest(
+        "v2/select/{schema}/nsi_discord_messages?where=message_id='{message_id}'".format(
+            schema=config.schema_name, message_id=message_id))
     if not is_ok:
-        await loop.run_in_executor(
-            None, lambda: write_log_db(
-                'Error', 'discord', f'❌ {ans}', file_name=common.get_computer_name(), law_id='messages'))
+        await common_async.write_log_db(
+            'Error', 'discord', f'❌ {ans}', file_name=common.get_computer_name(), law_id='messages')
         return True  # лучше пропустим
     ans = json.loads(ans)
     if len(ans) > 0:
@@ -271,56 +423,98 @@ async def exist_message(message_id):
     return False  # Сообщение не найдено в БД
 
 
-async def insert_message(msg, token=None):
-    loop = asyncio.get_running_loop()
-    if token is None:
-        _, _, token, _ = await loop.run_in_executor(None, lambda: common.login_admin())
-    try:
+async def exist_messages(message_ids):
+    """
+    Определяет, какие из сообщений уже есть в БД, одним запросом (message_id in (...)).
+
+    Если загружен message_index, в запрос попадают только коды, которые могут быть в БД:
+    есть в фильтре или новее его загрузки (их мог записать работающий бот); для остальных запрос не выполняется.
+
+    :param message_ids: Коды сообщений (например, страница истории канала).
+    :return: Множество кодов (str) сообщений, найденных в БД, или None при ошибке запроса.
+    """
+    global count_index_skips
+    message_ids = [str(message_id) for message_id in message_ids]
+    if message_index is not None:
+        message_ids = [message_id for message_id in message_ids if not is_absent_in_index(message_id)]
+        if not message_ids:
+            count_index_skips += 1
+    if not message_ids:
+        return set()
+    ans, is_ok, _ = await common_async.send_rest(
+        "v2/select/{schema}/nsi_discord_messages?where=message_id in ({ids})".format(
+            schema=config.schema_name, ids=','.join(f"'{message_id}'" for message_id in message_ids)),
+        params={"columns": "message_id"})
+    if not is_ok:
+        await common_async.write_log_db(
+            'Error', 'discord', f'❌ {ans}', file_name=common.get_computer_name(), law_id='messages')
+        return None
+    return {str(data['message_id']) for data in json.loads(ans)}
+
+
+async def get_message_row(msg, token=None):
+    """
+    Формирует строку discord_messages для сообщения (при необходимости добавляет в БД автора и канал).
+
+    :return: (values, datas) для v2/entity.
+    """
+    author_id = await get_author_id(msg.author.id)
+    if author_id is None:
+        await insert_member(msg.author, token=token)
         author_id = await get_author_id(msg.author.id)
-        if author_id is None:
-            await insert_member(msg.author, token=token)
-            author_id = await get_author_id(msg.author.id)
 
+    channel_id = await get_channel_id(msg.channel.id)
+    if channel_id is None:
+        await insert_channel(msg.channel, token=token)
         channel_id = await get_channel_id(msg.channel.id)
-        if channel_id is None:
-            await insert_channel(msg.channel, token=token)
-            channel_id = await get_channel_id(msg.channel.id)
-
-        values = {
-            "channel": channel_id,
-            "message_id": str(msg.id),
-            "created_at": msg.created_at.isoformat(),
-            "edited_at": msg.edited_at.isoformat() if msg.edited_at else "",
-            "is_reply": bool(msg.reference),
-        }
-        datas = ''
-        if msg.content.strip():
-            values["content"] = '%s'
-            datas = msg.content.strip()
-
-        if author_id is not None:
-            values["author"] = author_id
-        if channel_id is not None:
-            values["channel"] = channel_id
-
-        if msg.attachments:
-            attachment_urls = ", ".join(a.url for a in msg.attachments)
-            values["attachments"] = '%s'
-            values["has_attachments"] = True
-            datas = f"{datas}~~~{attachment_urls}" if datas else attachment_urls
-
-        if msg.reactions:
-            values["reactions"] = json.dumps([
-                {"emoji": r.emoji.name if hasattr(r.emoji, 'name') else r.emoji, "count": r.count}
-                for r in msg.reactions
-            ])
-
-        if msg.mentions:
-            mention_names = ", ".join(u.name for u in msg.mentions)
-            if mention_names:
-                values["mentions"] = '%s'
-                datas = f"{datas}~~~{mention_names}" if datas else mention_names
 
+    values = {
+        "channel": channel_id,
+        "message_id": str(msg.id),
+        "created_at": msg.created_at.isoformat(),
+        "edited_at": msg.edited_at.isoformat() if msg.edited_at else "",
+        "is_reply": bool(msg.reference),
+    }
+    # части datas добавляются через common.inc_datas: '~~~' внутри текста не сдвигает поля следующих строк
+    datas = ''
+    if msg.content.strip():
+        values["content"] = '%s'
+        datas = common.inc_datas(datas, msg.content)
+
+    if author_id is not None:
+        values["author"] = author_id
+    if channel_id is not None:
+        values["channel"] = channel_id
+
+    if msg.attachments:
+        attachment_urls = ", ".join(a.url for a in msg.attachments)
+        values["attachments"] = '%s'
+        values["has_attachments"] = True
+        datas = common.inc_datas(datas, attachment_urls)
+
+    if msg.reactions:
+        values["reactions"] = json.dumps([
+            {"emoji": r.emoji.name if hasattr(r.emoji, 'name') else r.emoji, "count": r.count}
+            for r in msg.reactions
+        ])
+
+    if msg.mentions:
+        mention_names = ", ".join(u.name for u in msg.mentions)
+        if mention_names:
+            values["mentions"] = '%s'
+            datas = common.inc_datas(datas, mention_names)
+    return values, datas
+
+
+async def insert_message(msg, token=None):
+    if token is None:
+        token = await get_token()
+    try:
+        values, datas = await get_message_row(msg, token)
+        if writer is not None:
+            await writer.put('discord_messages', values, datas)
+            add_to_message_index(msg.id)
+            return 1
         params = {
             'schema_name': common.config.schema_name,
             'object_code': 'discord_messages',
@@ -328,33 +522,55 @@ async def insert_message(msg, token=None):
             'datas': datas
         }
 
-        ans, is_ok, _ = await loop.run_in_executor(
-            None, lambda: common.send_rest('v2/entity', 'PUT', params=params, token_user=token))
+        ans, is_ok, _ = await common_async.send_rest('v2/entity', 'PUT', params=params, token_user=token)
         if not is_ok:
-            await loop.run_in_executor(
-                None, lambda: write_log_db(
-                    'Error', 'discord', f'❌ {ans}', file_name=common.get_computer_name(), token=token, law_id='messages'
-                ))
+            await common_async.write_log_db(
+                'Error', 'discord', f'❌ {ans}', file_name=common.get_computer_name(), token=token, law_id='messages'
+            )
             return 0
         else:
-            await loop.run_in_executor(
-                None, lambda: write_log_db(
-                    'info', 'discord', f'Добавлено новое сообщение ' + str(msg.id),
-                    file_name=common.get_computer_name(), token=token, law_id='messages'))
+            add_to_message_index(msg.id)
+            await common_async.write_log_db(
+                'info', 'discord', f'Добавлено новое сообщение ' + str(msg.id),
+                file_name=common.get_computer_name(), token=token, law_id='messages')
             return 1
     except Exception as er:
-        await loop.run_in_executor(
-            None, lambda: write_log_db(
-                'Exception', 'discord', f'{er}', file_name=common.get_computer_name(), token=token, law_id='messages'
-            )
+        await common_async.write_log_db(
+            'Exception', 'discord', f'{er}', file_name=common.get_computer_name(), token=token, law_id='messages'
         )
     return 0
 
 
+async def insert_messages(messages, token=None):
+    """
+    Добавляет несколько сообщений (например, страницу истории канала) многострочными запросами v2/entity.
+
+    :return: Количество добавленных сообщений.
+    """
+    if token is None:
+        token = await get_token()
+    rows = []
+    for msg in messages:
+        try:
+            rows.append(await get_message_row(msg, token))
+        except Exception as er:
+            await common_async.write_log_db(
+                'Exception', 'discord', f'{msg.id}: {er}', file_name=common.get_computer_name(), token=token,
+                law_id='messages')
+    result = await put_entities('discord_messages', rows, token)
+    for (values, _), error in zip(rows, result.errors):
+        if error is None:
+            add_to_message_index(values['message_id'])
+    if not result.ok:
+        await common_async.write_log_db(
+            'Error', 'discord', f'❌ Не добавлено сообщений: {result.count_errors}: {result.get_first_error()}',
+            file_name=common.get_computer_name(), token=token, law_id='messages')
+    return len(rows) - result.count_errors
+
+
 async def insert_channel(channel, token=None):
-    loop = asyncio.get_running_loop()
     if token is None:
-        _, _, token, _ = await loop.run_in_executor(None, lambda: common.login_admin())
+        token = await get_token()
     values = {
         "code": str(channel.id),
         "sh_name": '%s',
@@ -376,35 +592,31 @@ async def insert_channel(channel, token=None):
         datas += '~~~' + channel.topic
     params = {'schema_name': common.config.schema_name, 'object_code': 'discord_channels',
               "values": values, 'datas': datas}
-    ans, is_ok, _ = await loop.run_in_executor(
-            None, lambda: common.send_rest('v2/entity', 'PUT', params=params, token_user=token))
+    ans, is_ok, _ = await common_async.send_rest('v2/entity', 'PUT', params=params, token_user=token)
     if not is_ok:
-        await loop.run_in_executor(
-            None, lambda:
-            write_log_db('Error', 'discord', f'❌ {ans}', file_name=common.get_computer_name(), token=token))
+        await common_async.write_log_db(
+            'Error', 'discord', f'❌ {ans}', file_name=common.get_computer_name(), token=token)
     else:
         ans = json.loads(ans)
         if len(ans) > 0:
+            if 'id' in ans[0]:
+                channel_ids.set(str(channel.id), ans[0]['id'])
             if 'id' not in values:
                 st = f'Канал [{channel.name}] успешно добавлен в базу данных'
-                await loop.run_in_executor(
-                    None, lambda:
-                    write_log_db('✅ Новый канал', 'discord', st, file_name=common.get_computer_name(), token=token))
+                await common_async.write_log_db(
+                    '✅ Новый канал', 'discord', st, file_name=common.get_computer_name(), token=token)
                 return True
     return False
 
 
 async def delete_channel(channel, token=None):
-    loop = asyncio.get_running_loop()
     if token is None:
-        _, _, token, _ = await loop.run_in_executor(None, lambda: common.login_admin())
+        token = await get_token()
     removed_at = datetime.datetime.utcnow().isoformat()
     query = "update {schema}.nsi_discord_channels set remove=true, removed_at={removed_at} where code='{channel_id}'".format(
         schema=config.schema_name, channel_id=channel.id, removed_at=removed_at
     )
-    ans, is_ok, _ = await loop.run_in_executor(
-            None, lambda: common.send_rest('v2/execute', 'PUT', params={"script": query}, token_user=token))
+    ans, is_ok, _ = await common_async.send_rest('v2/execute', 'PUT', params={"script": query}, token_user=token)
     if not is_ok:
-        await loop.run_in_executor(
-            None, lambda:
-            write_log_db('Error', 'discord', f'❌ {ans}', file_name=common.get_computer_name(), token=token))
+        await common_async.write_log_db(
+            'Error', 'discord', f'❌ {ans}', file_name=common.get_computer_name(), token=token)
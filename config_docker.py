@@ -5,3 +5,71 @@ schema_name = os.environ.get("SCHEMA_NAME", "urban")
 app_lang = os.environ.get("APP_LANG", "ru")
 kirill = os.environ.get("KIRILL", "")
 discord_token = os.environ.get("DISCORD_TOKEN", "")
+
+# Пул HTTP-соединений к REST API
+http_pool_size = int(os.environ.get("HTTP_POOL_SIZE", "16"))
+http_pool_block = os.environ.get("HTTP_POOL_BLOCK", "false").lower() == "true"
+http_connect_timeout = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "10"))
+http_read_timeout = float(os.environ.get("HTTP_READ_TIMEOUT", "300"))
+
+# Кэш токена администратора
+token_ttl = float(os.environ.get("TOKEN_TTL", "3600"))
+token_refresh_margin = float(os.environ.get("TOKEN_REFRESH_MARGIN", "60"))
+token_retry_delay = float(os.environ.get("TOKEN_RETRY_DELAY", "5"))
+
+# Асинхронный REST-клиент (common_async)
+async_rest_concurrency = int(os.environ.get("ASYNC_REST_CONCURRENCY", "64"))
+async_keepalive_timeout = float(os.environ.get("ASYNC_KEEPALIVE_TIMEOUT", "60"))
+
+# Кэш соответствия Discord ID -> id в БД (участники, каналы)
+id_cache_size = int(os.environ.get("ID_CACHE_SIZE", "100000"))
+id_cache_ttl = float(os.environ.get("ID_CACHE_TTL", "86400"))
+
+# Отложенная пакетная запись событий (write_behind)
+write_behind_batch_size = int(os.environ.get("WRITE_BEHIND_BATCH_SIZE", "200"))
+write_behind_interval = float(os.environ.get("WRITE_BEHIND_INTERVAL", "0.5"))
+write_behind_queue_size = int(os.environ.get("WRITE_BEHIND_QUEUE_SIZE", "10000"))
+write_behind_retries = int(os.environ.get("WRITE_BEHIND_RETRIES", "5"))
+
+# Фоновая пакетная запись лога (common.log_writer)
+log_async = os.environ.get("LOG_ASYNC", "true").lower() == "true"
+log_queue_size = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+log_batch_size = int(os.environ.get("LOG_BATCH_SIZE", "100"))
+log_flush_interval = float(os.environ.get("LOG_FLUSH_INTERVAL", "1"))
+# например LOG_SAMPLE_RATES="info=0.1,sleep=1"
+log_sample_rates = {k.strip(): float(v) for k, v in
+                    (unit.split('=') for unit in os.environ.get("LOG_SAMPLE_RATES", "").split(',') if '=' in unit)}
+log_fallback_file = os.environ.get("LOG_FALLBACK_FILE", "/tmp/log_fallback.jsonl")
+
+# Сверка участников сервера с БД (member_sync)
+member_sync_chunk_size = int(os.environ.get("MEMBER_SYNC_CHUNK_SIZE", "500"))
+member_sync_enabled = os.environ.get("MEMBER_SYNC_ENABLED", "true").lower() == "true"
+member_sync_interval = float(os.environ.get("MEMBER_SYNC_INTERVAL", "900"))
+
+# Агрегация событий присутствия (presence)
+# status - строки прежней таблицы discord_his_status_members; sessions и hours пишут в таблицы, которые
+# нужно создать до включения режима (и объекты discord_his_sessions_members / discord_his_online_members в API):
+#   create table urban.nsi_discord_his_sessions_members (id serial primary key, member_id varchar(32),
+#       display_name varchar(255), online_from timestamp, online_to timestamp, seconds integer);
+#   create table urban.nsi_discord_his_online_members (id serial primary key, member_id varchar(32),
+#       hour timestamp, seconds integer);
+presence_mode = os.environ.get("PRESENCE_MODE", "status")  # status, sessions или hours
+presence_debounce = float(os.environ.get("PRESENCE_DEBOUNCE", "60"))
+presence_raw_events = os.environ.get("PRESENCE_RAW_EVENTS", "false").lower() == "true"
+
+# Счётчики discord_his_count_members (member_counts)
+member_counts_interval = float(os.environ.get("MEMBER_COUNTS_INTERVAL", "60"))
+member_counts_hourly = os.environ.get("MEMBER_COUNTS_HOURLY", "false").lower() == "true"
+member_counts_file = os.environ.get("MEMBER_COUNTS_FILE", "/tmp/member_counts.json")
+
+# Пакетная запись строк (common.put_entities)
+bulk_max_rows = int(os.environ.get("BULK_MAX_ROWS", "500"))
+bulk_max_bytes = int(os.environ.get("BULK_MAX_BYTES", "1048576"))
+bulk_concurrency = int(os.environ.get("BULK_CONCURRENCY", "4"))
+
+# Постраничное чтение v2/select (common.iter_select)
+select_page_size = int(os.environ.get("SELECT_PAGE_SIZE", "5000"))
+
+# Фильтр Блума кодов сообщений (common_bot.message_index)
+message_index_capacity = int(os.environ.get("MESSAGE_INDEX_CAPACITY", "2000000"))
+message_index_error_rate = float(os.environ.get("MESSAGE_INDEX_ERROR_RATE", "0.01"))
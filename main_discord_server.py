@@ -1,6 +1,8 @@
 import time
 import os
+import signal
 import threading
+import asyncio
 from http.server import HTTPServer, BaseHTTPRequestHandler
 
 import discord
@@ -8,10 +10,18 @@ from discord.ext import commands
 
 import common_bot
 import common
+import common_async
+import write_behind
+import member_sync
+import presence
+import member_counts
 import config
 
 
-version = '1.2.4 от 2026-01-28'
+version = '1.3.0 от 2026-10-18'
+
+# Синхронизация участников с БД по кэшу gateway (заменяет ежечасный опрос other/discord_members.py)
+member_sync_enabled = getattr(config, 'member_sync_enabled', True)
 
 
 # Health check HTTP сервер для Cloud Run
@@ -39,12 +49,67 @@ intents.presences = True  # <--- ОБЯЗАТЕЛЬНО!
 intents.messages = True
 intents.guilds = True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+
+class DiscordBot(commands.Bot):
+    member_sync = None
+    presence = None
+    closing_task = None  # остановка по SIGTERM
+
+    async def setup_hook(self):
+        # Запись событий в БД - пакетами в фоне, не задерживая обработчики событий
+        common_bot.writer = write_behind.WriteBehindQueue().start()
+        # Счётчики присоединений/уходов - строкой за дату, периодически и при остановке
+        common_bot.counts = member_counts.MemberCountStore().start()
+        # Сессии присутствия участников вместо строки на каждое переключение статуса
+        self.presence = presence.PresenceAggregator().start()
+        try:
+            # Cloud Run останавливает контейнер через SIGTERM - успеваем дописать очередь
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self.request_close)
+        except NotImplementedError:
+            pass  # Windows
+
+    def request_close(self):
+        if self.closing_task is None:
+            self.closing_task = asyncio.create_task(self.close())
+
+    async def start(self, *args, **kwargs):
+        try:
+            await super().start(*args, **kwargs)
+        finally:
+            # start завершается, как только закрыто соединение с Discord, а asyncio.run отменяет
+            # незавершённые задачи - дожидаемся остановки по SIGTERM до конца
+            if self.closing_task is not None:
+                await self.closing_task
+
+    async def close(self):
+        if self.member_sync is not None:
+            await self.member_sync.stop()
+        # Закрываем сессии присутствия (их строки попадут в очередь) и дописываем очередь до остановки бота;
+        # события, пришедшие после этого, записываются сразу
+        if self.presence is not None:
+            await self.presence.close()
+        if common_bot.counts is not None:
+            await common_bot.counts.close()
+        if common_bot.writer is not None:
+            await common_bot.writer.drain()
+        await super().close()
+        # пул соединений к REST API закрывается после остановки бота
+        await common_async.close_session()
+        common.flush_logs()
+
+
+bot = DiscordBot(command_prefix='!', intents=intents)
 
 
 @bot.event
 async def on_ready():
     print(time.ctime(), f'Запущен как {bot.user}')
+    count_members, count_channels = await common_bot.warm_id_cache()
+    print(time.ctime(), f'Кэш id: участников {count_members}, каналов {count_channels}')
+    await bot.presence.seed(member for guild in bot.guilds for member in guild.members)
+    if member_sync_enabled and bot.member_sync is None:
+        # on_ready повторяется при переподключении - сверка запускается один раз
+        bot.member_sync = member_sync.GatewayMemberSync(bot).start()
 
 @bot.event
 async def on_message(message):
@@ -55,6 +120,18 @@ async def on_message(message):
     await bot.process_commands(message)
 
 
+async def member_join(member):
+    # Новый участник добавляется в БД, вернувшемуся снимается пометка удаления
+    if not member_sync_enabled or await common_bot.insert_member(member) is False:
+        await common_bot.write_value_join_member(member, 1, in_log=True)
+
+
+async def member_remove(member):
+    # Записывает информацию о покидании участником сервера в базу данных.
+    await common_bot.write_value_join_member(member, -1, in_log=True)
+    common_bot.forget_member(member.id)
+
+
 @bot.event
 async def on_member_join(member):
     """
@@ -62,7 +139,9 @@ async def on_member_join(member):
 
     :param member: Участник, который присоединился.
     """
-    await common_bot.write_value_join_member(member, 1, in_log=True)
+    # во время стартовой сверки участников событие откладывается до её завершения
+    if bot.member_sync is None or not bot.member_sync.defer('join', member_join, member):
+        await member_join(member)
     print(time.ctime(), f"{member} присоединился к серверу {member.guild.name}")
 
 
@@ -74,16 +153,21 @@ async def on_member_remove(member):
     :param member: Участник, который покинул сервер.
     :type member: Discord.member
     """
-    # Записывает информацию о покидании участником сервера в базу данных.
-    await common_bot.write_value_join_member(member, -1, in_log=True)
+    if bot.member_sync is None or not bot.member_sync.defer('remove', member_remove, member):
+        await member_remove(member)
     print(time.ctime(), f"{member} покинул сервер {member.guild.name}")
 
 
+@bot.event
+async def on_member_update(before, after):
+    if member_sync_enabled and (before.name != after.name or before.display_name != after.display_name):
+        await common_bot.update_member(after)
+
+
 @bot.event
 async def on_presence_update(before, after):
     if before.status != after.status:
-        if after.status.value in ['offline', 'online']:
-            await  common_bot.insert_status_member(after)
+        await bot.presence.update(after)
         # print(time.ctime(), f"{after.name} сменил статус с {before.status} на {after.status}")
 
 
@@ -95,6 +179,7 @@ async def on_guild_channel_create(channel):
 
 @bot.event
 async def on_guild_channel_delete(channel):
+    common_bot.forget_channel(channel.id)
     print(time.ctime(), f"🗑️ Канал удалён: {channel.name}")
 
 
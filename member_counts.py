@@ -0,0 +1,205 @@
+"""
+Локальное накопление счётчиков discord_his_count_members (присоединения, уходы, изменение количества).
+
+Вместо отдельной строки на каждое присоединение или уход счётчики суммируются в памяти по датам
+(или по часам при member_counts_hourly) и раз в member_counts_interval секунд, а также при остановке,
+записываются одной строкой на дату: существующая строка обновляется (сумма), отсутствующая - создаётся.
+
+Несохранённые счётчики хранятся в файле журнала member_counts_file. Журнал записывается не на каждое
+событие, а вместе с записью в БД, поэтому при аварийной остановке теряются счётчики не более чем за
+member_counts_interval секунд. Перед записью в БД в журнал заносятся и ожидаемые итоговые значения строки,
+поэтому после аварийной остановки flush() по журналу определяет, дошла ли запись до БД, и не прибавляет
+счётчики повторно.
+Строка даты обновляется чтением и записью, поэтому счётчики одной таблицы должен вести один процесс.
+"""
+import os
+import json
+import time
+import asyncio
+import datetime
+
+import common
+import common_async
+import config
+
+source = "member_counts"
+
+member_counts_interval = float(getattr(config, 'member_counts_interval', 60))  # период записи в БД, сек
+member_counts_hourly = getattr(config, 'member_counts_hourly', False)  # строка на час вместо строки на дату
+member_counts_file = getattr(config, 'member_counts_file', os.path.join(common.current_path, 'member_counts.json'))
+
+fields = ('count', 'count_join', 'count_remove')
+
+
+def get_bucket(at, hourly=False):
+    """
+    Ключ строки: 'YYYY-MM-DD' или 'YYYY-MM-DD HH:00:00'.
+
+    :param at: datetime или строка даты/времени в формате ISO.
+    """
+    if isinstance(at, str):
+        at = datetime.datetime.fromisoformat(at)
+    if hourly:
+        return at.strftime("%Y-%m-%d %H:00:00")
+    return at.strftime("%Y-%m-%d")
+
+
+class MemberCountStore:
+    """
+    Накопитель счётчиков discord_his_count_members с периодической записью строк по датам.
+
+    :param hourly: Строка на час вместо строки на дату.
+    :param interval: Период записи в БД, сек.
+    :param file_name: Файл журнала несохранённых счётчиков.
+    """
+
+    def __init__(self, hourly=None, interval=None, file_name=None):
+        self.hourly = member_counts_hourly if hourly is None else hourly
+        self.interval = member_counts_interval if interval is None else interval
+        self.file_name = file_name or member_counts_file
+        # дата -> {"delta": {count, count_join, count_remove}, "expect": итоговая строка при незавершённой записи}
+        self.buckets = self._load()
+        self.lock = None
+        self.task = None
+        self.dirty = False  # есть счётчики, не записанные в журнал
+        self.count_rows = 0  # записано строк
+        self.count_recovered = 0  # записей журнала, подтверждённых в БД после аварийной остановки
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+        return self
+
+    def add(self, at, count=0, count_join=0, count_remove=0):
+        """
+        Прибавляет счётчики к строке даты (часа) at.
+        """
+        bucket = self.buckets.setdefault(get_bucket(at, self.hourly), {"delta": dict.fromkeys(fields, 0)})
+        delta = bucket["delta"]
+        delta['count'] += count
+        delta['count_join'] += count_join
+        delta['count_remove'] += count_remove
+        self.dirty = True
+        if self.task is None:
+            self._save()  # периодической записи нет (не запущена или остановлена) - журнал сразу
+
+    async def flush(self, token=None):
+        """
+        Записывает накопленные счётчики в БД: одно чтение строк всех дат и один многострочный запрос записи.
+        """
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if not self.buckets:
+                return True
+            if token is None:
+                token = await common_async.get_token()
+            dates = sorted(self.buckets)
+            ans, is_ok, _ = await common_async.send_rest(
+                "v2/select/{schema}/nsi_discord_his_count_members?where=date in ({dates})".format(
+                    schema=config.schema_name, dates=','.join(f"'{date}'" for date in dates)), token_user=token)
+            if not is_ok:
+                print(time.ctime(), f'{source}: ошибка чтения discord_his_count_members: {ans}', flush=True)
+                return False
+            rows = {}
+            for data in sorted(json.loads(ans), key=lambda data: data['id']):
+                rows.setdefault(get_bucket(str(data['date']), self.hourly), data)
+
+            prepared = []  # (дата, values)
+            for date in dates:
+                bucket = self.buckets[date]
+                row = rows.get(date)
+                expect = bucket.get("expect")
+                if expect is not None and row is not None and all(row.get(f) == expect[f] for f in fields):
+                    # запись дошла до БД до аварийной остановки
+                    self.count_recovered += 1
+                    bucket["delta"] = {f: bucket["delta"][f] - bucket["sent"][f] for f in fields}
+                    bucket.pop("expect")
+                    bucket.pop("sent")
+                if not any(bucket["delta"].values()):
+                    del self.buckets[date]
+                    continue
+                sent = dict(bucket["delta"])
+                values = {"date": date}
+                values.update({f: ((row.get(f) or 0) if row else 0) + sent[f] for f in fields})
+                if row is not None:
+                    values["id"] = row["id"]
+                bucket["expect"] = {f: values[f] for f in fields}
+                bucket["sent"] = sent
+                prepared.append((date, values))
+            self._save()
+
+            # все даты - одним многострочным запросом
+            result = await common_async.put_entities(
+                'discord_his_count_members', [values for _, values in prepared], token)
+            for (date, _), error in zip(prepared, result.errors):
+                if error:
+                    continue  # при следующей записи по "expect" будет видно, дошла ли строка до БД
+                self.count_rows += 1
+                bucket = self.buckets[date]
+                # за время записи могли добавиться новые счётчики - в журнале остаются только они
+                bucket["delta"] = {f: bucket["delta"][f] - bucket["sent"][f] for f in fields}
+                bucket.pop("expect")
+                bucket.pop("sent")
+                if not any(bucket["delta"].values()):
+                    del self.buckets[date]
+            if not result.ok:
+                await common_async.write_log_db(
+                    'ERROR', source, f'❌ Ошибка при записи истории кол-ва участников ({result.count_errors} дат) '
+                                     f'в БД: {result.get_first_error()}',
+                    file_name=common.get_computer_name(), token=token)
+            self._save()
+            return result.ok
+
+    async def close(self):
+        """
+        Останавливает периодическую запись и записывает оставшиеся счётчики.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+        self._save_dirty()
+        print(time.ctime(), f'{source}: записано строк: {self.count_rows}, восстановлено: {self.count_recovered}, '
+                            f'осталось дат: {len(self.buckets)}', flush=True)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as er:
+                print(time.ctime(), f'{source}: Exception {er}', flush=True)
+            self._save_dirty()
+
+    def _load(self):
+        try:
+            with open(self.file_name, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as er:
+            print(time.ctime(), f'{source}: ошибка чтения {self.file_name}: {er}', flush=True)
+            return {}
+
+    def _save_dirty(self):
+        # flush не записал журнал (ошибка чтения строк из БД) - журнал записывается отдельно
+        if self.dirty:
+            self._save()
+
+    def _save(self):
+        """
+        Записывает журнал атомарно (через временный файл).
+        """
+        self.dirty = False
+        try:
+            tmp_file = self.file_name + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(self.buckets, f)
+            os.replace(tmp_file, self.file_name)
+        except Exception as er:
+            print(time.ctime(), f'{source}: ошибка записи {self.file_name}: {er}', flush=True)
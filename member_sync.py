@@ -0,0 +1,414 @@
+"""
+Сверка списка участников сервера Discord с таблицей nsi_discord_members.
+
+Участники из БД загружаются одним запросом в словарь (member_id -> запись), участники сервера читаются
+потоком и отмечаются в множестве; новые, изменённые и ушедшие участники определяются разностью множеств
+и записываются пакетами: новые и изменённые - многострочными v2/entity, ушедшие - одним update ... in (...).
+
+GatewayMemberSync выполняет сверку в основном боте по кэшу участников gateway и отслеживает расхождения
+по контрольной сумме.
+"""
+import json
+import time
+import hashlib
+import asyncio
+import datetime
+
+import common
+import common_async
+import common_bot
+import config
+
+source = "member_sync"
+
+member_sync_chunk_size = int(getattr(config, 'member_sync_chunk_size', 500))  # строк в одном запросе записи
+member_sync_interval = float(getattr(config, 'member_sync_interval', 900))  # период проверки контрольной суммы, сек
+
+
+class ReconcileStats:
+    """
+    Итог сверки участников.
+    """
+
+    def __init__(self):
+        self.count = 0  # участников на сервере
+        self.count_db = 0  # участников в БД (не удалённых)
+        self.count_insert = 0
+        self.count_update = 0  # вернувшиеся и сменившие имя
+        self.count_remove = 0
+        self.count_error = 0  # строк, которые не удалось записать
+        self.requests = 0  # запросов к БД
+        self.joined = set()  # member_id новых и вернувшихся участников
+        self.removed = set()  # member_id участников, помеченных удалёнными
+
+    def get_summary(self):
+        return (f"Всего участников на сервере: {self.count} (в БД: {self.count_db}),\n"
+                f" - добавлено: {self.count_insert},\n - обновлено: {self.count_update},\n"
+                f" - удалено: {self.count_remove},\n - ошибки: {self.count_error},\n"
+                f" - запросов к БД: {self.requests}")
+
+
+async def load_db_members(token=None):
+    """
+    Читает всех участников из БД (постранично, см. common_async.iter_select).
+
+    :return: Словарь {member_id: {"id", "sh_name", "display_name", "remove"}} или None при ошибке.
+    """
+    try:
+        return {str(data['member_id']): data async for data in common_async.iter_select(
+            'nsi_discord_members', columns='id,member_id,sh_name,display_name,remove', token_user=token)}
+    except RuntimeError as er:
+        await common_async.write_log_db(
+            'ERROR', source, '❌ Ошибка при получении участников из БД: {}'.format(er),
+            file_name=common.get_computer_name(), law_id='members', token=token)
+        return None
+
+
+async def iterate(members):
+    """
+    Перебирает участников из обычного (guild.members) или асинхронного (guild.fetch_members()) источника.
+    """
+    if hasattr(members, '__aiter__'):
+        async for member in members:
+            yield member
+    else:
+        for member in members:
+            yield member
+
+
+def get_join_date(member):
+    return member.joined_at.strftime("%Y-%m-%d") if member.joined_at else None
+
+
+class MemberReconciler:
+    """
+    Сверка участников сервера с БД за один проход.
+
+    :param db_members: Результат load_db_members().
+    :param token: Токен для доступа к БД.
+    :param chunk_size: Максимальное количество строк в одном запросе записи.
+    """
+
+    def __init__(self, db_members, token=None, chunk_size=None):
+        self.db_members = db_members
+        self.token = token
+        self.chunk_size = chunk_size or member_sync_chunk_size
+        self.seen = set()
+        self.inserts = []  # [(member_id, values)]
+        self.updates = []
+        self.joins = {}  # дата присоединения -> кол-во присоединившихся (новых и вернувшихся)
+        self.stats = ReconcileStats()
+        self.stats.count_db = sum(1 for data in db_members.values() if not data.get('remove'))
+
+    def add(self, member):
+        """
+        Учитывает участника сервера; новые и изменённые участники накапливаются для пакетной записи.
+        """
+        member_id = str(member.id)
+        if member_id in self.seen:
+            return
+        self.seen.add(member_id)
+        self.stats.count += 1
+        data = self.db_members.get(member_id)
+        values = common_bot.get_member_values(member)
+        if data is None or data.get('remove'):
+            # новый или вернувшийся участник
+            if data is None:
+                self.inserts.append((member_id, values))
+            else:
+                values.update({"id": data['id'], "remove": False})
+                self.updates.append((member_id, values))
+            self.stats.joined.add(member_id)
+            date = get_join_date(member)
+            if date:
+                self.joins[date] = self.joins.get(date, 0) + 1
+        elif data.get('sh_name') != values['sh_name'] or data.get('display_name') != values['display_name']:
+            self.updates.append((member_id, {"id": data['id'], "sh_name": values['sh_name'],
+                                             "display_name": values['display_name']}))
+        else:
+            common_bot.member_ids.set(member_id, data['id'])
+
+    async def flush(self, force=False):
+        """
+        Записывает накопленные строки, если их набралось на полный пакет (или force).
+        """
+        for rows, counter in ((self.inserts, 'count_insert'), (self.updates, 'count_update')):
+            if rows and (force or len(rows) >= self.chunk_size):
+                await self._put(rows, counter)
+                rows.clear()
+
+    async def _put(self, rows, counter):
+        result = await common_bot.put_entities(
+            'discord_members', [values for _, values in rows], self.token, self.chunk_size)
+        self.stats.requests += result.count_requests
+        for (member_id, _), id, error in zip(rows, result.ids, result.errors):
+            if error is None and id is not None:
+                common_bot.member_ids.set(member_id, id)
+        count_errors = result.count_errors
+        self.stats.count_error += count_errors
+        setattr(self.stats, counter, getattr(self.stats, counter) + len(rows) - count_errors)
+        if count_errors:
+            await common_async.write_log_db(
+                'ERROR', source, f'❌ Ошибка записи {count_errors} участников в БД: {result.get_first_error()}',
+                file_name=common.get_computer_name(), law_id='members', token=self.token)
+
+    def get_removed(self):
+        """
+        :return: Список member_id участников, которые есть в БД (не удалены), но отсутствуют на сервере.
+        """
+        return [member_id for member_id, data in self.db_members.items()
+                if not data.get('remove') and member_id not in self.seen]
+
+    async def remove(self, member_ids):
+        """
+        Помечает ушедших участников удалёнными (update ... where member_id in (...), по chunk_size кодов).
+        """
+        remove_at = datetime.datetime.utcnow().isoformat()
+        for i in range(0, len(member_ids), self.chunk_size):
+            chunk = member_ids[i:i + self.chunk_size]
+            query = ("update {schema}.nsi_discord_members set remove=true, remove_at='{remove_at}' "
+                     "where member_id in ({ids})").format(
+                schema=config.schema_name, remove_at=remove_at, ids=','.join(f"'{member_id}'" for member_id in chunk))
+            ans, is_ok, _ = await common_async.send_rest(
+                'v2/execute', 'PUT', params={"script": query}, token_user=self.token)
+            self.stats.requests += 1
+            if not is_ok:
+                self.stats.count_error += len(chunk)
+                await common_async.write_log_db(
+                    'ERROR', source, f'❌ Ошибка при пометке {len(chunk)} участников удалёнными: {ans}',
+                    file_name=common.get_computer_name(), law_id='members', token=self.token)
+                continue
+            self.stats.count_remove += len(chunk)
+            self.stats.removed.update(chunk)
+            for member_id in chunk:
+                common_bot.forget_member(member_id)
+
+    async def write_history(self):
+        """
+        Записывает изменения количества участников в discord_his_count_members: по строке на дату
+        присоединения и одну строку ушедших за текущий момент (или добавляет их в common_bot.counts).
+        """
+        if common_bot.counts is not None:
+            for date, count in self.joins.items():
+                common_bot.counts.add(date, count_join=count)
+            if self.stats.count_remove:
+                common_bot.counts.add(datetime.datetime.utcnow(), count=-self.stats.count_remove,
+                                      count_remove=self.stats.count_remove)
+            return
+        rows = [({"date": date, "count": 0, "count_join": count, "count_remove": 0}, '')
+                for date, count in sorted(self.joins.items())]
+        if self.stats.count_remove:
+            rows.append(({"date": datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+                          "count": -self.stats.count_remove, "count_remove": self.stats.count_remove}, ''))
+        if not rows:
+            return
+        result = await common_bot.put_entities('discord_his_count_members', rows, self.token, self.chunk_size)
+        self.stats.requests += result.count_requests
+        if not result.ok:
+            await common_async.write_log_db(
+                'ERROR', source, f'❌ Ошибка при создании истории кол-ва участников в БД: {result.get_first_error()}',
+                file_name=common.get_computer_name(), law_id='members', token=self.token)
+
+
+async def reconcile_members(members, token=None, chunk_size=None):
+    """
+    Сверяет участников сервера с БД и записывает разницу.
+
+    :param members: Участники сервера: guild.fetch_members() или guild.members.
+    :param token: Токен для доступа к БД.
+    :return: ReconcileStats или None, если не удалось прочитать участников из БД.
+    """
+    if token is None:
+        token = await common_bot.get_token()
+    db_members = await load_db_members(token)
+    if db_members is None:
+        return None
+    reconciler = MemberReconciler(db_members, token, chunk_size)
+    reconciler.stats.requests += 1
+    async for member in iterate(members):
+        reconciler.add(member)
+        await reconciler.flush()
+    await reconciler.flush(force=True)
+    await reconciler.remove(reconciler.get_removed())
+    await reconciler.write_history()
+    return reconciler.stats
+
+
+def get_checksum(member_ids):
+    """
+    Контрольная сумма множества участников: (количество, md5 отсортированных кодов).
+    """
+    member_ids = sorted(str(member_id) for member_id in member_ids)
+    return len(member_ids), hashlib.md5(','.join(member_ids).encode()).hexdigest()
+
+
+async def load_member_checksum(token=None):
+    """
+    Контрольная сумма не удалённых участников, вычисленная в БД одним запросом (без чтения кодов):
+    то же, что get_checksum по множеству их member_id (повторяющиеся строки участника учитываются один раз).
+
+    :return: (количество, md5) или None при ошибке запроса.
+    :raises ValueError: API не вычисляет выражения в columns (ответ без count и md5).
+    """
+    mes = 'v2/select/{schema}/nsi_discord_members?where=remove is not true'.format(schema=config.schema_name)
+    params = {"columns": "count(distinct member_id) as count, "
+                         "md5(coalesce(string_agg(distinct member_id::text collate \"C\", ',' "
+                         "order by member_id::text collate \"C\"), '')) as md5"}
+    ans, is_ok, _ = await common_async.send_rest(mes, params=params, token_user=token)
+    if not is_ok:
+        print(time.ctime(), f'{source}: ошибка получения контрольной суммы участников из БД: {ans}', flush=True)
+        return None
+    try:
+        rows = json.loads(ans)
+        return int(rows[0]['count']), rows[0]['md5']
+    except (ValueError, LookupError, TypeError) as er:
+        raise ValueError(f'неожиданный ответ ({er}): {ans[:200]}')
+
+
+async def load_db_checksum(token=None):
+    """
+    Контрольная сумма не удалённых участников по всем строкам БД (load_db_members).
+
+    :return: (количество, md5) или None при ошибке.
+    """
+    db_members = await load_db_members(token)
+    if db_members is None:
+        return None
+    return get_checksum(member_id for member_id, data in db_members.items() if not data.get('remove'))
+
+
+class GatewayMemberSync:
+    """
+    Синхронизация участников по кэшу gateway вместо ежечасного guild.fetch_members().
+
+    При старте дожидается загрузки участников серверов (chunking) и один раз сверяет их с БД.
+    Дальше БД поддерживается событиями on_member_join / on_member_remove / on_member_update; присоединения
+    и уходы во время стартовой сверки откладываются (defer) и выполняются после неё, иначе участник,
+    пришедший во время сверки, записывается дважды (сверкой и событием). Раз в interval секунд сравнивается
+    контрольная сумма (количество и хэш кодов) участников в кэше бота и в БД (вычисляется запросом в БД,
+    а если API этого не умеет или запрос не удался - по строкам БД); полная сверка по кэшу выполняется
+    только при расхождении.
+
+    :param bot: Бот discord.py (с intents.members).
+    :param interval: Период проверки контрольной суммы, сек.
+    """
+
+    def __init__(self, bot, interval=None):
+        self.bot = bot
+        self.interval = member_sync_interval if interval is None else interval
+        self.task = None
+        self.started = False  # стартовая сверка завершена
+        self.aggregate = True  # контрольная сумма вычисляется в БД (load_member_checksum)
+        self.pending = []  # отложенные события: [(kind, обработчик, участник)]
+        self.count_checks = 0
+        self.count_drifts = 0
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+        return self
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if not self.started:
+            await self._replay(None)  # остановка во время стартовой сверки - отложенные события не теряются
+
+    def defer(self, kind, handler, member):
+        """
+        Откладывает событие участника до завершения стартовой сверки.
+
+        :param kind: 'join' или 'remove'.
+        :param handler: Обработчик события (корутина от участника).
+        :return: True, если событие отложено, False - его нужно обработать сразу.
+        """
+        if self.started:
+            return False
+        self.pending.append((kind, handler, member))
+        return True
+
+    async def _replay(self, stats):
+        """
+        Выполняет отложенные события; учтённые стартовой сверкой (участник добавлен или помечен удалённым)
+        пропускаются.
+        """
+        while self.pending:
+            kind, handler, member = self.pending.pop(0)
+            if stats is not None and str(member.id) in (stats.joined if kind == 'join' else stats.removed):
+                continue
+            try:
+                await handler(member)
+            except Exception as er:
+                print(time.ctime(), f'{source}: Exception {er}', flush=True)
+        # между последней проверкой очереди и started нет await - новое событие не останется в очереди
+        self.started = True
+
+    def get_members(self):
+        """
+        Участники всех серверов из кэша бота (без запросов к Discord API).
+        """
+        return [member for guild in self.bot.guilds for member in guild.members]
+
+    async def reconcile(self, reason):
+        t = time.time()
+        stats = await reconcile_members(self.get_members())
+        if stats is None:
+            return None
+        await common_async.write_log_db(
+            'INFO', source, f'Сверка участников по кэшу бота ({reason}).\n' + stats.get_summary() + '.',
+            td=time.time() - t, law_id='members', file_name=common.get_computer_name())
+        return stats
+
+    async def check(self):
+        """
+        Сравнивает контрольные суммы участников в кэше бота и в БД.
+
+        :return: True - совпадают, False - расхождение, None - не удалось прочитать БД.
+        """
+        self.count_checks += 1
+        token = await common_bot.get_token()
+        db_sum = None
+        if self.aggregate:
+            try:
+                db_sum = await load_member_checksum(token)
+            except ValueError as er:
+                # API не поддерживает выражения в columns - дальше контрольная сумма по строкам БД
+                self.aggregate = False
+                await common_async.write_log_db(
+                    'ERROR', source, f'❌ Контрольная сумма участников не вычисляется в БД: {er}',
+                    file_name=common.get_computer_name(), law_id='members', token=token)
+        if db_sum is None:
+            db_sum = await load_db_checksum(token)
+            if db_sum is None:
+                return None
+        # участник нескольких серверов есть в кэше каждого из них, а в БД - один раз
+        cache_sum = get_checksum({member.id for member in self.get_members()})
+        if cache_sum == db_sum:
+            return True
+        self.count_drifts += 1
+        print(time.ctime(), f'{source}: расхождение участников: в кэше {cache_sum[0]}, в БД {db_sum[0]}', flush=True)
+        return False
+
+    async def _run(self):
+        stats = None
+        try:
+            for guild in self.bot.guilds:
+                if not guild.chunked:
+                    await guild.chunk()
+            stats = await self.reconcile('старт')
+        except Exception as er:
+            # сверка при старте не удалась - расхождение найдёт очередная проверка контрольной суммы
+            print(time.ctime(), f'{source}: Exception {er}', flush=True)
+        await self._replay(stats)
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                if await self.check() is False:
+                    await self.reconcile('расхождение контрольной суммы')
+            except Exception as er:
+                print(time.ctime(), f'{source}: Exception {er}', flush=True)
@@ -20,14 +20,13 @@ def load_data():
     Загрузка данных из базы данных
     """
     try:
-        ans, is_ok, _ = common.send_rest('v2/select/{schema}/nsi_list?column_order=id'.format(schema=config.schema_name))
-        if not is_ok:
+        # Читаем постранично (keyset по id), не загружая весь ответ одной строкой
+        try:
+            data = list(common.iter_select('nsi_list'))
+        except RuntimeError:
             st.error('Ошибка при получении данных из БД')
             return None
         
-        # Преобразуем JSON в список словарей
-        data = json.loads(ans)
-        
         # Создаем DataFrame
         df = pd.DataFrame(data)
         
@@ -0,0 +1,205 @@
+"""
+Потоковая расшифровка аудио без временных файлов (youtube_sentiment_analyzer).
+
+ffmpeg читает аудио напрямую по ссылке, полученной yt_dlp (без загрузки), или из локального файла,
+и выдаёт в stdout моно PCM 16 кГц (формат, с которым работает Whisper). Поток чтения складывает PCM
+в ограниченную очередь, а Whisper расшифровывает части по stream_chunk_seconds секунд по мере их
+поступления - расшифровка начинается, пока загрузка ещё идёт. Граница части выбирается в самом тихом
+месте последних stream_search_seconds секунд, чтобы не резать слова; хвост предыдущего текста
+передаётся Whisper как initial_prompt. У каждого задания свой рабочий каталог (лог ffmpeg).
+"""
+import os
+import time
+import queue
+import array
+import tempfile
+import threading
+import subprocess
+
+import config
+import model_registry
+
+source = "audio_stream"
+
+ffmpeg_path = getattr(config, 'youtube_ffmpeg', 'ffmpeg')
+stream_chunk_seconds = float(getattr(config, 'youtube_stream_chunk_seconds', 30))  # аудио в одной части расшифровки, сек
+stream_search_seconds = float(getattr(config, 'youtube_stream_search_seconds', 2))  # поиск тихого места на границе, сек
+stream_prefetch_seconds = float(getattr(config, 'youtube_stream_prefetch_seconds', 300))  # аудио в очереди, сек
+stream_prompt_size = int(getattr(config, 'youtube_stream_prompt_size', 200))  # символов текста для initial_prompt
+
+sample_rate = 16000  # whisper.audio.SAMPLE_RATE
+bytes_per_second = sample_rate * 2  # s16le, моно
+frame_bytes = sample_rate // 50 * 2  # 20 мс
+block_bytes = 1 << 16  # размер чтения stdout ffmpeg
+
+
+def is_local(source_name):
+    """
+    Источник - локальный аудио файл (путь или file://), а не ссылка на видео.
+    """
+    return source_name.startswith('file://') or os.path.exists(source_name)
+
+
+def get_input(source_name):
+    """
+    Вход ffmpeg для источника.
+
+    :return: (путь или ссылка на аудио, дополнительные аргументы ffmpeg перед -i).
+    """
+    if is_local(source_name):
+        return source_name[len('file://'):] if source_name.startswith('file://') else source_name, []
+    import yt_dlp
+    with yt_dlp.YoutubeDL({'format': 'bestaudio/best', 'quiet': True, 'no_warnings': True}) as ydl:
+        info = ydl.extract_info(source_name, download=False)
+    headers = ''.join(f'{key}: {value}\r\n' for key, value in (info.get('http_headers') or {}).items())
+    return info['url'], (['-headers', headers] if headers else [])
+
+
+def open_ffmpeg(source_name, workdir):
+    """
+    Запускает ffmpeg, выдающий PCM s16le 16 кГц моно в stdout; ошибки ffmpeg пишутся в workdir/ffmpeg.log.
+    """
+    url, args = get_input(source_name)
+    with open(os.path.join(workdir, 'ffmpeg.log'), 'wb') as log:
+        return subprocess.Popen(
+            [ffmpeg_path, '-nostdin', '-loglevel', 'error', *args, '-i', url,
+             '-f', 's16le', '-ac', '1', '-ar', str(sample_rate), '-'],
+            stdout=subprocess.PIPE, stderr=log)
+
+
+def find_cut(data, search_bytes):
+    """
+    Позиция самого тихого 20-мс кадра в последних search_bytes байтах PCM (граница части).
+    """
+    start = max(0, len(data) - search_bytes)
+    start -= start % 2
+    best, best_energy = len(data), None
+    for pos in range(start, len(data) - frame_bytes + 1, frame_bytes):
+        samples = array.array('h', data[pos:pos + frame_bytes])
+        energy = sum(abs(sample) for sample in samples)
+        if best_energy is None or energy < best_energy:
+            best, best_energy = pos, energy
+    return best
+
+
+class PcmReader:
+    """
+    Чтение stdout ffmpeg в отдельном потоке в ограниченную очередь: загрузка и декодирование
+    продолжаются, пока Whisper расшифровывает предыдущие части.
+    """
+
+    def __init__(self, stream, prefetch_seconds=None):
+        prefetch = stream_prefetch_seconds if prefetch_seconds is None else prefetch_seconds
+        self.stream = stream
+        self.queue = queue.Queue(max(1, int(prefetch * bytes_per_second) // block_bytes))
+        self.count_bytes = 0
+        self.thread = threading.Thread(target=self._run, name=source, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                block = self.stream.read(block_bytes)
+                if not block:
+                    break
+                self.count_bytes += len(block)
+                self.queue.put(block)
+        finally:
+            self.queue.put(b'')
+
+    def close(self):
+        """
+        Освобождает очередь, чтобы поток чтения завершился после остановки ffmpeg.
+        """
+        while self.thread.is_alive():
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                self.thread.join(0.1)
+
+    def __iter__(self):
+        while True:
+            block = self.queue.get()
+            if not block:
+                return
+            yield block
+
+
+def iter_chunks(blocks, chunk_seconds=None, search_seconds=None):
+    """
+    Собирает поток PCM в части по chunk_seconds секунд с границей в тихом месте.
+    """
+    chunk_bytes = int((chunk_seconds or stream_chunk_seconds) * bytes_per_second) // 2 * 2
+    search_bytes = int((stream_search_seconds if search_seconds is None else search_seconds) * bytes_per_second)
+    buffer = bytearray()
+    for block in blocks:
+        buffer += block
+        while len(buffer) >= chunk_bytes:
+            cut = find_cut(buffer[:chunk_bytes], search_bytes) or chunk_bytes
+            yield bytes(buffer[:cut])
+            del buffer[:cut]
+    if len(buffer) >= 2:
+        yield bytes(buffer[:len(buffer) // 2 * 2])
+
+
+def to_float(pcm):
+    """
+    PCM s16le -> массив float32 в диапазоне [-1, 1] (как whisper.audio.load_audio).
+    """
+    import numpy as np
+    return np.frombuffer(pcm, np.int16).flatten().astype(np.float32) / 32768.0
+
+
+class StreamStats:
+    def __init__(self):
+        self.count_chunks = 0
+        self.audio_seconds = 0
+        self.first_text = None  # через сколько секунд после старта готова первая часть текста
+        self.wall = 0
+
+
+def transcribe_stream(source_name, model=None, chunk_seconds=None, stats=None, transcribe=None, digest=None):
+    """
+    Расшифровывает аудио источника по частям, не сохраняя его на диск.
+
+    :param source_name: Ссылка на видео или путь к локальному аудио файлу.
+    :param model: Модель Whisper (по умолчанию - из model_registry).
+    :param stats: StreamStats для статистики.
+    :param transcribe: Функция transcribe(pcm, prompt) -> текст вместо Whisper.
+    :param digest: Объект hashlib, обновляемый всем PCM (хэш аудио для transcript_cache).
+    :return: Текст расшифровки.
+    """
+    t = time.time()
+    stats = stats or StreamStats()
+    if transcribe is None:
+        model = model or model_registry.get_whisper()
+
+        def transcribe(pcm, prompt):
+            return model.transcribe(to_float(pcm), initial_prompt=prompt or None)["text"]
+
+    texts = []
+    with tempfile.TemporaryDirectory(prefix='youtube_') as workdir:
+        process = open_ffmpeg(source_name, workdir)
+        reader = PcmReader(process.stdout)
+        try:
+            for pcm in iter_chunks(reader, chunk_seconds):
+                if digest is not None:
+                    digest.update(pcm)
+                prompt = ''.join(texts)[-stream_prompt_size:]
+                texts.append(transcribe(pcm, prompt))
+                stats.count_chunks += 1
+                stats.audio_seconds += len(pcm) / bytes_per_second
+                if stats.first_text is None:
+                    stats.first_text = time.time() - t
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            reader.close()
+            code = process.wait()
+            process.stdout.close()
+        if code:
+            with open(os.path.join(workdir, 'ffmpeg.log'), 'r', encoding='utf-8', errors='replace') as f:
+                raise RuntimeError(f'ffmpeg завершился с кодом {code}: {f.read()[-1000:].strip()}')
+    stats.wall = time.time() - t
+    return ''.join(texts)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Сравнение расшифровки аудио файла целиком (прежний путь: файл на диске -> Whisper) и потоковой
+расшифровки audio_stream.transcribe_stream (ffmpeg -> PCM в памяти -> Whisper по частям):
+время до первой части текста и общее время. Нужны ffmpeg, whisper и numpy; сеть не нужна -
+источник - локальный аудио файл (по умолчанию генерируется ffmpeg: тон с паузами).
+
+Запуск из каталога other:
+    PYTHONPATH=.. python bench_audio_stream.py [аудио файл] [секунд в части]
+"""
+
+import os
+import sys
+import time
+import tempfile
+import subprocess
+
+import audio_stream
+import model_registry
+
+
+def make_fixture(path, seconds=120):
+    """Тестовый аудио файл: тон 440 Гц, прерываемый тишиной каждые 5 секунд."""
+    subprocess.run([audio_stream.ffmpeg_path, '-nostdin', '-loglevel', 'error', '-y', '-f', 'lavfi',
+                    '-i', f'sine=frequency=440:duration={seconds}', '-af', "volume='if(lt(mod(t,5),0.3),0,1)':eval=frame",
+                    '-ac', '1', path], check=True)
+    return path
+
+
+if __name__ == '__main__':
+    workdir = tempfile.mkdtemp(prefix='bench_audio_')
+    audio = sys.argv[1] if len(sys.argv) > 1 else make_fixture(os.path.join(workdir, 'fixture.wav'))
+    chunk_seconds = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    model = model_registry.get_whisper()
+
+    t = time.perf_counter()
+    text = model.transcribe(audio)["text"]
+    whole = time.perf_counter() - t
+    print(f"{'файл целиком':<24} всего {whole:8.2f} сек, первый текст через {whole:8.2f} сек, "
+          f"символов: {len(text)}")
+
+    stats = audio_stream.StreamStats()
+    text = audio_stream.transcribe_stream(audio, model, chunk_seconds, stats)
+    print(f"{'поток по частям':<24} всего {stats.wall:8.2f} сек, первый текст через {stats.first_text:8.2f} сек, "
+          f"символов: {len(text)}, частей: {stats.count_chunks}, аудио: {stats.audio_seconds:.1f} сек")
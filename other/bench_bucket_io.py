@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Сравнение поштучного ввода-вывода bucket (как прежние cloud.save_file_bucket / check_file_exists_in_bucket /
+load_file / count_files_in_bucket) и bucket_io.BucketIO: запись, проверка наличия, чтение и подсчёт
+количество_blob файлов. Облако не нужно - bucket_io.LocalBucket во временном каталоге с задержкой
+каждого запроса (имитация сети).
+
+Запуск из каталога other:
+    PYTHONPATH=.. python bench_bucket_io.py [количество blob] [задержка запроса, сек]
+"""
+
+import sys
+import time
+import tempfile
+
+import bucket_io
+
+
+def make_texts(count, size=20000):
+    phrase = 'Urban Heat keeps the room warm and the review goes on. '
+    return {f'tcache_video_{i:05d}_base-v1.txt': (phrase * (size // len(phrase) + 1))[:size] for i in range(count)}
+
+
+def measure(title, func, bucket):
+    requests = bucket.count_requests
+    t = time.perf_counter()
+    func()
+    print(f'{title:<32} {time.perf_counter() - t:8.2f} сек, запросов: {bucket.count_requests - requests}')
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.02
+    texts = make_texts(count)
+    names = list(texts) + [f'tcache_video_missing_{i:05d}_base-v1.txt' for i in range(count // 4)]
+
+    with tempfile.TemporaryDirectory(prefix='bench_bucket_') as path:
+        bucket = bucket_io.LocalBucket(path, latency)
+        measure('запись поштучно', lambda: [bucket.blob(name).upload_from_string(text) for name, text in texts.items()],
+                bucket)
+        measure('проверка наличия поштучно', lambda: [bucket.blob(name).exists() for name in names], bucket)
+        measure('чтение поштучно', lambda: [bucket.blob(name).download_as_bytes() for name in texts], bucket)
+        measure('подсчёт перебором', lambda: sum(1 for _ in bucket.list_blobs(prefix='tcache_video_')), bucket)
+
+    with tempfile.TemporaryDirectory(prefix='bench_bucket_') as path:
+        bucket = bucket_io.LocalBucket(path, latency)
+        io = bucket_io.BucketIO(bucket)
+        measure(f'запись пулом x{io.workers} (gzip)', lambda: io.save_many(texts, compress=True), bucket)
+        io.index.clear()  # проверка наличия без списка, оставшегося после записи
+        measure('проверка наличия пакетом', lambda: io.exists_many(names), bucket)
+        measure(f'чтение пулом x{io.workers}', lambda: io.load_many(list(texts)), bucket)
+        measure('подсчёт по кэшу списка', lambda: [io.count('tcache_video_') for _ in range(10)], bucket)
+        print(io.get_stats())
+        io.close()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк REST-слоя: requests.request (новое соединение на каждый вызов)
+против общей keep-alive сессии common.get_session() с пулом соединений.
+
+Запуск из корня проекта:
+    PYTHONPATH=.:other python other/bench_http_session.py [кол-во запросов] [кол-во потоков]
+"""
+
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import config
+import common
+from stub_api import start_stub_server
+
+
+def send_rest_old(mes, directive="GET", params=None):
+    """Прежняя реализация: отдельный requests.request на каждый вызов."""
+    js = {'lang': config.app_lang}
+    if params:
+        js['params'] = params
+    response = requests.request(directive, config.URL + mes, headers={"Accept": "application/json"}, json=js)
+    return response.text, response.ok, response.status_code
+
+
+def send_rest_new(mes, directive="GET", params=None):
+    return common.send_rest(mes, directive, params=params)
+
+
+def run(server, name, func, count, threads):
+    server.reset_counters()
+    mes = 'v2/select/{schema}/nsi_discord_members?where=member_id=1'.format(schema=config.schema_name)
+    t = time.time()
+    if threads == 1:
+        for _ in range(count):
+            func(mes)
+    else:
+        with ThreadPoolExecutor(threads) as pool:
+            list(pool.map(lambda _: func(mes), range(count)))
+    td = time.time() - t
+    print(f"{name:<24} {count / td:10.0f} req/sec   {td:6.2f} sec   "
+          f"TCP-соединений: {server.count_connections}")
+    return count / td
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    server = start_stub_server()
+    config.URL = server.url
+    print(f"Заглушка API: {server.url}; запросов: {count}")
+    for n in (1, threads):
+        print(f"\n--- потоков: {n} ---")
+        before = run(server, 'requests.request', send_rest_old, count, n)
+        after = run(server, 'common.get_session()', send_rest_new, count, n)
+        print(f"Ускорение: x{after / before:.2f}")
+    common.close_session()
+    server.shutdown()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк common.encode / common.decode: прежний посимвольный цикл против bytes.translate
+по позициям ключа, а также повторное раскодирование из кэша.
+
+Запуск из корня проекта:
+    PYTHONPATH=. python other/bench_secret_codec.py [размер в КБ] [кол-во повторов]
+"""
+
+import sys
+import json
+import time
+import base64
+import random
+
+import common
+
+
+def decode_old(key, enc):
+    """Прежняя реализация: посимвольный цикл."""
+    dec = []
+    enc = base64.urlsafe_b64decode(enc).decode()
+    for i in range(len(enc)):
+        key_c = key[i % len(key)]
+        dec_c = chr((256 + ord(enc[i]) - ord(key_c)) % 256)
+        dec.append(dec_c)
+    return "".join(dec)
+
+
+def encode_old(key, text):
+    """Прежняя реализация: посимвольный цикл."""
+    enc = []
+    for i in range(len(text)):
+        key_c = key[i % len(key)]
+        enc_c = chr((ord(text[i]) + ord(key_c)) % 256)
+        enc.append(enc_c)
+    return base64.urlsafe_b64encode("".join(enc).encode()).decode()
+
+
+def make_secret(size):
+    """JSON, похожий на ключ сервисного аккаунта."""
+    rnd = random.Random(1)
+    body = ''.join(rnd.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/') for _ in range(size))
+    return json.dumps({"type": "service_account", "project_id": "discord", "private_key": body,
+                       "client_email": "bot@discord.iam.gserviceaccount.com"})
+
+
+def run(name, func, repeat):
+    t = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    td = (time.perf_counter() - t) / repeat
+    print(f"{name:<36} {td * 1e6:12.1f} мкс")
+    return td
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    key = 'secret-key-for-benchmark'
+    text = make_secret(size * 1024)
+    enc = encode_old(key, text)
+    assert common.encode(key, text) == enc
+    assert common.decode(key, enc) == decode_old(key, enc) == text
+    print(f"Секрет: {len(text)} символов, ключ: {len(key)} символов, повторов: {repeat}\n")
+
+    before = run('encode (цикл)', lambda: encode_old(key, text), repeat)
+    after = run('encode (bytes.translate)', lambda: common.encode(key, text), repeat)
+    print(f"Ускорение: x{before / after:.2f}\n")
+
+    before = run('decode (цикл)', lambda: decode_old(key, enc), repeat)
+    after = run('decode (bytes.translate)', lambda: common.decode.__wrapped__(key, enc), repeat)
+    print(f"Ускорение: x{before / after:.2f}")
+    run('decode (из кэша)', lambda: common.decode(key, enc), repeat)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк анализа настроения на CPU: поштучный прогон упоминаний (прежний цикл sentiment_analyzer(mention))
+против пакетного sentiment_batch.classify, и общее настроение по первым 512 символам против окон всей расшифровки.
+Нужны transformers и torch; модели загружаются через model_registry (имена из config).
+
+Запуск из каталога other:
+    PYTHONPATH=.. python bench_sentiment.py [кол-во предложений] [размер пакета] [потоков torch]
+"""
+
+import sys
+import time
+import random
+
+import model_registry
+import sentiment_batch
+
+
+def make_sentences(count, seed=1):
+    """Предложения, похожие на упоминания игры в расшифровках."""
+    rnd = random.Random(seed)
+    starts = ['I really think', 'Honestly', 'To be fair', 'In my opinion', 'So basically', 'Look']
+    middles = ['Urban Heat is', 'the new Urban Heat update is', 'playing Urban Heat feels', 'Urban Heat gameplay is']
+    ends = ['amazing', 'pretty bad', 'okay I guess', 'the best shooter this year', 'full of bugs', 'so much fun',
+            'a bit boring after a few hours', 'worth the money if you like tactical games']
+    return [' '.join((rnd.choice(starts), rnd.choice(middles), rnd.choice(ends))) +
+            ' ' * rnd.randint(0, 1) + 'and the maps are ' * rnd.randint(0, 6) + 'great'
+            for _ in range(count)]
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else sentiment_batch.sentiment_batch_size
+    if len(sys.argv) > 3:
+        sentiment_batch.set_threads(int(sys.argv[3]))
+    sentences = make_sentences(count)
+
+    t = time.perf_counter()
+    analyzer = model_registry.get_sentiment()
+    print(f"Загрузка модели упоминаний: {time.perf_counter() - t:.1f} сек")
+    t = time.perf_counter()
+    model_registry.get_sentiment()
+    print(f"Повторное обращение к модели: {(time.perf_counter() - t) * 1e6:.0f} мкс")
+
+    single, batched = sentiment_batch.measure(sentences, analyzer, batch_size)
+    print(f"\n--- упоминания, {count} предложений, пакет {batch_size} ---")
+    print(f"{'поштучно':<24} {single:10.1f} предложений/сек")
+    print(f"{'пакетами':<24} {batched:10.1f} предложений/сек")
+    print(f"Ускорение: x{batched / single:.2f}")
+
+    transcript = '. '.join(sentences * 4)
+    print(f"\n--- общее настроение, расшифровка {len(transcript)} символов ---")
+    for mode in ('head', 'chunks'):
+        t = time.perf_counter()
+        answer = sentiment_batch.analyze_overall(transcript, mode=mode, batch_size=batch_size)
+        print(f"{mode:<8} {answer['label']:<10} {answer['score']:.3f}  окон: {answer['windows']:<4} "
+              f"{time.perf_counter() - t:.2f} сек")
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк кодирования специальных символов datas: прежние цепочки из 25 str.replace
+против common.translate_to_base (замена только присутствующих символов) / translate_from_base
+(один проход по split('~')) и потоковых вариантов.
+
+Запуск из корня проекта:
+    PYTHONPATH=. python other/bench_translate.py [кол-во повторов]
+"""
+
+import sys
+import time
+import random
+
+import common
+
+
+def translate_to_base_old(st):
+    """Прежняя реализация: 25 последовательных str.replace."""
+    if st and type(st) == str:
+        st = st.replace('(', '~A~').replace(')', '~B~').replace('@', '~a1~').replace('\n', '~LF~')
+        st = st.replace(',', '~a2~').replace('=', '~a3~').replace('"', '~a4~').replace("'", '~a5~')
+        st = st.replace(':', '~a6~').replace('/', '~b1~').replace('\t', '~TAB~').replace('\r', '~R~')
+        st = st.replace(';', '~a7~').replace('\\', '~b2~').replace('%', '~a8~').replace('_', '~a9~')
+        st = st.replace('[', '~C~').replace(']', '~D~').replace('{', '~E~').replace('}', '~F~')
+        st = st.replace('$', '~G~').replace('&', '~H~').replace('|', '~I~')
+        st = st.replace('\0', '~Z~')
+    return st
+
+
+def translate_from_base_old(st):
+    """Прежняя реализация: 25 последовательных str.replace."""
+    if st and type(st) == str:
+        st = st.replace('~A~', '(').replace('~B~', ')').replace('~a1~', '@').replace('~LF~', '\n')
+        st = st.replace('~a2~', ',').replace('~a3~', '=').replace('~a4~', '"').replace('~a5~', "'")
+        st = st.replace('~a6~', ':').replace('~b1~', '/').replace('~TAB~', '\t').replace('~R~', '\r')
+        st = st.replace('~a7~', ';').replace('~b2~', '\\').replace('~a8~', '%').replace('~a9~', '_')
+        st = st.replace('~C~', '[').replace('~D~', ']').replace('~E~', '{').replace('~F~', '}')
+        st = st.replace('~G~', '$').replace('~H~', '&').replace('~I~', '|')
+        st = st.replace('~Z~', '\0')
+    return st
+
+
+def make_text(size, seed=1):
+    """Текст, похожий на сообщения и расшифровки: слова, пунктуация, ссылки, переводы строк."""
+    rnd = random.Random(seed)
+    words = ['привет', 'hello', 'это', 'и', 'the', 'word', 'слово', 'канал', 'server', 'сегодня', 'we', 'ok']
+    special = ['https://example.com/a_b?x=1&y=2', 'ok,', '(test)', "don't", 'user@mail', '"quote"', '50%',
+               'C:\\path', 'a:b;', '[x]', '{y}', '$5', 'a|b']
+    parts, length = [], 0
+    while length < size:
+        word = rnd.choice(special if rnd.random() < 0.15 else words)
+        parts.append(word + ('\n' if rnd.random() < 0.05 else ' '))
+        length += len(parts[-1])
+    return ''.join(parts)[:size]
+
+
+def chunked(text, size=65536):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def run(name, func, arg, repeat):
+    t = time.perf_counter()
+    for _ in range(repeat):
+        func(arg)
+    td = (time.perf_counter() - t) / repeat
+    print(f"{name:<44} {td * 1e6:12.1f} мкс")
+    return td
+
+
+if __name__ == '__main__':
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    for title, size, count in (('сообщение, 300 символов', 300, repeat),
+                               ('расшифровка, 1 МБ', 1 << 20, max(1, repeat // 200))):
+        text = make_text(size)
+        encoded = common.translate_to_base(text)
+        # совместимость: кодирование побайтно совпадает, раскодирование - точная обратная операция
+        assert encoded == translate_to_base_old(text)
+        assert common.translate_from_base(encoded) == text
+        assert ''.join(common.iter_translate_from_base(chunked(encoded))) == text
+        print(f"\n--- {title}, повторов: {count} ---")
+        before = run('translate_to_base (str.replace)', translate_to_base_old, text, count)
+        after = run('translate_to_base (новая)', common.translate_to_base, text, count)
+        print(f"Ускорение: x{before / after:.2f}")
+        before = run('translate_from_base (str.replace)', translate_from_base_old, encoded, count)
+        after = run('translate_from_base (новая)', common.translate_from_base, encoded, count)
+        print(f"Ускорение: x{before / after:.2f}")
+        if size > 65536:
+            run('iter_translate_to_base (части по 64 КБ)',
+                lambda x: ''.join(common.iter_translate_to_base(chunked(x))), text, count)
+            run('iter_translate_from_base (части по 64 КБ)',
+                lambda x: ''.join(common.iter_translate_from_base(chunked(x))), encoded, count)
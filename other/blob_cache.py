@@ -0,0 +1,220 @@
+"""
+Локальный кэш blob bucket для cloud.load_file / load_files.
+
+Текст blob хранится в файле каталога cache_dir, его свойства (поколение, размер, время последнего
+использования и последней проверки) - в индексе SQLite того же каталога, поэтому кэш одновременно
+используют несколько процессов (анализаторы, дашборд). Файлы записываются атомарно (временный файл
+и os.replace). Копия считается свежей cache_validate секунд после проверки, затем поколение blob
+сверяется с облаком (один запрос свойств) и blob загружается заново, только если он изменился.
+Если суммарный размер кэша превышает cache_mb, удаляются давно не использованные blob (LRU).
+Если облако недоступно, возвращается имеющаяся копия.
+"""
+import os
+import time
+import sqlite3
+import threading
+import urllib.parse
+
+import config
+import common
+
+source = "blob_cache"
+
+cache_dir = getattr(config, 'cloud_cache_dir', os.path.join(common.current_path, 'blob_cache'))
+cache_mb = float(getattr(config, 'cloud_cache_mb', 1024))  # предельный размер кэша, МБ
+cache_validate = float(getattr(config, 'cloud_cache_validate', 60))  # срок без проверки поколения, сек (0 - проверять всегда)
+
+touch_interval = 60  # время использования обновляется в индексе не чаще, сек
+tmp_age = 3600  # временные файлы старше (оставшиеся после аварийного завершения) удаляются, сек
+
+
+class BlobCache:
+    """
+    Кэш blob в локальном каталоге с индексом SQLite.
+
+    :param bucket: Bucket (google.cloud.storage или bucket_io.LocalBucket).
+    :param path: Каталог кэша.
+    :param max_mb: Предельный размер кэша, МБ.
+    :param validate: Срок без проверки поколения, сек.
+    """
+
+    def __init__(self, bucket, path=None, max_mb=None, validate=None):
+        self.bucket = bucket
+        self.path = path or cache_dir
+        self.max_bytes = int((cache_mb if max_mb is None else max_mb) * (1 << 20))
+        self.validate = cache_validate if validate is None else validate
+        self.lock = threading.Lock()
+        self.local = threading.local()  # соединение с индексом: одно на поток
+        self.count_hits = 0  # копия свежая
+        self.count_validated = 0  # поколение совпало с облаком
+        self.count_misses = 0  # копии не было
+        self.count_stale = 0  # blob изменился - загружен заново
+        self.count_offline = 0  # облако недоступно - возвращена имеющаяся копия
+        self.count_evicted = 0
+
+    def _connect(self):
+        """
+        Соединение с индексом текущего потока (создаётся один раз; в дочернем процессе - заново).
+        """
+        db = getattr(self.local, 'db', None)
+        if db is not None and self.local.pid == os.getpid():
+            return db
+        os.makedirs(self.path, exist_ok=True)
+        db = sqlite3.connect(os.path.join(self.path, 'index.sqlite'), timeout=60, isolation_level=None)
+        db.execute('pragma journal_mode=wal')
+        db.execute('create table if not exists blobs (name text primary key, generation text, '
+                   'size integer, used real, checked real)')
+        self.local.db, self.local.pid = db, os.getpid()
+        return db
+
+    def get_file_name(self, name):
+        return os.path.join(self.path, urllib.parse.quote(name, safe=''))
+
+    def get(self, name):
+        """
+        Текст blob name из кэша или облака.
+
+        :return: Текст или None, если blob в облаке нет (ошибка облака без копии в кэше - исключение).
+        """
+        now = time.time()
+        row = self._get_row(name)
+        if row is not None and now - row[2] < self.validate:
+            text = self._read(name)
+            if text is not None:
+                self._touch(name, row, now)
+                self._count('hits')
+                return text
+        try:
+            blob = self.bucket.get_blob(name)
+        except Exception as er:
+            text = self._read(name) if row is not None else None
+            if text is None:
+                raise
+            print(time.ctime(), f'{source}: проверка {name} не удалась, используется копия: {er}', flush=True)
+            self._count('offline')
+            return text
+        if blob is None:
+            if row is not None:
+                self._remove(name)
+            self._count('misses')
+            return None
+        generation = str(blob.generation)
+        if row is not None and row[0] == generation:
+            text = self._read(name)
+            if text is not None:
+                self._touch(name, row, now, checked=True)
+                self._count('validated')
+                return text
+        data = blob.download_as_bytes(timeout=3600)
+        self._store(name, generation, data)
+        self._count('misses' if row is None else 'stale')
+        return data.decode('utf-8')
+
+    def get_stats(self):
+        count, size = self._connect().execute('select count(*), coalesce(sum(size), 0) from blobs').fetchone()
+        requests = self.count_hits + self.count_validated + self.count_misses + self.count_stale + self.count_offline
+        hit_rate = (requests - self.count_misses - self.count_stale) / requests * 100 if requests else 0
+        return (f'попаданий {self.count_hits}, после проверки {self.count_validated}, промахов {self.count_misses}, '
+                f'устаревших {self.count_stale}, без облака {self.count_offline} ({hit_rate:.0f}% из кэша), '
+                f'вытеснено {self.count_evicted}; в кэше {count} blob, {size / (1 << 20):.1f} из '
+                f'{self.max_bytes / (1 << 20):.1f} МБ')
+
+    def _count(self, name):
+        with self.lock:
+            setattr(self, f'count_{name}', getattr(self, f'count_{name}') + 1)
+
+    def _get_row(self, name):
+        """
+        :return: (поколение, время использования, время проверки) или None.
+        """
+        return self._connect().execute('select generation, used, checked from blobs where name = ?',
+                                       (name,)).fetchone()
+
+    def _read(self, name):
+        try:
+            with open(self.get_file_name(name), 'r', encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            # файл удалил другой процесс (вытеснение) - blob загружается заново
+            return None
+
+    def _touch(self, name, row, now, checked=False):
+        if not checked and now - row[1] < touch_interval:
+            return
+        if checked:
+            self._connect().execute('update blobs set used = ?, checked = ? where name = ?', (now, now, name))
+        else:
+            self._connect().execute('update blobs set used = ? where name = ?', (now, name))
+
+    def _store(self, name, generation, data):
+        """
+        Записывает blob атомарно и вытесняет давно не использованные blob сверх предельного размера.
+        """
+        if len(data) > self.max_bytes:
+            return
+        file_name = self.get_file_name(name)
+        tmp_file = os.path.join(self.path, f'.{os.path.basename(file_name)}.{os.getpid()}.{threading.get_ident()}.tmp')
+        try:
+            db = self._connect()
+            with open(tmp_file, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_file, file_name)
+            now = time.time()
+            evicted = []
+            db.execute('begin immediate')  # запись и вытеснение - одна транзакция на все процессы
+            try:
+                db.execute('insert or replace into blobs (name, generation, size, used, checked) values (?, ?, ?, ?, ?)',
+                           (name, generation, len(data), now, now))
+                total = db.execute('select sum(size) from blobs').fetchone()[0]
+                if total > self.max_bytes:
+                    for old, size in db.execute('select name, size from blobs where name <> ? order by used',
+                                                (name,)).fetchall():
+                        if total <= self.max_bytes:
+                            break
+                        db.execute('delete from blobs where name = ?', (old,))
+                        total -= size
+                        evicted.append(old)
+                db.execute('commit')
+            except BaseException:
+                db.execute('rollback')
+                raise
+        except Exception as er:
+            print(time.ctime(), f'{source}: ошибка записи {name}: {er}', flush=True)
+            return
+        for old in evicted:
+            self._remove_file(old)
+        if evicted:
+            with self.lock:
+                self.count_evicted += len(evicted)
+            self._clean_tmp()
+
+    def invalidate(self, name):
+        """
+        Удаляет копию blob name (после записи blob в облако: следующее чтение загрузит новый текст).
+        """
+        try:
+            self._remove(name)
+        except Exception as er:
+            print(time.ctime(), f'{source}: ошибка удаления {name} из кэша: {er}', flush=True)
+
+    def _remove(self, name):
+        self._connect().execute('delete from blobs where name = ?', (name,))
+        self._remove_file(name)
+
+    def _remove_file(self, name):
+        try:
+            os.remove(self.get_file_name(name))
+        except FileNotFoundError:
+            pass
+
+    def _clean_tmp(self):
+        """
+        Удаляет временные файлы процессов, завершившихся во время записи.
+        """
+        now = time.time()
+        for entry in os.scandir(self.path):
+            try:
+                if entry.name.endswith('.tmp') and now - entry.stat().st_mtime > tmp_age:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
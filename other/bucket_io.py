@@ -0,0 +1,395 @@
+"""
+Параллельный ввод-вывод bucket (cloud).
+
+Несколько blob загружаются и выгружаются пулом потоков (ожидание ответа облака не последовательно,
+а одновременно для io_workers blob). Наличие многих blob проверяется одним чтением списка имён
+(или пулом запросов exists, если имён немного); список имён кэшируется по префиксам на index_ttl секунд,
+из него же считается количество blob с префиксом (count_files_in_bucket). Свои записи добавляются в кэш
+сразу; blob, записанные другими процессами, видны после истечения срока кэша.
+Тексты больше resumable_size загружаются возобновляемой загрузкой частями по chunk_size (сбой сети
+повторяет только незавершённую часть); при gzip_enabled тексты сжимаются (Content-Encoding: gzip,
+облако и клиент распаковывают их при чтении - прежние читатели получают тот же текст).
+
+LocalBucket - bucket в локальном каталоге с тем же подмножеством API google.cloud.storage
+(тесты, замеры bench_bucket_io.py и работа без облака: config.cloud_bucket_path).
+"""
+import os
+import gzip
+import json
+import time
+import base64
+import bisect
+import hashlib
+import threading
+import concurrent.futures
+
+import config
+
+source = "bucket_io"
+
+io_workers = int(getattr(config, 'cloud_workers', 8))  # потоков для загрузки/выгрузки нескольких blob
+resumable_size = int(getattr(config, 'cloud_resumable_size', 8 << 20))  # данные больше - возобновляемая загрузка, байт
+chunk_size = int(getattr(config, 'cloud_chunk_size', 8 << 20))  # часть возобновляемой загрузки, байт (кратно 256 КБ)
+gzip_enabled = getattr(config, 'cloud_gzip', False)  # сжимать тексты (Content-Encoding: gzip)
+gzip_min_size = int(getattr(config, 'cloud_gzip_min_size', 4096))  # тексты меньше не сжимаются, байт
+index_ttl = float(getattr(config, 'cloud_index_ttl', 300))  # срок кэша списка имён blob, сек (0 - не кэшировать)
+exists_list_size = int(getattr(config, 'cloud_exists_list_size', 100))  # от стольких имён - чтение списка вместо exists
+
+gzip_magic = b'\x1f\x8b'
+last_name = '\U0010ffff'  # больше любого символа имени (верхняя граница префикса)
+
+
+class BucketIndex:
+    """
+    Кэш списка имён blob по префиксам.
+
+    :param bucket: Bucket (google.cloud.storage или LocalBucket).
+    :param ttl: Срок кэша, сек.
+    """
+
+    def __init__(self, bucket, ttl=None):
+        self.bucket = bucket
+        self.ttl = index_ttl if ttl is None else ttl
+        self.lock = threading.Lock()
+        self.listings = {}  # префикс -> (время чтения, отсортированный список имён)
+        self.count_lists = 0
+
+    def _find(self, prefix):
+        """
+        Свежий список, содержащий все имена с префиксом prefix (список самого длинного подходящего префикса).
+        """
+        now = time.time()
+        found = None
+        for key, (at, names) in self.listings.items():
+            if now - at < self.ttl and prefix.startswith(key) and (found is None or len(key) > len(found[0])):
+                found = key, names
+        return found[1] if found else None
+
+    def get_names(self, prefix=''):
+        """
+        Отсортированный список имён blob с префиксом (из кэша или одним чтением списка).
+        """
+        with self.lock:
+            names = self._find(prefix)
+        if names is None:
+            names = sorted(blob.name for blob in self.bucket.list_blobs(prefix=prefix or None,
+                                                                        fields='items(name),nextPageToken'))
+            with self.lock:
+                self.listings[prefix] = (time.time(), names)
+                self.count_lists += 1
+        return names
+
+    def count(self, prefix=''):
+        names = self.get_names(prefix)
+        return bisect.bisect_left(names, prefix + last_name) - bisect.bisect_left(names, prefix)
+
+    def exists(self, name):
+        """
+        :return: True/False по свежему кэшу или None, если кэша для имени нет.
+        """
+        with self.lock:
+            names = self._find(name)
+        if names is None:
+            return None
+        return has_name(names, name)
+
+    def add(self, name):
+        """
+        Добавляет записанный blob в кэшированные списки (списки не изменяются на месте - их могут читать другие потоки).
+        """
+        with self.lock:
+            for key, (at, names) in list(self.listings.items()):
+                if name.startswith(key) and not has_name(names, name):
+                    names = list(names)
+                    bisect.insort(names, name)
+                    self.listings[key] = (at, names)
+
+    def clear(self):
+        with self.lock:
+            self.listings.clear()
+
+
+def has_name(names, name):
+    i = bisect.bisect_left(names, name)
+    return i < len(names) and names[i] == name
+
+
+class BucketIO:
+    """
+    Загрузка, выгрузка и проверка наличия нескольких blob пулом потоков.
+
+    :param bucket: Bucket (google.cloud.storage или LocalBucket).
+    :param workers: Количество потоков.
+    :param retry: Политика повторов google.api_core для загрузки (None - по умолчанию библиотеки).
+    """
+
+    def __init__(self, bucket, workers=None, retry=None):
+        self.bucket = bucket
+        self.workers = workers or io_workers
+        self.retry = retry
+        self.index = BucketIndex(bucket)
+        self.executor = None
+        self.lock = threading.Lock()
+        self.count_uploaded = 0
+        self.count_resumable = 0
+        self.count_downloaded = 0
+        self.count_exists = 0  # запросов exists (без ответов из кэша списка)
+        self.count_errors = 0
+        self.bytes_text = 0  # загружено байт текста
+        self.bytes_sent = 0  # из них передано (после сжатия)
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix=source)
+            return self.executor
+
+    def map(self, func, items):
+        if len(items) < 2 or self.workers < 2:
+            return [func(item) for item in items]
+        return list(self.get_executor().map(func, items))
+
+    def upload(self, name, text, compress=None):
+        """
+        Записывает текст в blob name (при ошибке - исключение).
+
+        :param compress: Сжимать gzip (None - по настройке cloud_gzip).
+        """
+        data = text.encode('utf-8') if isinstance(text, str) else text
+        blob = self.bucket.blob(name)
+        if (gzip_enabled if compress is None else compress) and len(data) >= gzip_min_size:
+            data_sent = gzip.compress(data, 6, mtime=0)
+            blob.content_encoding = 'gzip'
+        else:
+            data_sent = data
+        if len(data_sent) > resumable_size:
+            blob.chunk_size = chunk_size
+        kwargs = {} if self.retry is None else {'retry': self.retry}
+        blob.upload_from_string(data_sent, content_type='text/plain', timeout=3600, **kwargs)
+        self.index.add(name)
+        with self.lock:
+            self.count_uploaded += 1
+            self.count_resumable += len(data_sent) > resumable_size
+            self.bytes_text += len(data)
+            self.bytes_sent += len(data_sent)
+
+    def download(self, name):
+        """
+        Текст blob name (при ошибке - исключение).
+        """
+        text = self.bucket.blob(name).download_as_bytes(timeout=3600).decode('utf-8')
+        with self.lock:
+            self.count_downloaded += 1
+        return text
+
+    def exists(self, name):
+        found = self.index.exists(name)
+        if found is not None:
+            return found
+        with self.lock:
+            self.count_exists += 1
+        return self.bucket.blob(name).exists()
+
+    def save_many(self, items, compress=None):
+        """
+        Записывает несколько текстов одновременно.
+
+        :param items: Словарь или список пар (имя blob, текст).
+        :return: Словарь имя -> пустая строка в случае успеха или сообщение об ошибке.
+        """
+        items = list(items.items() if isinstance(items, dict) else items)
+
+        def save(item):
+            try:
+                self.upload(item[0], item[1], compress)
+                return ''
+            except Exception as er:
+                self._error()
+                return f"Ошибка при загрузке блоба {item[0]} в облако: {er}"
+
+        return dict(zip((name for name, _ in items), self.map(save, items)))
+
+    def load_many(self, names):
+        """
+        Читает несколько blob одновременно.
+
+        :return: Словарь имя -> текст (пустая строка в случае ошибки).
+        """
+        names = list(names)
+
+        def load(name):
+            try:
+                return self.download(name)
+            except Exception as er:
+                self._error()
+                print(time.ctime(), f'{source}: ошибка при загрузке {name} из облака: {er}', flush=True)
+                return ''
+
+        return dict(zip(names, self.map(load, names)))
+
+    def exists_many(self, names):
+        """
+        Проверяет наличие нескольких blob: по кэшу списка, одним чтением списка по общему префиксу имён
+        (exists_list_size и больше имён) или одновременными запросами exists.
+
+        :return: Словарь имя -> bool.
+        """
+        result = {}
+        unknown = []
+        for name in names:
+            found = self.index.exists(name)
+            if found is None:
+                unknown.append(name)
+            else:
+                result[name] = found
+        if len(unknown) >= exists_list_size:
+            listed = self.index.get_names(os.path.commonprefix(unknown))
+            result.update((name, has_name(listed, name)) for name in unknown)
+        else:
+            result.update(zip(unknown, self.map(self.exists, unknown)))
+        return result
+
+    def count(self, prefix=None):
+        return self.index.count(prefix or '')
+
+    def close(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+    def get_stats(self):
+        ratio = self.bytes_sent / self.bytes_text * 100 if self.bytes_text else 100
+        return (f'загружено {self.count_uploaded} (возобновляемых {self.count_resumable}, передано {ratio:.0f}% байт), '
+                f'прочитано {self.count_downloaded}, запросов exists {self.count_exists}, '
+                f'чтений списка {self.index.count_lists}, ошибок {self.count_errors}')
+
+    def _error(self):
+        with self.lock:
+            self.count_errors += 1
+
+
+class LocalBucket:
+    """
+    Bucket в локальном каталоге: подмножество API google.cloud.storage.Bucket, которое использует cloud.
+    Свойства blob (тип, кодировка, поколение) хранятся в подкаталоге .meta.
+
+    :param path: Каталог bucket.
+    :param latency: Задержка каждого запроса, сек (имитация сети для замеров).
+    """
+
+    def __init__(self, path, latency=0):
+        self.path = os.path.abspath(path)
+        self.name = os.path.basename(self.path)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.count_requests = 0
+        os.makedirs(os.path.join(self.path, '.meta'), exist_ok=True)
+
+    def request(self):
+        with self.lock:
+            self.count_requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def blob(self, name):
+        return LocalBlob(self, name)
+
+    def get_blob(self, name):
+        blob = LocalBlob(self, name)
+        try:
+            blob.reload()
+        except FileNotFoundError:
+            return None
+        return blob
+
+    def list_blobs(self, prefix=None, fields=None, **kwargs):
+        self.request()
+        for name in sorted(os.listdir(self.path)):
+            if name.startswith(prefix or '') and not name.startswith('.') and os.path.isfile(os.path.join(self.path, name)):
+                yield LocalBlob(self, name)
+
+
+class LocalBlob:
+    """
+    Blob LocalBucket: файл с содержимым (как хранится в облаке - возможно, сжатым) и файл свойств.
+    """
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.chunk_size = None
+        self.content_type = None
+        self.content_encoding = None
+        self.generation = None
+        self.etag = None
+        self.md5_hash = None
+        self.size = None
+
+    def get_file_name(self):
+        return os.path.join(self.bucket.path, self.name)
+
+    def get_meta_name(self):
+        return os.path.join(self.bucket.path, '.meta', self.name + '.json')
+
+    def exists(self, **kwargs):
+        self.bucket.request()
+        return os.path.isfile(self.get_file_name())
+
+    def reload(self, **kwargs):
+        """
+        Читает свойства blob (FileNotFoundError, если blob нет).
+        """
+        self.bucket.request()
+        with open(self.get_meta_name(), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        for key, value in meta.items():
+            setattr(self, key, value)
+
+    def upload_from_string(self, data, content_type='text/plain', timeout=None, retry=None, **kwargs):
+        data = data.encode('utf-8') if isinstance(data, str) else data
+        tmp_file = os.path.join(self.bucket.path, '.meta', f'{self.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(tmp_file, 'wb') as f:
+            if self.chunk_size:
+                for pos in range(0, len(data), self.chunk_size):  # каждая часть - отдельный запрос
+                    self.bucket.request()
+                    f.write(data[pos:pos + self.chunk_size])
+            else:
+                self.bucket.request()
+                f.write(data)
+        generation = time.time_ns()
+        md5_hash = base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+        meta = {'content_type': content_type, 'content_encoding': self.content_encoding, 'generation': generation,
+                'etag': f'{md5_hash}:{generation}', 'md5_hash': md5_hash, 'size': len(data)}
+        meta_tmp = tmp_file + '.json'
+        with open(meta_tmp, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(tmp_file, self.get_file_name())
+        os.replace(meta_tmp, self.get_meta_name())
+        for key, value in meta.items():
+            setattr(self, key, value)
+
+    def download_as_bytes(self, raw_download=False, timeout=None, retry=None, **kwargs):
+        self.bucket.request()
+        with open(self.get_file_name(), 'rb') as f:
+            data = f.read()
+        # как клиент google.cloud.storage: сжатое содержимое распаковывается (текст не начинается с gzip_magic)
+        if not raw_download and data[:2] == gzip_magic:
+            data = gzip.decompress(data)
+        return data
+
+    def download_as_text(self, encoding='utf-8', **kwargs):
+        return self.download_as_bytes(**kwargs).decode(encoding)
+
+    def download_to_filename(self, filename, raw_download=False, **kwargs):
+        data = self.download_as_bytes(raw_download, **kwargs)
+        with open(filename, 'wb') as f:
+            f.write(data)
+
+    def delete(self, **kwargs):
+        self.bucket.request()
+        os.remove(self.get_file_name())
+        try:
+            os.remove(self.get_meta_name())
+        except FileNotFoundError:
+            pass
@@ -1,108 +1,64 @@
 """
 Скрипт для получения списка участников сервера Discord и их сохранения в базу данных.
+
+Основной бот (main_discord_server.py) при member_sync_enabled сам сверяет участников по кэшу gateway;
+скрипт нужен только при отключённой синхронизации в боте или для разовой полной сверки через Discord API.
 """
-from itertools import count
+import os
 import time
-import datetime
-import json
 
 import discord
 import asyncio
 
 import common
+import common_async
 import common_bot
+import member_sync
+import member_counts
 import config
 
-version = '1.2.1 от 2025-07-09'
+version = '1.3.0 от 2026-10-18'
 intents = discord.Intents.default()
 intents.members = True  # 🔴 ОБЯЗАТЕЛЬНО для получения списка участников
 intents.guilds = True
 
 bot = discord.Client(intents=intents)
 
+async def get_members():
+    """
+    Участники всех серверов бота (потоком, постранично через Discord API).
+    """
+    for guild in bot.guilds:
+        async for member in guild.fetch_members():
+            yield member
+
+
 @bot.event
 async def on_ready():
     print(f"Бот вошёл как {bot.user}")
+    # Счётчики присоединений/уходов пишутся строкой за дату после каждой сверки
+    common_bot.counts = member_counts.MemberCountStore(
+        file_name=os.path.join(common.current_path, 'discord_members_counts.json'))
     while True:
-        loop = asyncio.get_running_loop()
-        await loop.run_in_executor(
-            None, lambda: common.write_log_db(
+        await common_async.write_log_db(
             'START', common_bot.source, 'Старт опроса участников сервера Discord (members)' +
                                         '\n - version: ' + version +
                                         '\n - host: ' + config.URL +
                                         '\n - schema: ' + config.schema_name,
             law_id='members',
-            file_name=common.get_computer_name()))
-        # Чтение списка members.
-        members = list()  # Список идентификатор существующих участников сервера.
-        ans, is_ok, _ = await loop.run_in_executor(
-            None, lambda: common.send_rest("v2/select/{schema}/nsi_discord_members?where=remove <> true".format(
-                schema=config.schema_name), params={"columns": "member_id"}))
-        if not is_ok:
-            # Логирование ошибки при получении данных участника из БД.
-            await loop.run_in_executor(
-            None, lambda: common.write_log_db('ERROR', common_bot.source,
-                '❌ Ошибка при получении участников из БД: {}'.format(ans),
-                file_name=common.get_computer_name(), law_id='members', token=token
-            ))
-        else:
-            # Преобразование ответа в JSON.
-            ans = json.loads(ans)
-            for data in ans:
-                members.append(data['member_id'])
-
-
+            file_name=common.get_computer_name())
+        token = await common_bot.get_token()
         t = time.time()
-        _, is_ok, token, _ = common.login_admin()
-        count, count_error, count_insert, count_remove = 0, 0, 0, 0
-        for guild in bot.guilds:
-            async for member in guild.fetch_members():
-                result = await common_bot.insert_member(member, token=token)
-                if result is None:
-                    count_error += 1
-                elif result:
-                    count_insert += 1
-                if result != True and str(member.id) in members:  # либо ошибка, либо существует - удаляем из members
-                    members.remove(str(member.id))
-                count += 1  # Считаем количество обработанных участников
-
-        # Записывает информацию о покидании участником сервера в базу данных.
-        date = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-        for member_id in members:
-            query = "update {schema}.nsi_discord_members set remove=true where member_id='{member_id}'".format(
-                schema=config.schema_name, member_id=member_id)
-            ans, is_ok, _ = await loop.run_in_executor(
-                None, lambda: common.send_rest('v2/execute', 'PUT', params={"script": query}, token_user=token))
-            if not is_ok:
-                await loop.run_in_executor(None, lambda: common.write_log_db(
-                    'ERROR', common_bot.source, f'❌ Ошибка при обновлении участника {member_id} в БД: {ans}',
-                    file_name=common.get_computer_name(), token=token, law_id='members'))
-            else:
-                count_remove += 1
-                await loop.run_in_executor(None, lambda: common.write_log_db(
-                    'info', common_bot.source, f'Участник {member_id} помечен как удалённый в БД.',
-                    file_name=common.get_computer_name(), token=token, law_id='members'))
-            # пометим уход участника из БД в истории
-            params = {
-                "schema_name": config.schema_name,
-                "object_code": "discord_his_count_members",
-                "values": {
-                    "date": date,
-                    "count": -1,
-                    "count_remove": 1,
-                }
-            }
-            ans, is_ok, _ = await loop.run_in_executor(None, lambda: common.send_rest("v2/entity", 'PUT', params=params, token_user=token))
-            if not is_ok:
-                await loop.run_in_executor(None, lambda: common.write_log_db(
-                    'ERROR', common_bot.source, f'❌ Ошибка при создании истории кол-ва участников {member.id} в БД: {ans}',
-                    file_name=common.get_computer_name(), token=token, law_id='members'))
-
-        finish_text = (f"Сканирование участников (members) завершено.\nВсего участников на сервере: "
-                       f"{count},\n - добавлено: {count_insert},\n - ошибки: {count_error},\n - удалено: {count_remove}."
-                       f"\nОжидание 1 час, чтобы не перегружать API Discord")
-        await loop.run_in_executor(None, lambda: common.write_log_db('Sleep', common_bot.source, finish_text, td=time.time() - t, law_id='members',
-                            file_name=common.get_computer_name()))
+        # Сверка участников всех серверов с БД за один проход (см. member_sync).
+        stats = await member_sync.reconcile_members(get_members(), token)
+        await common_bot.counts.flush(token)
+        if stats is None:
+            finish_text = "Сканирование участников (members) прервано: не удалось прочитать участников из БД."
+        else:
+            finish_text = "Сканирование участников (members) завершено.\n" + stats.get_summary() + "."
+        finish_text += "\nОжидание 1 час, чтобы не перегружать API Discord"
+        await common_async.write_log_db('Sleep', common_bot.source, finish_text, td=time.time() - t, law_id='members',
+                                        file_name=common.get_computer_name())
         # await bot.close()
         await asyncio.sleep(3600)  # 24 часа в секундах, чтобы не перегружать API Discord
 
@@ -1,4 +1,18 @@
+"""
+Скрипт для загрузки истории сообщений сервера Discord в базу данных.
+
+Загрузка инкрементальная: для каждого канала (и ветки) в файле состояния хранится последнее обработанное
+сообщение, и следующий запуск продолжает историю с него (history(after=...)).
+Запуск с ключом --full сканирует историю каналов с начала.
+
+Каналы сканируются параллельно (не более crawl_concurrency одновременно); при ответах 429 от Discord
+все загрузки приостанавливаются на retry_after и количество одновременных загрузок уменьшается.
+"""
+import os
+import sys
+import json
 import time
+import logging
 
 import discord
 from discord.ext import commands
@@ -6,6 +20,7 @@ import asyncio
 
 import common_bot
 import common
+import common_async
 import config
 
 intents = discord.Intents.default()
@@ -13,50 +28,258 @@ intents.message_content = True  # ❗ Обязателен для чтения 
 intents.guilds = True
 intents.messages = True
 
-version = '1.1.1 от 2025-07-09'
+version = '1.2.1 от 2026-10-18'
 bot = commands.Bot(command_prefix="!", intents=intents)
 
+page_size = 100  # сообщений в странице (столько же отдаёт Discord API за один запрос history)
+state_file = getattr(config, 'messages_state_file', os.path.join(common.current_path, 'discord_messages_state.json'))
+crawl_concurrency = int(getattr(config, 'messages_crawl_concurrency', 4))  # макс. каналов, загружаемых одновременно
+progress_interval = 10  # период вывода прогресса по каналу, сек
+
+
+class CrawlStats:
+    """
+    Счётчики сканирования для итоговой сводки.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.count = 0  # прочитано сообщений
+        self.count_new = 0  # добавлено в БД (записей)
+        self.api_calls = 0  # запросов к Discord API
+        self.db_reads = 0  # запросов проверки наличия в БД
+        self.db_writes = 0  # многострочных запросов записи новых сообщений
+        self.count_429 = 0  # ответов 429
+        self.count_global_429 = 0  # глобальных ограничений
+        self.count_exhausted = 0  # исчерпаний bucket (discord.py ждёт заранее, без 429)
+        self.wait_429 = 0.0  # суммарное retry_after, сек
+
+    def get_summary(self):
+        td = max(time.time() - self.started_at, 1e-6)
+        return (f"сообщений: {self.count} ({self.count / td:.1f} msg/sec), добавлено: {self.count_new},\n"
+                f" - запросов к Discord API: {self.api_calls}, ответов 429: {self.count_429} "
+                f"(глобальных: {self.count_global_429}, ожидание {self.wait_429:.1f} sec), "
+                f"исчерпаний bucket: {self.count_exhausted},\n"
+                f" - запросов к БД: чтение {self.db_reads - common_bot.count_index_skips} "
+                f"(без запроса по фильтру Блума: {common_bot.count_index_skips}), запись {self.db_writes}")
+
+
+class RateLimitPacer(logging.Filter):
+    """
+    Ограничивает количество одновременных запросов history по обратной связи о rate limit.
+
+    discord.py сам повторяет запрос после 429 и сообщает об этом только в лог 'discord.http', поэтому
+    объект подключается к этому логгеру как фильтр: видит все его записи (включая debug об исчерпании
+    bucket), а в консоль пропускает только уровень INFO и выше.
+    При 429 все загрузки приостанавливаются на retry_after, а допустимое количество одновременных
+    запросов уменьшается вдвое; после серии успешных запросов - увеличивается на 1 (до max_concurrency).
+    """
+
+    increase_after = 20  # успешных запросов без 429 для увеличения лимита
+
+    def __init__(self, max_concurrency, stats):
+        super().__init__()
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.active = 0
+        self.successes = 0
+        self.paused_until = 0.0
+        self.stats = stats
+        self.condition = None
+
+    def filter(self, record):
+        msg = record.msg if isinstance(record.msg, str) else ''
+        if 'responded with 429. Retrying' in msg:
+            self.on_rate_limited(float(record.args[-1]))
+        elif msg.startswith('Global rate limit has been hit'):
+            self.stats.count_global_429 += 1
+        elif 'has been exhausted' in msg:
+            self.stats.count_exhausted += 1
+        return record.levelno >= logging.INFO
+
+    def attach(self):
+        logger = logging.getLogger('discord.http')
+        self.logger_level = logger.level
+        logger.setLevel(logging.DEBUG)
+        logger.addFilter(self)
+
+    def detach(self):
+        logger = logging.getLogger('discord.http')
+        logger.removeFilter(self)
+        logger.setLevel(self.logger_level)
+
+    def on_rate_limited(self, retry_after):
+        self.stats.count_429 += 1
+        self.stats.wait_429 += retry_after
+        self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        self.limit = max(1, self.limit // 2)
+        self.successes = 0
+
+    def on_success(self):
+        self.successes += 1
+        if self.successes >= self.increase_after and self.limit < self.max_concurrency:
+            self.limit += 1
+            self.successes = 0
+
+    async def acquire(self):
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        async with self.condition:
+            while self.active >= self.limit:
+                await self.condition.wait()
+            self.active += 1
+        pause = self.paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+
+    async def release(self):
+        async with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+
+def load_state():
+    """
+    Читает файл состояния: {id канала: {"last_message_id": ..., "last_at": ..., "name": ...}}.
+    """
+    try:
+        with open(state_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as er:
+        print(f"⚠️ Ошибка чтения {state_file}: {er}")
+        return {}
+
+
+def save_state(state):
+    """
+    Записывает файл состояния атомарно (через временный файл), чтобы прерванный запуск не испортил его.
+    """
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_file, state_file)
+
+
+async def get_channels(guild):
+    """
+    Возвращает все текстовые каналы сервера и их ветки (активные и архивные), включая ветки форумов.
+    """
+    channels = list(guild.text_channels)
+    threads = {thread.id: thread for thread in guild.threads}
+    for channel in list(guild.text_channels) + list(guild.forums):
+        try:
+            async for thread in channel.archived_threads(limit=None):
+                threads[thread.id] = thread
+        except (discord.Forbidden, discord.HTTPException):
+            pass  # нет доступа к архивным веткам канала
+    return channels + list(threads.values())
+
+
+async def backfill_channel(channel, state, pacer, stats, full=False):
+    """
+    Загружает новые сообщения канала, начиная с сохранённой отметки, постранично (1 страница = 1 запрос history).
+
+    :return: (кол-во прочитанных сообщений, кол-во добавленных в БД)
+    """
+    key = str(channel.id)
+    last = None if full else state.get(key)
+    after = discord.Object(id=int(last['last_message_id'])) if last else None
+    count, count_new = 0, 0
+    t = time.time()
+    t_progress = t
+
+    while True:
+        await pacer.acquire()
+        try:
+            page = [message async for message in channel.history(limit=page_size, after=after, oldest_first=True)]
+        finally:
+            await pacer.release()
+        stats.api_calls += 1
+        pacer.on_success()
+        if not page:
+            break
+        count += len(page)
+        stats.count += len(page)
+
+        existing = await common_bot.exist_messages(message.id for message in page)
+        stats.db_reads += 1
+        if existing is None:
+            raise RuntimeError('не удалось проверить наличие сообщений в БД')
+        new_messages = [message for message in page if str(message.id) not in existing]
+        if new_messages:
+            inserted = await common_bot.insert_messages(new_messages)
+            count_new += inserted
+            stats.count_new += inserted
+            stats.db_writes += 1
+            if inserted < len(new_messages):
+                # отметка остаётся на прежнем месте - страница будет прочитана снова при следующем запуске
+                raise RuntimeError(f'записано {inserted} из {len(new_messages)} новых сообщений, '
+                                   f'загрузка канала остановлена (отметка: {after.id if after else "нет"})')
+        # страница сохранена - передвигаем отметку
+        after = page[-1]
+        state[key] = {"last_message_id": str(after.id), "last_at": after.created_at.isoformat(),
+                      "name": channel.name}
+        save_state(state)
+
+        if time.time() - t_progress >= progress_interval:
+            t_progress = time.time()
+            print(f"   #{channel.name}: прочитано {count}, добавлено {count_new}, "
+                  f"{count / (t_progress - t):.1f} msg/sec, до {after.created_at:%Y-%m-%d}")
+        if len(page) < page_size:
+            break
+    return count, count_new
+
+
+async def crawl_channel(channel, state, pacer, stats, full):
+    try:
+        count, count_new = await backfill_channel(channel, state, pacer, stats, full)
+        if count:
+            print(f"📁 #{channel.name}: прочитано {count}, добавлено {count_new}")
+    except discord.Forbidden:
+        print(f"⛔ #{channel.name}: нет доступа к этому каналу")
+    except (discord.HTTPException, RuntimeError) as e:
+        print(f"⚠️ #{channel.name}: ошибка: {e}")
+
+
 @bot.event
 async def on_ready():
     print(f"Бот вошёл как {bot.user}")
     t = time.time()
-    loop = asyncio.get_running_loop()
-    await loop.run_in_executor(
-        None, lambda: common.write_log_db(
-            'START', common_bot.source, 'Старт сканирования сообщений Discord (messages)' +
-                                        '\n - version: ' + version +
-                                        '\n - host: ' + config.URL +
-                                        '\n - schema: ' + config.schema_name,
-            law_id='members',
-            file_name=common.get_computer_name()))
+    full = '--full' in sys.argv
+    await common_async.write_log_db(
+        'START', common_bot.source, 'Старт сканирования сообщений Discord (messages)' +
+                                    '\n - version: ' + version +
+                                    '\n - host: ' + config.URL +
+                                    '\n - schema: ' + config.schema_name +
+                                    '\n - mode: ' + ('full' if full else 'incremental'),
+        law_id='messages',
+        file_name=common.get_computer_name())
 
     guild = discord.utils.get(bot.guilds, name="Urban Heat Official")  # или bot.get_guild(ID)
+    state = load_state()
+    if full or not state:
+        # большая загрузка: коды сообщений из БД - в фильтр Блума, сообщения старше загрузки фильтра,
+        # которых в нём нет, не проверяются запросами (более новые мог записать работающий бот)
+        count = await common_bot.load_message_index()
+        print(f"Фильтр сообщений: {count} кодов из БД")
+    stats = CrawlStats()
+    pacer = RateLimitPacer(crawl_concurrency, stats)
+    pacer.attach()
+    try:
+        channels = await get_channels(guild)
+        print(f"Каналов и веток: {len(channels)}, одновременно: {crawl_concurrency}")
+        await asyncio.gather(*(crawl_channel(channel, state, pacer, stats, full) for channel in channels))
+    finally:
+        pacer.detach()
 
-    count, count_new = 0, 0
-    for channel in guild.text_channels:
-        if channel.name != 'lore-discussions':
-            continue
-        print(f"\n📁 Канал: #{channel.name}")
-        try:
-            async for message in channel.history(limit=None, oldest_first=True):
-                count += 1
-                # print(f"[{message.created_at}] {message.author}")
-                if not await common_bot.exist_message(message.id):
-                    # print("⛔ Сообщение уже базе данных")
-                # else:
-                    await common_bot.insert_message(message)
-                    count_new += 1
-                    # print("✅ Сообщение успешно сохранено в базу данных")
-        except discord.Forbidden:
-            print("⛔ Нет доступа к этому каналу")
-        except discord.HTTPException as e:
-            print(f"⚠️ Ошибка: {e}")
-    finish_text = (f"Сканирование сообщений (messages) завершено.\nВсего сообщений на сервере: "
-                   f"{count},\n - добавлено: {count_new}.")
-    await loop.run_in_executor(None, lambda: common.write_log_db('Sleep', common_bot.source, finish_text,
-                                                                 td=time.time() - t, law_id='messages',
-                        file_name=common.get_computer_name()))
+    finish_text = "Сканирование сообщений (messages) завершено.\nНовых " + stats.get_summary() + "."
+    await common_async.write_log_db('Sleep', common_bot.source, finish_text,
+                                    td=time.time() - t, law_id='messages',
+                                    file_name=common.get_computer_name())
 
+    await common_async.close_session()
     await bot.close()
 
 # Токен бота в config.py
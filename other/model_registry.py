@@ -0,0 +1,211 @@
+"""
+Общий для процесса реестр моделей Whisper и transformers (youtube_sentiment_analyzer).
+
+Модель загружается один раз при первом обращении (или заранее через warm_up) и дальше переиспользуется
+всеми видео и потоками процесса. Размер моделей задаётся в config, память ограничивается бюджетом
+models_memory_mb: при загрузке новой модели сверх бюджета выгружаются давно не использовавшиеся,
+а release_idle() выгружает модели, не использовавшиеся models_idle_timeout секунд.
+Библиотеки whisper и transformers импортируются только при загрузке соответствующей модели.
+"""
+import gc
+import time
+import threading
+
+import config
+
+source = "model_registry"
+
+whisper_model = getattr(config, 'youtube_whisper_model', 'base')  # tiny, base, small, medium, large
+sentiment_model = getattr(config, 'youtube_sentiment_model', 'cardiffnlp/twitter-roberta-base-sentiment-latest')
+# модель общего настроения видео (прежде - модель pipeline("sentiment-analysis") по умолчанию)
+overall_model = getattr(config, 'youtube_overall_model', 'distilbert-base-uncased-finetuned-sst-2-english')
+models_memory_mb = float(getattr(config, 'youtube_models_memory_mb', 0))  # бюджет памяти моделей, МБ (0 - без ограничения)
+models_idle_timeout = float(getattr(config, 'youtube_models_idle_timeout', 3600))  # выгрузка неиспользуемых, сек (0 - никогда)
+
+
+def load_whisper(name):
+    import whisper
+    return whisper.load_model(name)
+
+
+def load_sentiment(name):
+    from transformers import pipeline
+    return pipeline("sentiment-analysis", model=name)
+
+
+loaders = {
+    'whisper': load_whisper,
+    'sentiment': load_sentiment,
+}
+
+
+def get_model_size(model):
+    """
+    Оценка памяти модели (байт) по параметрам torch; для pipeline - по pipeline.model.
+    """
+    module = getattr(model, 'model', model)
+    try:
+        return sum(p.numel() * p.element_size() for p in module.parameters())
+    except Exception:
+        return 0
+
+
+class ModelEntry:
+    __slots__ = ('model', 'size', 'used_at', 'load_time', 'lock')
+
+    def __init__(self):
+        self.model = None
+        self.size = 0
+        self.used_at = 0
+        self.load_time = 0
+        self.lock = threading.Lock()  # одна загрузка модели при одновременных обращениях из нескольких потоков
+
+
+class ModelRegistry:
+    """
+    Ленивая загрузка и кэширование моделей по ключу (вид, имя).
+
+    :param memory_mb: Бюджет памяти загруженных моделей, МБ (0 - без ограничения).
+    :param idle_timeout: Через сколько секунд без обращений модель выгружается release_idle() (0 - никогда).
+    """
+
+    def __init__(self, memory_mb=None, idle_timeout=None):
+        self.memory = (models_memory_mb if memory_mb is None else memory_mb) * 1024 * 1024
+        self.idle_timeout = models_idle_timeout if idle_timeout is None else idle_timeout
+        self.entries = {}  # (вид, имя) -> ModelEntry
+        self.lock = threading.Lock()
+        self.monitor = None
+        self.count_loads = 0
+        self.count_hits = 0
+        self.count_unloads = 0
+
+    def get(self, kind, name):
+        """
+        Возвращает модель, при необходимости загружая её.
+
+        :param kind: Вид модели: 'whisper' или 'sentiment'.
+        :param name: Имя (размер) модели.
+        """
+        key = (kind, name)
+        with self.lock:
+            entry = self.entries.setdefault(key, ModelEntry())
+        with entry.lock:
+            if entry.model is None:
+                t = time.time()
+                entry.model = loaders[kind](name)
+                entry.size = get_model_size(entry.model)
+                entry.load_time = time.time() - t
+                self.count_loads += 1
+                print(time.ctime(), f'{source}: загружена модель {kind} {name} '
+                                    f'({entry.size / 1024 / 1024:.0f} МБ, {entry.load_time:.1f} сек)', flush=True)
+                entry.used_at = time.monotonic()
+                self._fit_budget(key)
+            else:
+                self.count_hits += 1
+                entry.used_at = time.monotonic()
+            return entry.model
+
+    def warm_up(self, kinds=None):
+        """
+        Заранее загружает модели, нужные анализатору (при старте потока).
+
+        :param kinds: Список (вид, имя); по умолчанию - модели из config.
+        """
+        for kind, name in kinds or get_default_models():
+            self.get(kind, name)
+
+    def start(self):
+        """
+        Запускает фоновый поток, выгружающий неиспользуемые модели (в т.ч. пока поток анализатора ждёт
+        следующего запуска).
+        """
+        if self.monitor is None and self.idle_timeout:
+            self.monitor = threading.Thread(target=self._run, name=source, daemon=True)
+            self.monitor.start()
+        return self
+
+    def release_idle(self, timeout=None):
+        """
+        Выгружает модели, не использовавшиеся timeout секунд (по умолчанию idle_timeout).
+        """
+        timeout = self.idle_timeout if timeout is None else timeout
+        if not timeout:
+            return 0
+        now = time.monotonic()
+        return self._unload([key for key, entry in list(self.entries.items())
+                             if entry.model is not None and now - entry.used_at >= timeout])
+
+    def clear(self):
+        return self._unload(list(self.entries))
+
+    def get_memory(self):
+        return sum(entry.size for entry in self.entries.values() if entry.model is not None)
+
+    def get_stats(self):
+        loaded = [f'{kind} {name}' for (kind, name), entry in self.entries.items() if entry.model is not None]
+        return (f'загрузок: {self.count_loads}, повторных обращений: {self.count_hits}, '
+                f'выгрузок: {self.count_unloads}, загружены: {", ".join(loaded) or "-"} '
+                f'({self.get_memory() / 1024 / 1024:.0f} МБ)')
+
+    def _run(self):
+        while True:
+            time.sleep(max(1, self.idle_timeout / 4))
+            try:
+                self.release_idle()
+            except Exception as er:
+                print(time.ctime(), f'{source}: Exception {er}', flush=True)
+
+    def _fit_budget(self, keep):
+        """
+        Выгружает давно не использовавшиеся модели, пока загруженные не уложатся в бюджет памяти.
+        """
+        if not self.memory:
+            return
+        candidates = sorted((entry.used_at, key) for key, entry in list(self.entries.items())
+                            if key != keep and entry.model is not None)
+        unload = []
+        memory = self.get_memory()
+        for _, key in candidates:
+            if memory <= self.memory:
+                break
+            memory -= self.entries[key].size
+            unload.append(key)
+        self._unload(unload)
+
+    def _unload(self, keys):
+        count = 0
+        for key in keys:
+            entry = self.entries[key]
+            if not entry.lock.acquire(blocking=False):
+                continue  # модель сейчас загружается
+            try:
+                if entry.model is not None:
+                    entry.model = None
+                    entry.size = 0
+                    count += 1
+                    print(time.ctime(), f'{source}: выгружена модель {key[0]} {key[1]}', flush=True)
+            finally:
+                entry.lock.release()
+        if count:
+            self.count_unloads += count
+            gc.collect()
+        return count
+
+
+def get_default_models():
+    return [('whisper', whisper_model), ('sentiment', sentiment_model), ('sentiment', overall_model)]
+
+
+registry = ModelRegistry()
+
+
+def get_whisper(name=None):
+    return registry.get('whisper', name or whisper_model)
+
+
+def get_sentiment(name=None):
+    return registry.get('sentiment', name or sentiment_model)
+
+
+def get_overall_sentiment(name=None):
+    return registry.get('sentiment', name or overall_model)
@@ -0,0 +1,151 @@
+"""
+Пакетный анализ настроения (youtube_sentiment_analyzer).
+
+Упоминания продукта всех видео пакета собираются в один список и прогоняются через модель пакетами
+по sentiment_batch_size строк (токенизация с дополнением до длины самой длинной строки пакета),
+а не по одной строке. Общее настроение видео считается по всей расшифровке: текст режется на окна
+по длине модели (с перекрытием), окна оцениваются пакетами, вероятности меток усредняются с весом
+по количеству токенов окна (режим 'chunks'); прежний режим 'head' оценивает только первые 512 символов.
+"""
+import time
+
+import config
+import model_registry
+
+source = "sentiment_batch"
+
+sentiment_batch_size = int(getattr(config, 'youtube_sentiment_batch_size', 32))  # строк в одном прогоне модели
+sentiment_threads = int(getattr(config, 'youtube_sentiment_threads', 0))  # потоков torch (0 - по умолчанию torch)
+overall_mode = getattr(config, 'youtube_overall_mode', 'chunks')  # 'chunks' - вся расшифровка, 'head' - первые 512 символов
+overall_window = int(getattr(config, 'youtube_overall_window', 510))  # токенов в окне (без служебных)
+overall_stride = int(getattr(config, 'youtube_overall_stride', 64))  # токенов перекрытия соседних окон
+
+threads_set = False
+
+
+def set_threads(count=None):
+    """
+    Устанавливает количество потоков torch для инференса (один раз на процесс).
+    """
+    global threads_set
+    count = sentiment_threads if count is None else count
+    if threads_set or not count:
+        return
+    import torch
+    torch.set_num_threads(count)
+    threads_set = True
+
+
+def find_mentions(text, product_name):
+    """
+    Предложения текста, в которых упоминается продукт.
+    """
+    product = product_name.lower()
+    return [sentence.strip() for sentence in text.split('.') if product in sentence.lower() and sentence.strip()]
+
+
+def classify(texts, analyzer=None, batch_size=None):
+    """
+    Оценивает список строк пакетами.
+
+    :param texts: Строки для оценки.
+    :param analyzer: pipeline("sentiment-analysis"); по умолчанию - модель упоминаний из model_registry.
+    :return: Список {"label", "score"} в порядке texts.
+    """
+    if not texts:
+        return []
+    set_threads()
+    analyzer = analyzer or model_registry.get_sentiment()
+    # строки близкой длины в одном пакете - меньше дополнения; результат возвращается в исходном порядке
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    answers = analyzer([texts[i] for i in order], batch_size=batch_size or sentiment_batch_size,
+                       truncation=True)
+    result = [None] * len(texts)
+    for i, answer in zip(order, answers):
+        result[i] = answer
+    return result
+
+
+def analyze_mentions(videos, product_name="Urban Heat", batch_size=None):
+    """
+    Настроение упоминаний продукта сразу в нескольких расшифровках (одним пакетным прогоном).
+
+    :param videos: Список расшифровок.
+    :return: Список по видео: список {"text", "sentiment", "score"} (пустой, если упоминаний нет).
+    """
+    mentions = [find_mentions(text, product_name) for text in videos]
+    answers = iter(classify([mention for items in mentions for mention in items], batch_size=batch_size))
+    result = []
+    for items in mentions:
+        sentiments = []
+        for mention in items:
+            answer = next(answers)
+            sentiments.append({'text': mention, 'sentiment': answer['label'], 'score': answer['score']})
+        result.append(sentiments)
+    return result
+
+
+def get_windows(text, tokenizer, window=None, stride=None):
+    """
+    Режет текст на окна по window токенов с перекрытием stride.
+
+    :return: Список (текст окна, количество токенов).
+    """
+    window = min(window or overall_window, (tokenizer.model_max_length or 512) - 2)
+    stride = min(overall_stride if stride is None else stride, window // 2)
+    ids = tokenizer(text, add_special_tokens=False)['input_ids']
+    windows = []
+    start = 0
+    while start < len(ids):
+        chunk = ids[start:start + window]
+        windows.append((tokenizer.decode(chunk), len(chunk)))
+        if start + window >= len(ids):
+            break
+        start += window - stride
+    return windows
+
+
+def analyze_overall(transcript, analyzer=None, mode=None, batch_size=None):
+    """
+    Общее настроение расшифровки.
+
+    :param mode: 'chunks' - взвешенное среднее вероятностей меток по окнам всего текста,
+                 'head' - оценка первых 512 символов.
+    :return: {"label", "score", "windows"}.
+    """
+    analyzer = analyzer or model_registry.get_overall_sentiment()
+    windows = []
+    if (mode or overall_mode) != 'head' and transcript:
+        windows = get_windows(transcript, analyzer.tokenizer)
+    if not windows:
+        answer = analyzer(transcript[:512])[0]
+        return {'label': answer['label'], 'score': answer['score'], 'windows': 1}
+    set_threads()
+    answers = analyzer([text for text, _ in windows], batch_size=batch_size or sentiment_batch_size,
+                       truncation=True, top_k=None)
+    totals = {}
+    weight = 0
+    for (_, count), scores in zip(windows, answers):
+        weight += count
+        for answer in scores:
+            totals[answer['label']] = totals.get(answer['label'], 0) + answer['score'] * count
+    label = max(totals, key=totals.get)
+    return {'label': label, 'score': totals[label] / weight, 'windows': len(windows)}
+
+
+def measure(texts, analyzer=None, batch_size=None):
+    """
+    Пропускная способность модели на списке строк.
+
+    :return: (строк в секунду поштучно, строк в секунду пакетами).
+    """
+    analyzer = analyzer or model_registry.get_sentiment()
+    analyzer(texts[0])  # прогрев
+    t = time.perf_counter()
+    for text in texts:
+        analyzer(text)
+    single = len(texts) / (time.perf_counter() - t)
+    t = time.perf_counter()
+    classify(texts, analyzer, batch_size)
+    batched = len(texts) / (time.perf_counter() - t)
+    return single, batched
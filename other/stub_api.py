@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Локальная заглушка REST API (config.URL) для бенчмарков и офлайн-проверок.
+
+Отвечает на те же пути, что и настоящий сервис:
+ - POST v1/login      -> {"accessToken": ..., "lang": ...}
+ - GET  v2/select/... -> строки server.tables[таблица] (id>N в where и limit) или []
+ - PUT  v2/entity     -> [{"id": N}, ...] (по id на каждую строку "values"; строка с "fail" в values -> 400);
+                        параметры принятых запросов сохраняются в server.entities
+ - PUT  v2/execute    -> []
+Поддерживает HTTP/1.1 keep-alive и считает запросы и принятые TCP-соединения.
+"""
+
+import re
+import json
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class StubApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, как у настоящего API
+    disable_nagle_algorithm = True  # иначе keep-alive ответы ждут delayed ACK (~40 мс)
+
+    def _reply(self, body, status=200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        server = self.server
+        rows = 1
+        params = None
+        if 'v2/entity' in self.path and body:
+            params = json.loads(json.loads(body).get('params') or '{}')
+            values = params.get('values')
+            if isinstance(values, list):
+                rows = len(values)
+                if any(value.get('fail') for value in values):
+                    with server.lock:
+                        server.count_requests += 1
+                    self._reply({"error": "bad row"}, 400)
+                    return
+        with server.lock:
+            server.count_requests += 1
+            next_id = server.next_id + 1
+            server.next_id += rows
+            if params is not None:
+                server.entities.append(params)
+        if server.delay:
+            server.delay_event.wait(server.delay)
+        if 'v1/login' in self.path:
+            with server.lock:
+                server.count_login += 1
+            self._reply({"accessToken": "stub-token-%d" % next_id, "lang": "ru"})
+        elif 'v2/entity' in self.path:
+            self._reply([{"id": next_id + i} for i in range(rows)])
+        elif 'v2/select' in self.path:
+            self._reply(self._select())
+        else:
+            self._reply([])
+
+    def _select(self):
+        """
+        Строки server.tables[таблица] с учётом id>N в where и limit (прочие условия не проверяются).
+        """
+        url = urlparse(self.path)
+        table = url.path.rstrip('/').split('/')[-1]
+        query = parse_qs(url.query)
+        rows = self.server.tables.get(table, [])
+        last_id = re.search(r'id>(\d+)', query.get('where', [''])[0])
+        if last_id:
+            rows = [row for row in rows if row['id'] > int(last_id.group(1))]
+        if 'limit' in query:
+            rows = rows[:int(query['limit'][0])]
+        return rows
+
+    do_GET = _handle
+    do_POST = _handle
+    do_PUT = _handle
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.count_connections += 1
+
+    def log_message(self, format, *args):
+        pass  # Отключаем логи HTTP запросов
+
+
+class StubApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, delay=0.0):
+        super().__init__(('127.0.0.1', port), StubApiHandler)
+        self.lock = threading.Lock()
+        self.delay = delay  # искусственная задержка ответа, сек
+        self.delay_event = threading.Event()
+        self.count_requests = 0
+        self.count_connections = 0
+        self.count_login = 0
+        self.next_id = 0
+        self.tables = {}  # таблица -> список строк (по возрастанию id) для v2/select
+        self.entities = []  # параметры принятых запросов v2/entity
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+    def reset_counters(self):
+        with self.lock:
+            self.count_requests = 0
+            self.count_connections = 0
+            self.count_login = 0
+
+
+def start_stub_server(port=0, delay=0.0):
+    """
+    Запускает заглушку API в фоновом потоке.
+
+    :param port: Порт (0 - выбрать свободный).
+    :param delay: Искусственная задержка ответа в секундах.
+    :return: Запущенный StubApiServer (адрес в server.url).
+    """
+    server = StubApiServer(port, delay)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
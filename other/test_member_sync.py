@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Проверка синхронизации участников по кэшу бота (member_sync.GatewayMemberSync) через заглушку API (stub_api).
+config - config_docker.py, как в Docker образе.
+"""
+
+import os
+import sys
+import types
+import asyncio
+import datetime
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if root not in sys.path:
+    sys.path.insert(0, root)
+if 'config' not in sys.modules:
+    import config_docker
+    sys.modules['config'] = config_docker
+
+import config
+import common
+import common_bot
+import common_async
+import member_sync
+from stub_api import start_stub_server
+
+
+def make_member(id):
+    return types.SimpleNamespace(id=id, name=f'user{id}', display_name=f'user{id}', bot=False,
+                                 joined_at=datetime.datetime(2026, 1, 1))
+
+
+def make_bot(*guilds):
+    return types.SimpleNamespace(guilds=[types.SimpleNamespace(members=members, chunked=True) for members in guilds])
+
+
+def run(coro):
+    """Выполняет корутину и закрывает общую сессию aiohttp её event loop."""
+    async def main():
+        try:
+            return await coro
+        finally:
+            await common_async.close_session()
+    return asyncio.run(main())
+
+
+def start_server(member_ids):
+    server = start_stub_server()
+    server.tables = {'nsi_discord_members': [
+        {'id': i + 1, 'member_id': str(member_id), 'sh_name': f'user{member_id}', 'display_name': f'user{member_id}',
+         'remove': False} for i, member_id in enumerate(member_ids)]}
+    config.URL = server.url
+    common.log_async = False
+    common.token_manager.store('', True, 'stub')
+    common_bot.member_ids.clear()
+    return server
+
+
+def test_events_deferred_during_startup():
+    start_server([5, 8])
+    bot = make_bot([make_member(5), make_member(6)])
+    calls = []
+
+    async def handler(member):
+        calls.append(member.id)
+
+    async def main():
+        sync = member_sync.GatewayMemberSync(bot, interval=3600)
+        # события до завершения стартовой сверки: 6 - в кэше (добавит сверка), 7 - нет в кэше,
+        # 8 - ушёл (пометит сверка), 5 - ушёл после чтения кэша сверкой
+        assert sync.defer('join', handler, make_member(6)) and sync.defer('join', handler, make_member(7))
+        assert sync.defer('remove', handler, make_member(8)) and sync.defer('remove', handler, make_member(5))
+        sync.start()
+        while not sync.started:
+            await asyncio.sleep(0.01)
+        assert not sync.defer('join', handler, make_member(9))
+        await sync.stop()
+
+    run(main())
+    assert calls == [7, 5]
+
+
+def test_check_falls_back_to_db_rows():
+    # заглушка не вычисляет выражения columns (отдаёт строки таблицы) - контрольная сумма по строкам БД
+    start_server([5, 6, 7])
+    members = [make_member(5), make_member(6), make_member(7)]
+    sync = member_sync.GatewayMemberSync(make_bot(members, members[:1]))  # 5 - на двух серверах
+    assert run(sync.check()) is True
+    assert not sync.aggregate
+    sync.bot.guilds[0].members = members[:2]
+    assert run(sync.check()) is False
+    assert (sync.count_checks, sync.count_drifts) == (2, 1)
+
+
+def test_check_with_db_checksum():
+    server = start_server([])
+    count, md5 = member_sync.get_checksum({5, 6})
+    server.tables['nsi_discord_members'] = [{'count': count, 'md5': md5}]
+    sync = member_sync.GatewayMemberSync(make_bot([make_member(5), make_member(6)], [make_member(6)]))
+    assert run(sync.check()) is True
+    assert sync.aggregate
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Проверка записи сообщений бота (common_bot.insert_message / insert_messages) через заглушку API (stub_api).
+config - config_docker.py, как в Docker образе.
+"""
+
+import os
+import sys
+import types
+import asyncio
+import datetime
+
+import discord
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if root not in sys.path:
+    sys.path.insert(0, root)
+if 'config' not in sys.modules:
+    import config_docker
+    sys.modules['config'] = config_docker
+
+import config
+import common
+import common_bot
+import common_async
+import write_behind
+from stub_api import start_stub_server
+
+
+def make_message(id, content='', attachments=(), mentions=()):
+    """Сообщение с полями, которые читает common_bot.get_message_row."""
+    return types.SimpleNamespace(
+        id=id, content=content, created_at=datetime.datetime(2026, 1, 1), edited_at=None, reference=None,
+        reactions=[], author=types.SimpleNamespace(id=11), channel=types.SimpleNamespace(id=22),
+        attachments=[types.SimpleNamespace(url=url) for url in attachments],
+        mentions=[types.SimpleNamespace(name=name) for name in mentions])
+
+
+def run(coro):
+    """Выполняет корутину и закрывает общую сессию aiohttp её event loop."""
+    async def main():
+        try:
+            return await coro
+        finally:
+            await common_async.close_session()
+    return asyncio.run(main())
+
+
+def start_server():
+    server = start_stub_server()
+    server.tables = {'nsi_discord_members': [{'id': 7}], 'nsi_discord_channels': [{'id': 3}]}
+    config.URL = server.url
+    common.log_async = False
+    common_bot.member_ids.clear()
+    common_bot.channel_ids.clear()
+    return server
+
+
+def test_insert_message():
+    server = start_server()
+    count = run(common_bot.insert_message(make_message(101, 'hello', attachments=['http://a/1.png']), token='stub'))
+    assert count == 1
+    params = server.entities[-1]
+    assert params['object_code'] == 'discord_messages'
+    assert params['values']['message_id'] == '101'
+    assert params['values']['author'] == 7 and params['values']['channel'] == 3
+    assert params['datas'] == 'hello~~~http://a/1.png'
+
+
+def test_insert_messages():
+    server = start_server()
+    messages = [make_message(200 + i, f'text {i}') for i in range(5)]
+    count = run(common_bot.insert_messages(messages, token='stub'))
+    assert count == 5
+    params = server.entities[-1]
+    assert [values['message_id'] for values in params['values']] == [str(200 + i) for i in range(5)]
+    assert params['datas'].split('~~~') == [f'text {i}' for i in range(5)]
+
+
+def test_put_entities_rejected_row():
+    server = start_server()
+    rows = [{'n': i, 'fail': i == 5} for i in range(8)]
+    result = common.put_entities('discord_messages', rows, token_user='stub')
+    assert result.errors[5] and result.rejected[5]
+    assert [id is None for id in result.ids] == [i == 5 for i in range(8)]
+    result = run(common_async.put_entities('discord_messages', rows, token_user='stub'))
+    assert result.count_errors == 1 and result.rejected[5]
+    assert sum(len(params['values']) for params in server.entities) == 14
+
+
+def test_write_behind_rejected_row():
+    server = start_server()
+    common.token_manager.store('', True, 'stub')
+
+    async def main():
+        writer = write_behind.WriteBehindQueue(interval=0.01, retries=2).start()
+        for i in range(6):
+            await writer.put('discord_messages', {'n': i, 'fail': i == 2}, f'text {i}')
+        await writer.drain()
+        return writer
+
+    writer = run(main())
+    assert (writer.count_rows, writer.count_failed, writer.count_retries) == (5, 1, 0)
+    written = [values['n'] for params in server.entities for values in params['values']]
+    assert sorted(written) == [0, 1, 3, 4, 5]
+
+
+def test_insert_messages_with_separator():
+    server = start_server()
+    messages = [make_message(301, 'a ~~~~ b', attachments=['http://a/~~~.png']),
+                make_message(302, '~~strike~~'), make_message(303, '~~old~~', mentions=['~~~user~~~'])]
+    assert run(common_bot.insert_messages(messages, token='stub')) == 3
+    params = server.entities[-1]
+    placeholders = sum(value == '%s' for values in params['values'] for value in values.values())
+    fields = params['datas'].split('~~~')
+    assert len(fields) == placeholders == 5
+    assert [field.strip() for field in fields] == ['a ~~ b', 'http://a/~~.png', '~~strike~~', '~~old~~', '~~user~~']
+
+
+def test_message_index_checks_newer_messages():
+    server = start_server()
+    old = discord.utils.time_snowflake(datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc))
+    server.tables['nsi_discord_messages'] = [{'id': 1, 'message_id': str(old)}]
+    assert run(common_bot.load_message_index(capacity=1000)) == 1
+    requests = server.count_requests
+    assert run(common_bot.exist_messages([old + 1])) == set()
+    assert server.count_requests == requests  # старше загрузки фильтра и нет в нём - без запроса
+    # записано работающим ботом после загрузки фильтра - проверяется запросом
+    new = discord.utils.time_snowflake(datetime.datetime.now(datetime.timezone.utc)) + 1
+    server.tables['nsi_discord_messages'].append({'id': 2, 'message_id': str(new)})
+    assert str(new) in run(common_bot.exist_messages([new]))
+    assert server.count_requests == requests + 1
+    common_bot.message_index = None
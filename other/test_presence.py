@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Проверка агрегации присутствия (presence.PresenceAggregator) без БД: строки перехватываются вместо common_bot.writer.
+config - config_docker.py, как в Docker образе.
+"""
+
+import os
+import sys
+import types
+import asyncio
+import datetime
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if root not in sys.path:
+    sys.path.insert(0, root)
+if 'config' not in sys.modules:
+    import config_docker
+    sys.modules['config'] = config_docker
+
+import common_bot
+import presence
+
+
+class Writer:
+    def __init__(self):
+        self.rows = []
+
+    async def put(self, object_code, values, datas=''):
+        self.rows.append((object_code, values))
+
+
+def make_member(id, status):
+    return types.SimpleNamespace(id=id, display_name=f'user{id}', status=types.SimpleNamespace(value=status))
+
+
+def restart(mode):
+    """Остановка и запуск бота с участниками online (1), idle (2) и ушедшим в offline перед остановкой (3)."""
+    writer = common_bot.writer = Writer()
+    t = datetime.datetime(2026, 1, 1, 10)
+
+    async def main():
+        aggregator = presence.PresenceAggregator(mode=mode, debounce=60)
+        await aggregator.seed([make_member(1, 'online'), make_member(2, 'idle'), make_member(3, 'online')])
+        await aggregator.update(make_member(3, 'offline'), t)
+        await aggregator.close()
+        aggregator = presence.PresenceAggregator(mode=mode, debounce=60)
+        await aggregator.seed([make_member(1, 'online'), make_member(2, 'idle'), make_member(3, 'offline')])
+        return aggregator
+
+    try:
+        aggregator = asyncio.run(main())
+    finally:
+        common_bot.writer = None
+    return aggregator, writer.rows
+
+
+def test_status_restart_writes_no_flaps():
+    aggregator, rows = restart('status')
+    assert [(values['member_id'], values['status']) for _, values in rows] == [('3', 'offline')]
+    assert sorted(aggregator.sessions) == ['1', '2']
+
+
+def test_sessions_restart_closes_sessions():
+    _, rows = restart('sessions')
+    assert sorted(values['member_id'] for object_code, values in rows
+                  if object_code == 'discord_his_sessions_members') == ['1', '2', '3']
@@ -0,0 +1,193 @@
+"""
+Кэш расшифровок видео (youtube_sentiment_analyzer), адресуемый по содержимому.
+
+Расшифровка хранится под ключом (хэш аудио, модель Whisper): повторная обработка видео (need_reload),
+дубликаты одного видео под разными ссылками и пересчёт настроения после смены модели анализа
+не требуют загрузки и повторной расшифровки. Кроме расшифровки хранится указатель
+video_id -> (хэш аудио, модель), по которому кэш проверяется ещё до загрузки аудио.
+Порядок поиска: локальный каталог cache_dir, затем bucket (cloud.check_file_exists_in_bucket / load_file),
+затем - расшифровка. Ранее сохранённые в bucket transcript_{id}.txt (модель base) тоже используются.
+
+Имена в bucket (cloud сохраняет только .txt без каталогов):
+    tcache_{хэш аудио}_{модель}.txt        - текст расшифровки;
+    tcache_video_{video_id}_{модель}.txt   - указатель (JSON).
+"""
+import os
+import json
+import time
+import hashlib
+import datetime
+import threading
+
+import config
+import common
+import model_registry
+
+source = "transcript_cache"
+
+cache_enabled = getattr(config, 'youtube_cache', True)
+cache_dir = getattr(config, 'youtube_cache_dir', os.path.join(common.current_path, 'transcript_cache'))
+cache_bucket = getattr(config, 'youtube_cache_bucket', True)  # искать и сохранять расшифровки и в bucket
+cache_version = str(getattr(config, 'youtube_cache_version', '1'))  # изменить, чтобы не использовать прежние расшифровки
+cache_legacy = getattr(config, 'youtube_cache_legacy', True)  # использовать transcript_{id}.txt, сохранённые раньше
+legacy_model = 'base'  # модель, которой сделаны прежние transcript_{id}.txt
+
+hash_block = 1 << 20
+
+
+def get_file_hash(file_name):
+    """
+    Хэш содержимого аудио файла (sha256, 32 символа).
+    """
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(hash_block), b''):
+            digest.update(block)
+    return digest.hexdigest()[:32]
+
+
+class TranscriptCache:
+    """
+    Кэш расшифровок: локальный каталог и bucket.
+
+    :param path: Локальный каталог кэша.
+    :param model: Имя модели Whisper (по умолчанию - из model_registry).
+    :param use_bucket: Искать и сохранять расшифровки в bucket.
+    """
+
+    def __init__(self, path=None, model=None, use_bucket=None):
+        self.path = path or cache_dir
+        self.model = model or model_registry.whisper_model
+        self.use_bucket = cache_bucket if use_bucket is None else use_bucket
+        self.lock = threading.Lock()
+        self.count_local = 0
+        self.count_bucket = 0
+        self.count_legacy = 0
+        self.count_miss = 0
+        self.count_stored = 0
+
+    def get_model_key(self):
+        return f'{self.model}-v{cache_version}'
+
+    def get_text_name(self, audio_hash):
+        return f'tcache_{audio_hash}_{self.get_model_key()}.txt'
+
+    def get_pointer_name(self, video_id):
+        return f'tcache_video_{video_id}_{self.get_model_key()}.txt'
+
+    def lookup(self, video_id):
+        """
+        Расшифровка видео по указателю video_id (до загрузки аудио).
+
+        :return: (текст, хэш аудио, где найдено: 'local', 'bucket', 'legacy') или (None, None, None).
+        """
+        pointer = self._read(self.get_pointer_name(video_id))
+        if pointer is not None:
+            try:
+                audio_hash = json.loads(pointer[0])['audio']
+            except Exception as er:
+                print(time.ctime(), f'{source}: ошибка указателя видео {video_id}: {er}', flush=True)
+            else:
+                text, where = self._read(self.get_text_name(audio_hash)) or (None, None)
+                if text is not None:
+                    self._count(where)
+                    return text, audio_hash, where
+        if cache_legacy and self.model == legacy_model and self.use_bucket:
+            for name in (f'transcript_{video_id}.txt', f'no_transcript_{video_id}.txt'):
+                text = self._read_bucket(name)
+                if text is not None:
+                    self._count('legacy')
+                    return text, None, 'legacy'
+        self._count(None)
+        return None, None, None
+
+    def lookup_audio(self, audio_hash):
+        """
+        Расшифровка по хэшу аудио (аудио уже загружено, но такое же аудио уже расшифровывалось).
+
+        :return: (текст, где найдено) или (None, None).
+        """
+        found = self._read(self.get_text_name(audio_hash))
+        if found is None:
+            return None, None
+        self._count(found[1])
+        return found
+
+    def store(self, video_id, audio_hash, text, pointer_only=False):
+        """
+        Сохраняет расшифровку и указатель video_id локально и в bucket.
+
+        :param pointer_only: Расшифровка этого аудио уже в кэше - сохранить только указатель.
+        """
+        if audio_hash is None:
+            # хэш аудио неизвестен (прежняя расшифровка из bucket) - ключом служит хэш текста
+            audio_hash = 'text' + hashlib.sha256(text.encode('utf-8')).hexdigest()[:28]
+        pointer = json.dumps({"video_id": video_id, "audio": audio_hash, "model": self.get_model_key(),
+                              "size": len(text), "at": datetime.datetime.utcnow().isoformat()})
+        if not pointer_only:
+            self._write(self.get_text_name(audio_hash), text)
+        self._write(self.get_pointer_name(video_id), pointer)
+        with self.lock:
+            self.count_stored += 1
+
+    def get_stats(self):
+        return (f'локально: {self.count_local}, bucket: {self.count_bucket}, прежние: {self.count_legacy}, '
+                f'промахов: {self.count_miss}, сохранено: {self.count_stored}')
+
+    def _count(self, where):
+        with self.lock:
+            if where == 'local':
+                self.count_local += 1
+            elif where == 'bucket':
+                self.count_bucket += 1
+            elif where == 'legacy':
+                self.count_legacy += 1
+            else:
+                self.count_miss += 1
+
+    def _read(self, name):
+        """
+        :return: (содержимое, 'local' или 'bucket') или None. Найденное в bucket сохраняется локально.
+        """
+        try:
+            with open(os.path.join(self.path, name), 'r', encoding='utf-8') as f:
+                return f.read(), 'local'
+        except FileNotFoundError:
+            pass
+        text = self._read_bucket(name)
+        if text is None:
+            return None
+        self._write_local(name, text)
+        return text, 'bucket'
+
+    def _read_bucket(self, name):
+        if not self.use_bucket:
+            return None
+        import cloud
+        if not cloud.check_file_exists_in_bucket(name):
+            return None
+        text = cloud.load_file(name)
+        return text if text else None
+
+    def _write(self, name, text):
+        self._write_local(name, text)
+        if self.use_bucket:
+            import cloud
+            cloud.save_file_bucket(name, text)
+
+    def _write_local(self, name, text):
+        """
+        Записывает файл атомарно (через временный файл).
+        """
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            file_name = os.path.join(self.path, name)
+            tmp_file = f'{file_name}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmp_file, file_name)
+        except Exception as er:
+            print(time.ctime(), f'{source}: ошибка записи {name}: {er}', flush=True)
+
+
+cache = TranscriptCache()
@@ -0,0 +1,216 @@
+"""
+Конвейер обработки видео по этапам (youtube_sentiment_analyzer): загрузка -> расшифровка -> анализ -> запись.
+
+Каждый этап обслуживается своими рабочими потоками; между этапами - ограниченные очереди
+(при заполнении очереди предыдущий этап ждёт, поэтому загруженные, но не расшифрованные файлы не копятся).
+Этапы с processes > 0 выполняют функцию в пуле процессов (Whisper и модели настроения не делят GIL
+и загружаются в каждом процессе один раз); остальные - в потоках (сетевой ввод-вывод). Процессы пула
+запускаются методом spawn: функция этапа и инициализатор импортируются в процессе из своего модуля.
+Пока один этап ждёт сеть, другой занят вычислениями, поэтому время обработки списка видео
+приближается ко времени самого медленного этапа, а не к сумме этапов.
+
+Задание - словарь; функция этапа возвращает словарь значений, которые добавляются в задание.
+Ошибка в задании не останавливает конвейер: задание с ключами "error" и "error_stage" пропускает
+оставшиеся этапы и передаётся только этапам с always=True (запись результата/ошибки).
+"""
+import time
+import queue
+import threading
+import traceback
+import multiprocessing
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+
+source = "video_pipeline"
+
+stop = object()  # признак окончания заданий в очереди
+
+
+class Stage:
+    """
+    Этап конвейера.
+
+    :param name: Имя этапа (для статистики).
+    :param func: Функция задания: func(job) -> dict значений задания. Для этапа в пуле процессов -
+                 функция уровня модуля (передаётся в процесс по имени), задание передаётся копией.
+    :param workers: Количество рабочих потоков этапа.
+    :param processes: Выполнять func в пуле из processes процессов (0 - в рабочих потоках).
+    :param initializer: Функция инициализации процесса пула (загрузка моделей).
+    :param always: Выполнять этап и для заданий с ошибкой.
+    :param skip: Функция skip(job) -> True, если этап для задания не нужен (например, расшифровка найдена в кэше).
+    """
+
+    def __init__(self, name, func, workers=1, processes=0, initializer=None, always=False, skip=None):
+        self.name = name
+        self.func = func
+        self.processes = processes
+        self.workers = processes or workers
+        self.initializer = initializer
+        self.always = always
+        self.skip = skip
+        self.executor = None
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.count_errors = 0
+        self.count_skipped = 0
+        self.busy = 0  # суммарное время выполнения заданий, сек
+        self.blocked = 0  # суммарное ожидание места в очереди следующего этапа, сек
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                # spawn, а не fork: пул создаётся из рабочего потока, когда уже работают потоки этапов,
+                # common.log_writer и мониторинг моделей - копия процесса получила бы их захваченные
+                # блокировки и остановленный поток лога
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    self.processes, mp_context=multiprocessing.get_context('spawn'), initializer=self.initializer)
+            return self.executor
+
+    def call(self, job, local=False):
+        if local or not self.processes:
+            return self.func(job)
+        try:
+            return self.get_executor().submit(self.func, job).result()
+        except BrokenProcessPool:
+            # процесс пула аварийно завершился (например, нехватка памяти) - следующие задания получат новый пул
+            with self.lock:
+                if self.executor is not None:
+                    self.executor.shutdown(wait=False)
+                    self.executor = None
+            raise
+
+    def process(self, job, local=False):
+        """
+        Выполняет этап для задания; при local функция этапа в пуле процессов выполняется в текущем потоке.
+        """
+        if 'error' in job and not self.always:
+            return
+        if self.skip is not None and self.skip(job):
+            with self.lock:
+                self.count_skipped += 1
+            return
+        t = time.time()
+        try:
+            values = self.call(job, local)
+            if values:
+                job.update(values)
+        except Exception as er:
+            with self.lock:
+                self.count_errors += 1
+            if 'error' not in job:
+                job['error'] = f'{type(er).__name__}: {er}' if isinstance(er, BrokenProcessPool) else str(er)
+                job['error_stage'] = self.name
+            if self.always:
+                print(time.ctime(), f'{source}: {self.name}: Exception {er}\n{traceback.format_exc()}', flush=True)
+        finally:
+            with self.lock:
+                self.busy += time.time() - t
+                self.count += 1
+
+    def close(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+    def get_stats(self, wall):
+        load = self.busy / (wall * self.workers) * 100 if wall else 0
+        return (f'{self.name}: заданий {self.count}, ошибок {self.count_errors}, пропущено {self.count_skipped}, работа {self.busy:.1f} сек '
+                f'(загрузка {load:.0f}% x{self.workers}), ожидание очереди {self.blocked:.1f} сек')
+
+
+class Pipeline:
+    """
+    Конвейер из этапов с ограниченными очередями между ними.
+
+    :param stages: Список Stage в порядке выполнения.
+    :param queue_size: Размер очереди перед каждым этапом.
+    """
+
+    def __init__(self, stages, queue_size=2):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.wall = 0
+
+    def run(self, jobs, serial=False):
+        """
+        Обрабатывает задания всеми этапами.
+
+        :param jobs: Итерируемые задания (словари).
+        :param serial: Выполнять этапы последовательно в текущем потоке (без очередей и пулов процессов).
+        :return: Список обработанных заданий в порядке завершения.
+        """
+        for stage in self.stages:
+            stage.reset()
+        t = time.time()
+        if serial:
+            done = []
+            for job in jobs:
+                for stage in self.stages:
+                    stage.process(job, local=True)
+                done.append(job)
+        else:
+            done = self._run_threads(jobs)
+        self.wall = time.time() - t
+        return done
+
+    def _run_threads(self, jobs):
+        queues = [queue.Queue(self.queue_size) for _ in self.stages] + [queue.Queue()]
+        done = []
+        threads = []
+        for i, stage in enumerate(self.stages):
+            left = [stage.workers]  # рабочих потоков этапа, ещё не получивших stop
+            lock = threading.Lock()
+            for n in range(stage.workers):
+                thread = threading.Thread(target=self._worker, args=(stage, queues[i], queues[i + 1], left, lock),
+                                          name=f'{source}_{stage.name}_{n}', daemon=True)
+                thread.start()
+                threads.append(thread)
+        for job in jobs:
+            queues[0].put(job)
+        for _ in range(self.stages[0].workers):
+            queues[0].put(stop)
+        while True:
+            job = queues[-1].get()
+            if job is stop:
+                break
+            done.append(job)
+        for thread in threads:
+            thread.join()
+        return done
+
+    def _worker(self, stage, source_queue, target_queue, left, lock):
+        next_workers = self._get_next_workers(stage)
+        while True:
+            job = source_queue.get()
+            if job is stop:
+                with lock:
+                    left[0] -= 1
+                    last = left[0] == 0
+                if last:
+                    # последний поток этапа передаёт признак окончания всем потокам следующего этапа
+                    for _ in range(next_workers):
+                        target_queue.put(stop)
+                return
+            stage.process(job)
+            t = time.time()
+            target_queue.put(job)
+            with stage.lock:
+                stage.blocked += time.time() - t
+
+    def _get_next_workers(self, stage):
+        i = self.stages.index(stage)
+        return self.stages[i + 1].workers if i + 1 < len(self.stages) else 1
+
+    def close(self):
+        for stage in self.stages:
+            stage.close()
+
+    def get_stats(self):
+        lines = [stage.get_stats(self.wall) for stage in self.stages]
+        busy = sum(stage.busy for stage in self.stages)
+        lines.append(f'всего: {self.wall:.1f} сек (сумма этапов {busy:.1f} сек)')
+        return '\n'.join(lines)
@@ -0,0 +1,268 @@
+"""
+Аренда (lease) видео для пула процессов YoutubeTranscript (youtube_sentiment_analyzer --workers N).
+
+Несколько процессов (на одной или нескольких машинах) разбирают список need_reload так, чтобы одно видео
+обрабатывал только один процесс: процесс захватывает пачку видео с временем окончания аренды,
+продлевает аренду, пока обрабатывает их, и освобождает необработанные при остановке. Аренда процесса,
+который аварийно завершился, истекает, и его видео захватывает другой процесс. Если продлить аренду
+не удалось (её уже захватил другой процесс), результат видео не записывается.
+
+Хранилища аренды:
+ - DbLeaseStore - колонки lease_owner (text) и lease_until (timestamp) сущности list (nsi_list);
+   захват - один update ... where id in (select ... for update skip locked), без гонок между машинами;
+ - LocalLeaseStore - файл SQLite, для процессов одной машины, если колонок аренды в БД нет.
+"""
+import os
+import time
+import socket
+import sqlite3
+import threading
+
+import config
+import common
+
+source = "work_lease"
+
+lease_ttl = float(getattr(config, 'youtube_lease_ttl', 1800))  # срок аренды, сек (продлевается каждую треть срока)
+lease_batch = int(getattr(config, 'youtube_lease_batch', 1))  # видео в одном захвате
+lease_store = getattr(config, 'youtube_lease_store', 'db')  # 'db' - колонки аренды в nsi_list, 'local' - файл SQLite
+lease_poll = float(getattr(config, 'youtube_lease_poll', 30))  # ожидание освобождения чужой аренды, сек
+lease_file = getattr(config, 'youtube_lease_file', os.path.join(common.current_path, 'youtube_leases.sqlite'))
+
+
+def get_owner():
+    """
+    Уникальное имя процесса-арендатора: хост и pid.
+    """
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class DbLeaseStore:
+    """
+    Аренда в колонках lease_owner, lease_until таблицы nsi_list.
+    """
+
+    def __init__(self, owner=None, ttl=None, token=None):
+        self.owner = owner or get_owner()
+        self.ttl = lease_ttl if ttl is None else ttl
+        self.token = token
+
+    def _execute(self, query):
+        ans, is_ok, _ = common.send_rest('v2/execute', 'PUT', params={"script": query},
+                                         token_user=self.token or common.get_admin_token())
+        if not is_ok:
+            raise RuntimeError(f'ошибка аренды видео: {ans}')
+
+    def _select(self, where):
+        return list(common.iter_select('nsi_list', where=where, columns='id,url',
+                                       token_user=self.token or common.get_admin_token()))
+
+    def claim(self, count=None):
+        """
+        Захватывает до count свободных видео (need_reload, аренда отсутствует или истекла).
+
+        :return: Список {"id", "url"}.
+        """
+        self._execute(
+            "update {schema}.nsi_list set lease_owner='{owner}', lease_until=now() + interval '{ttl} seconds' "
+            "where id in (select id from {schema}.nsi_list where need_reload "
+            "and (lease_until is null or lease_until < now()) order by id limit {count} "
+            "for update skip locked)".format(
+                schema=config.schema_name, owner=self.owner, ttl=int(self.ttl), count=count or lease_batch))
+        return self._select(f"need_reload and lease_owner='{self.owner}'")
+
+    def has_pending(self):
+        """
+        Есть видео need_reload, арендованные другими процессами (их аренда может истечь).
+        """
+        return bool(self._select(f"need_reload and lease_owner is not null and lease_owner<>'{self.owner}'"))
+
+    def renew(self, ids):
+        """
+        Продлевает аренду видео ids.
+
+        :return: Множество id, аренда которых всё ещё принадлежит процессу.
+        """
+        if not ids:
+            return set()
+        id_list = ','.join(str(id) for id in ids)
+        self._execute(
+            "update {schema}.nsi_list set lease_until=now() + interval '{ttl} seconds' "
+            "where lease_owner='{owner}' and id in ({ids})".format(
+                schema=config.schema_name, owner=self.owner, ttl=int(self.ttl), ids=id_list))
+        return {data['id'] for data in self._select(f"lease_owner='{self.owner}' and id in ({id_list})")}
+
+    def release(self, ids, done=()):
+        """
+        Освобождает аренду (обработанные видео уже не need_reload, необработанные станут доступны другим).
+        """
+        if not ids:
+            return
+        self._execute(
+            "update {schema}.nsi_list set lease_owner=null, lease_until=null "
+            "where lease_owner='{owner}' and id in ({ids})".format(
+                schema=config.schema_name, owner=self.owner, ids=','.join(str(id) for id in ids)))
+
+
+class LocalLeaseStore:
+    """
+    Аренда в файле SQLite (процессы одной машины). Список видео читается из БД (need_reload),
+    захват, продление и освобождение выполняются транзакциями SQLite.
+    """
+
+    def __init__(self, owner=None, ttl=None, token=None, file_name=None):
+        self.owner = owner or get_owner()
+        self.ttl = lease_ttl if ttl is None else ttl
+        self.token = token
+        self.file_name = file_name or lease_file
+        self.candidates = None  # прочитанный список need_reload, перечитывается, когда захватывать из него нечего
+        db = self._connect()
+        try:
+            db.execute('create table if not exists leases '
+                       '(id text primary key, owner text, until real, done integer default 0)')
+        finally:
+            db.close()
+
+    def _connect(self):
+        db = sqlite3.connect(self.file_name, timeout=60, isolation_level=None)
+        db.execute('pragma journal_mode=wal')
+        return db
+
+    def get_candidates(self):
+        return list(common.iter_select('nsi_list', where='need_reload', columns='id,url',
+                                       token_user=self.token or common.get_admin_token()))
+
+    def claim(self, count=None, candidates=None):
+        """
+        Захватывает до count видео из списка need_reload, не арендованных другими процессами.
+
+        :param candidates: Список {"id", "url"} вместо чтения need_reload из БД.
+        """
+        if candidates is not None:
+            return self._claim(count, candidates)
+        if self.candidates is not None:
+            claimed = self._claim(count, self.candidates)
+            if claimed:
+                return claimed
+        self.candidates = self.get_candidates()
+        return self._claim(count, self.candidates)
+
+    def _claim(self, count, candidates):
+        count = count or lease_batch
+        now = time.time()
+        claimed = []
+        db = self._connect()
+        try:
+            db.execute('begin immediate')  # одна транзакция захвата на все процессы
+            # арендованные другими и недавно обработанные (строка в прочитанном списке могла устареть)
+            taken = {id for id, in db.execute('select id from leases where until > ? and (done or owner <> ?)',
+                                              (now, self.owner))}
+            for data in candidates:
+                if str(data['id']) in taken:
+                    continue
+                db.execute('insert or replace into leases (id, owner, until, done) values (?, ?, ?, 0)',
+                           (str(data['id']), self.owner, now + self.ttl))
+                claimed.append(data)
+                if len(claimed) >= count:
+                    break
+            db.execute('commit')
+        except BaseException:
+            db.execute('rollback')
+            raise
+        finally:
+            db.close()
+        return claimed
+
+    def has_pending(self):
+        ids = {str(data['id']) for data in self.candidates or []}
+        db = self._connect()
+        try:
+            leased = {id for id, in db.execute('select id from leases where until > ? and not done and owner <> ?',
+                                               (time.time(), self.owner))}
+        finally:
+            db.close()
+        return bool(ids & leased)
+
+    def renew(self, ids):
+        if not ids:
+            return set()
+        db = self._connect()
+        try:
+            db.execute('begin immediate')
+            owned = set()
+            for id in ids:
+                cursor = db.execute('update leases set until = ? where id = ? and owner = ? and not done',
+                                    (time.time() + self.ttl, str(id), self.owner))
+                if cursor.rowcount:
+                    owned.add(id)
+            db.execute('commit')
+            return owned
+        finally:
+            db.close()
+
+    def release(self, ids, done=()):
+        """
+        :param done: Обработанные видео - в течение срока аренды не захватываются снова по устаревшему
+                     списку need_reload (потом - снова доступны, если строку опять отметили need_reload).
+        """
+        db = self._connect()
+        try:
+            db.execute('begin immediate')
+            for id in ids:
+                is_done = id in done
+                db.execute('update leases set owner = null, until = ?, done = ? where id = ? and owner = ?',
+                           (time.time() + self.ttl if is_done else 0, int(is_done), str(id), self.owner))
+            db.execute('commit')
+        finally:
+            db.close()
+
+
+def get_store(owner=None, token=None):
+    if lease_store == 'local':
+        return LocalLeaseStore(owner, token=token)
+    return DbLeaseStore(owner, token=token)
+
+
+class LeaseKeeper:
+    """
+    Продлевает аренду обрабатываемых видео каждую треть срока в фоновом потоке.
+
+    :param store: Хранилище аренды.
+    :param ids: id арендованных видео.
+    """
+
+    def __init__(self, store, ids):
+        self.store = store
+        self.ids = set(ids)
+        self.lost = set()  # видео, аренду которых захватил другой процесс
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name=source, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def is_owned(self, id):
+        with self.lock:
+            return id in self.ids and id not in self.lost
+
+    def renew(self):
+        with self.lock:
+            ids = self.ids - self.lost
+        owned = self.store.renew(ids)
+        with self.lock:
+            for id in ids - owned:
+                self.lost.add(id)
+                print(time.ctime(), f'{source}: аренда видео {id} потеряна', flush=True)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.store.ttl / 3):
+            try:
+                self.renew()
+            except Exception as er:
+                print(time.ctime(), f'{source}: Exception {er}', flush=True)
@@ -1,97 +1,102 @@
 import os
+import sys
 import json
 import time
+import hashlib
+import shutil
+import tempfile
+import threading
+import multiprocessing
 
 import yt_dlp
-import whisper
-from transformers import pipeline
 import glob
 
 import config
 import common
 import  trafaret_thread
 import cloud
+import model_registry
+import sentiment_batch
+import video_pipeline
+import audio_stream
+import transcript_cache
+import work_lease
 
 
 # Добавьте эту строку в начало скрипта после импортов
 os.environ["PATH"] += os.pathsep + r"ffmpeg/bin"
 
-def transcribe_youtube_video(url):
+youtube_stream = getattr(config, 'youtube_stream', False)  # расшифровка потоком через ffmpeg, без аудио файла
+youtube_pipeline = getattr(config, 'youtube_pipeline', True)  # False - видео обрабатываются по одному, как раньше
+youtube_download_workers = int(getattr(config, 'youtube_download_workers', 2))  # потоков загрузки аудио
+youtube_transcribe_processes = int(getattr(config, 'youtube_transcribe_processes', 1))  # процессов Whisper
+youtube_analyze_processes = int(getattr(config, 'youtube_analyze_processes', 1))  # процессов анализа настроения
+youtube_upload_workers = int(getattr(config, 'youtube_upload_workers', 2))  # потоков записи в облако и БД
+youtube_pipeline_queue = int(getattr(config, 'youtube_pipeline_queue', 2))  # заданий в очереди перед этапом
+
+
+def download_audio(url, workdir):
+    """
+    Загружает аудио видео в каталог workdir (у каждого задания свой каталог).
+
+    :return: Путь к аудио файлу (локальный аудио файл вместо ссылки возвращается как есть).
+    """
+    if audio_stream.is_local(url):
+        return url[len('file://'):] if url.startswith('file://') else url
     # Настройка загрузки только аудио
     ydl_opts = {
         'format': 'bestaudio/best',
-        'outtmpl': 'temp_audio.%(ext)s',
+        'outtmpl': os.path.join(workdir, 'temp_audio.%(ext)s'),
         'quiet': True,
         'no_warnings': True,
         'postprocessor_args': {
             'ffmpeg': ['-loglevel', 'quiet'],
         }
     }
-    
+
     # Загрузка аудио
-    # print("Загружаем аудио...")
     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
         ydl.download([url])
-    
+
     # Найти созданный аудио файл
-    audio_files = glob.glob("temp_audio.*")
+    audio_files = glob.glob(os.path.join(workdir, "temp_audio.*"))
     if not audio_files:
         raise FileNotFoundError("Аудио файл не найден")
-    
-    audio_file = audio_files[0]
-    # print(f"Найден аудио файл: {audio_file}")
-    
-    # Загрузка модели Whisper для транскрибирования
-    # print("Загружаем модель Whisper...")
-    model = whisper.load_model("base")
-    
-    # Транскрибирование
-    # print("Транскрибируем аудио...")
-    result = model.transcribe(audio_file)
-    
-    # Удаление временного файла
-    if os.path.exists(audio_file):
-        os.remove(audio_file)
-    
-    return result["text"]
+    return audio_files[0]
+
+
+def transcribe_audio(audio_file):
+    # Модель Whisper загружается один раз на процесс (model_registry)
+    model = model_registry.get_whisper()
+    return model.transcribe(audio_file)["text"]
+
+
+def transcribe_youtube_video(url):
+    if youtube_stream:
+        # аудио не сохраняется на диск, расшифровка начинается во время загрузки
+        return audio_stream.transcribe_stream(url)
+    workdir = tempfile.mkdtemp(prefix='youtube_')
+    try:
+        return transcribe_audio(download_audio(url, workdir))
+    finally:
+        # Удаление временного каталога с аудио файлом
+        shutil.rmtree(workdir, ignore_errors=True)
 
 def analyze_sentiment_about_product(text, product_name="Urban Heat"):
-    # Инициализация модели анализа настроения
-    # print("Загружаем модель анализа настроения...")
-    sentiment_analyzer = pipeline("sentiment-analysis", 
-                                model="cardiffnlp/twitter-roberta-base-sentiment-latest")
-    
-    # Поиск упоминаний продукта в тексте
-    product_mentions = []
-    sentences = text.split('.')
-    
-    for sentence in sentences:
-        if product_name.lower() in sentence.lower():
-            product_mentions.append(sentence.strip())
-    
-    if not product_mentions:
+    # Упоминания продукта оцениваются одним пакетным прогоном модели (sentiment_batch)
+    sentiments = sentiment_batch.analyze_mentions([text], product_name)[0]
+    if not sentiments:
         err = f"Упоминания {product_name} не найдены в тексте."
         print(err)
         return None, err
-    
-    # Анализ настроения для каждого упоминания
-    sentiments = []
-    for mention in product_mentions:
-        if mention:
-            sentiment = sentiment_analyzer(mention)[0]
-            sentiments.append({
-                'text': mention,
-                'sentiment': sentiment['label'],
-                'score': sentiment['score']
-            })
-    
     return sentiments, None
 
-def main():
+def main(url=None):
     # url = "https://www.youtube.com/watch?v=pknx3Lu3few"
     # url = "https://www.youtube.com/watch?v=rCMhdn6dSO8"
     # url = "https://www.youtube.com/watch?v=bhMICVNFyHg"
-    url = "https://www.youtube.com/watch?v=bhMICVNFyHg&pp=ygUTdXJiYW4gaGVhdCBnYW1lcGxheQ%3D%3D"
+    # вместо ссылки можно передать путь к локальному аудио файлу
+    url = url or "https://www.youtube.com/watch?v=bhMICVNFyHg&pp=ygUTdXJiYW4gaGVhdCBnYW1lcGxheQ%3D%3D"
 
     print("Загрузка и транскрибирование видео...")
     transcript = transcribe_youtube_video(url)
@@ -121,16 +126,251 @@ def main():
             print()
 
     # Общий анализ настроения всего текста
-    overall_sentiment = pipeline("sentiment-analysis")(transcript[:512])[0]
+    overall_sentiment = sentiment_batch.analyze_overall(transcript)
     print(f"Общее настроение видео: {overall_sentiment['label']} ({overall_sentiment['score']:.2f})")
 
 
 
+def cache_job(job):
+    """
+    Этап конвейера: поиск расшифровки видео в кэше (локально, затем в bucket) до загрузки аудио.
+    """
+    job['t0'] = time.time()
+    if not transcript_cache.cache_enabled:
+        return None
+    text, audio_hash, where = transcript_cache.cache.lookup(job['id'])
+    if text is None:
+        return None
+    return {'transcript': text, 'audio_hash': audio_hash, 'cached': where}
+
+
+def download_job(job):
+    """
+    Этап конвейера: загрузка аудио (в потоке). Если такое же аудио уже расшифровывалось
+    (дубликат под другой ссылкой), расшифровка берётся из кэша по хэшу аудио.
+    """
+    job['workdir'] = tempfile.mkdtemp(prefix='youtube_')
+    audio = download_audio(job['url'], job['workdir'])
+    values = {'audio': audio}
+    if transcript_cache.cache_enabled:
+        values['audio_hash'] = transcript_cache.get_file_hash(audio)
+        text, where = transcript_cache.cache.lookup_audio(values['audio_hash'])
+        if text is not None:
+            values.update({'transcript': text, 'cached': where, 'cached_audio': True})
+    return values
+
+
+def transcribe_job(job):
+    """
+    Этап конвейера: расшифровка аудио (в процессе Whisper).
+    """
+    return {'transcript': transcribe_audio(job['audio'])}
+
+
+def stream_job(job):
+    """
+    Этап конвейера при youtube_stream: загрузка и расшифровка потоком (в процессе Whisper).
+    """
+    digest = hashlib.sha256()
+    transcript = audio_stream.transcribe_stream(job['url'], digest=digest)
+    return {'transcript': transcript, 'audio_hash': digest.hexdigest()[:32]}
+
+
+def is_transcribed(job):
+    return 'transcript' in job
+
+
+def analyze_job(job):
+    """
+    Этап конвейера: анализ настроения расшифровки (в процессе моделей настроения).
+    """
+    transcript = job['transcript']
+    sentiments, err = analyze_sentiment_about_product(transcript, "Urban Heat")
+    values = {'sentiments': sentiments, 'err': err}
+    if sentiments:
+        # Общий анализ настроения всего текста
+        values['overall'] = sentiment_batch.analyze_overall(transcript)
+    return values
+
+
+def init_transcribe_process():
+    model_registry.registry.start()
+    model_registry.registry.warm_up([('whisper', model_registry.whisper_model)])
+
+
+def init_analyze_process():
+    model_registry.registry.start()
+    model_registry.registry.warm_up([('sentiment', model_registry.sentiment_model),
+                                     ('sentiment', model_registry.overall_model)])
+
+
+class VideoProcessor:
+    """
+    Обработка списка видео конвейером этапов и запись результатов в облако и БД
+    (поток YoutubeTranscript и процессы пула run_workers).
+
+    :param source: Имя источника для лога.
+    :param serial: Выполнять этапы последовательно в текущем процессе (без очередей и пулов процессов).
+    """
+
+    def __init__(self, source, serial=None):
+        self.source = source
+        self.serial = (not youtube_pipeline) if serial is None else serial
+        self.token = None
+        self.lease = None  # work_lease.LeaseKeeper арендованных видео (в пуле процессов)
+        self.lock = threading.Lock()
+        self.count = 0
+        self.db_error = ''
+        self.done = set()  # видео, результат (или ошибка) которых записан в БД
+        # пулы процессов конвейера (с загруженными моделями) сохраняются между запусками
+        if youtube_stream:
+            # загрузка идёт внутри расшифровки (ffmpeg читает аудио по ссылке), отдельного этапа нет
+            stages = [video_pipeline.Stage('transcribe', stream_job, processes=youtube_transcribe_processes,
+                                           initializer=init_transcribe_process, skip=is_transcribed)]
+        else:
+            stages = [video_pipeline.Stage('download', download_job, workers=youtube_download_workers,
+                                           skip=is_transcribed),
+                      video_pipeline.Stage('transcribe', transcribe_job, processes=youtube_transcribe_processes,
+                                           initializer=init_transcribe_process, skip=is_transcribed)]
+        # расшифровка, найденная в кэше, сразу передаётся на анализ
+        stages.insert(0, video_pipeline.Stage('cache', cache_job, workers=youtube_download_workers))
+        self.pipeline = video_pipeline.Pipeline(stages + [
+            video_pipeline.Stage('analyze', analyze_job, processes=youtube_analyze_processes,
+                                 initializer=init_analyze_process),
+            video_pipeline.Stage('upload', self.upload_job, workers=youtube_upload_workers, always=True),
+        ], queue_size=youtube_pipeline_queue)
+
+    def run(self, videos, token, lease=None):
+        """
+        Обрабатывает видео: загрузка, расшифровка, анализ и запись разных видео выполняются одновременно;
+        ошибка одного видео записывается в БД и не останавливает остальные.
+
+        :param videos: Список {"id", "url"}.
+        :param token: Токен для записи в БД.
+        :param lease: work_lease.LeaseKeeper - результат записывается, только пока аренда видео не потеряна.
+        :return: Количество видео с упоминаниями продукта.
+        """
+        self.token = token
+        self.lease = lease
+        self.count = 0
+        self.db_error = ''
+        self.done = set()
+        if self.serial:
+            # модели загружаются до начала обработки (если были выгружены как неиспользуемые - повторно),
+            # чтобы время загрузки не попадало во время первого видео; в конвейере модели загружают процессы этапов
+            model_registry.registry.warm_up()
+        self.pipeline.run(({'id': data['id'], 'url': data['url']} for data in videos), serial=self.serial)
+        print(time.ctime(), f'{self.source}: этапы:\n{self.pipeline.get_stats()}', flush=True)
+        print(time.ctime(), f'{self.source}: кэш расшифровок: {transcript_cache.cache.get_stats()}', flush=True)
+        return self.count
+
+    def upload_job(self, job):
+        """
+        Этап конвейера: запись расшифровки в облако и результата (или ошибки) видео в БД.
+        """
+        video_id = job['id']
+        transcript = job.get('transcript', '')
+        try:
+            self.cache_transcript(job)
+            if self.lease is not None and not self.lease.is_owned(video_id):
+                # аренду захватил другой процесс - результат запишет он
+                print(time.ctime(), f'{self.source}: видео {video_id} не записано: аренда потеряна', flush=True)
+                return
+            if 'error' in job:
+                self.write_error(job, job['error'])
+                return
+            try:
+                sentiments = job['sentiments']
+                values = {"id": video_id, "need_reload": 'false', 'size_file': len(transcript)}
+                if sentiments:
+                    # Извлечение ID видео из URL для использования в имени файла
+                    blob_name = f"transcript_{video_id}.txt"
+                    overall_sentiment = job['overall']
+                    with self.lock:
+                        self.count += 1
+                    values["sentiment"] = overall_sentiment['label']
+                    values["value"] = overall_sentiment['score']
+                    values['result'] = '%s'
+                    values['err'] = ''
+                    datas = json.dumps(sentiments, ensure_ascii=False)
+                    print(f"Общее настроение видео: {overall_sentiment['label']} ({overall_sentiment['score']:.2f})")
+                else:
+                    values['err'] = job['err']
+                    blob_name = f"no_transcript_{video_id}.txt"
+                    datas = ''
+
+                # Сохранение транскрипции в облако
+                cloud.save_file_bucket(blob_name, transcript)
+                params = {
+                    "schema_name": config.schema_name,
+                    "object_code": "list",
+                    "values": values,
+                    "datas": datas
+                }
+                ans, is_ok, _ = common.send_rest('v2/entity', 'PUT',
+                    params=params, token_user=self.token)
+
+                if not is_ok:
+                    self.db_error = 'Ошибка при  коррекции видео в БД\n' + str(ans)
+                    return
+                self.done.add(video_id)
+                common.write_log_db('info', self.source,
+                                    'Обработано видео: ' + str(video_id) + ' ' + str(job['url']), page=video_id,
+                                    td=time.time() - job['t0'], file_name=common.get_computer_name(), token=self.token)
+            except Exception as er:
+                self.write_error(job, str(er))
+        finally:
+            if job.get('workdir'):
+                # Удаление временного каталога с аудио файлом
+                shutil.rmtree(job['workdir'], ignore_errors=True)
+
+    @staticmethod
+    def cache_transcript(job):
+        """
+        Сохраняет новую расшифровку в кэш (и указатель видео для расшифровки, найденной по хэшу аудио).
+        """
+        if not transcript_cache.cache_enabled or 'transcript' not in job:
+            return
+        if job.get('cached') in ('local', 'bucket') and not job.get('cached_audio'):
+            return  # найдена по указателю видео - в кэше уже есть всё
+        transcript_cache.cache.store(job['id'], job.get('audio_hash'), job['transcript'],
+                                     pointer_only=bool(job.get('cached_audio')))
+
+    def write_error(self, job, er):
+        video_id = job['id']
+        transcript = job.get('transcript', '')
+        st = 'Ошибка при обработке видео\n' + er
+        common.write_log_db('Exception', self.source, st + '\n' + job['url'], page=video_id,
+                            td=time.time() - job.get('t0', time.time()), file_name=common.get_computer_name(),
+                            token=self.token)
+        values = {"id": video_id, "need_reload": 'false'}
+        values['err'] = '%s'
+        datas = f'{er}'
+        if transcript:
+            blob_name = f"error_transcript_{video_id}.txt"
+            # Сохранение транскрипции в облако
+            cloud.save_file_bucket(blob_name, transcript)
+            values['size_file'] = len(transcript)
+        params = {
+            "schema_name": config.schema_name,
+            "object_code": "list",
+            "values": values,
+            "datas": datas
+        }
+        ans, is_ok, _ = common.send_rest('v2/entity', 'PUT', params=params,
+                                         token_user=self.token)
+        if not is_ok:
+            self.db_error = 'Ошибка при коррекции видео в БД\n' + str(ans)
+            return
+        self.done.add(video_id)
+
 class YoutubeTranscript(trafaret_thread.TrafaretThread):
     count = 0  # общее количество прочитанных статей
 
     def __init__(self, source, code_function, code_period, description):
         super(YoutubeTranscript, self).__init__(source, code_function, code_period, description)
+        self.processor = VideoProcessor(source)
+        model_registry.registry.start()
 
     def work(self):
         super(YoutubeTranscript, self).work()
@@ -145,91 +385,84 @@ class YoutubeTranscript(trafaret_thread.TrafaretThread):
                 'Start', self.source, 'Начало работы по оценке публикаций на youtube',
                 file_name=common.get_computer_name(), token=self.token)
             # читаем не обработанные публикации
-            ans, is_ok, _ = common.send_rest('v2/select/{schema}/nsi_list?where=need_reload&column_order=id'.format(schema=config.schema_name))
-            if not is_ok:
-                self.finish_text = 'Ошибка при получении списка публикаций для загрузки\n' + str(ans)
+            # постранично (keyset по id): обработанные строки (need_reload=false) не сдвигают следующие страницы
+            try:
+                ans = list(common.iter_select('nsi_list', where='need_reload', columns='id,url'))
+            except RuntimeError as er:
+                self.finish_text = 'Ошибка при получении списка публикаций для загрузки\n' + str(er)
+                return False
+            self.count = self.processor.run(ans, self.token)
+            if self.processor.db_error:
+                self.finish_text = self.processor.db_error
                 return False
-            ans = json.loads(ans)
-            for data in ans:
-                t0 = time.time()
-                transcript = ''
-                url = data['url']
-                video_id = data['id']
-                try:
-                    # Получаем ID видео из URL
-                    # print("Загрузка и транскрибирование видео...")
-                    transcript = transcribe_youtube_video(url)
-                    # print(f"\nТранскрипт:\n{transcript}\n")
-                    # print("Анализ настроения относительно Urban Heat...")
-                    sentiments, err = analyze_sentiment_about_product(transcript, "Urban Heat")
-
-                    values = {"id": data['id'], "need_reload": 'false', 'size_file': len(transcript)}
-                    if sentiments:
-                        # Извлечение ID видео из URL для использования в имени файла
-                        blob_name = f"transcript_{video_id}.txt"
-
-                        # Общий анализ настроения всего текста
-                        self.count += 1
-                        overall_sentiment = pipeline("sentiment-analysis")(transcript[:512])[0]
-                        values["sentiment"] = overall_sentiment['label']
-                        values["value"] = overall_sentiment['score']
-                        values['result'] = '%s'
-                        values['err'] = ''
-                        datas = json.dumps(sentiments, ensure_ascii=False)
-                        print(f"Общее настроение видео: {overall_sentiment['label']} ({overall_sentiment['score']:.2f})")
-                    else:
-                        values['err'] = err
-                        blob_name = f"no_transcript_{video_id}.txt"
-                        datas = ''
-
-                    # Сохранение транскрипции в облако
-                    cloud.save_file_bucket(blob_name, transcript)
-                    params = {
-                        "schema_name": config.schema_name,
-                        "object_code": "list",
-                        "values": values,
-                        "datas": datas
-                    }
-                    ans, is_ok, _ = common.send_rest('v2/entity', 'PUT',
-                        params=params, token_user=self.token)
-
-                    if not is_ok:
-                        self.finish_text = 'Ошибка при  коррекции видео в БД\n' + str(ans)
-                        return False
-                    common.write_log_db('info', self.source,
-                                        'Обработано видео: ' + str(data['id']) + ' ' + str(data['url']), page=data['id'],
-                                        td=time.time() - t0, file_name=common.get_computer_name(), token=self.token)
-                except Exception as er:
-                    st = 'Ошибка при обработке видео\n' + str(er)
-                    common.write_log_db('Exception', self.source, st + '\n' + data['url'], page=data['id'],
-                                        td=time.time() - t0, file_name=common.get_computer_name(), token=self.token)
-                    values = {"id": data['id'], "need_reload": 'false'}
-                    values['err'] = '%s'
-                    datas = f'{er}'
-                    if transcript:
-                        blob_name = f"error_transcript_{video_id}.txt"
-                        # Сохранение транскрипции в облако
-                        cloud.save_file_bucket(blob_name, transcript)
-                        values['size_file'] = len(transcript)
-                    params = {
-                        "schema_name": config.schema_name,
-                        "object_code": "list",
-                        "values": values,
-                        "datas": datas
-                    }
-                    ans, is_ok, _ = common.send_rest('v2/entity', 'PUT', params=params,
-                                                     token_user=self.token)
-                    if not is_ok:
-                        self.finish_text = 'Ошибка при коррекции видео в БД\n' + str(ans)
-                        return False
 
             self.finish_text = f'Обработано публикаций: {self.count}'
+            print(time.ctime(), f'{self.source}: модели: {model_registry.registry.get_stats()}', flush=True)
         return result
 
+
+def run_worker(index):
+    """
+    Процесс пула: захватывает видео по аренде (work_lease) и обрабатывает их, пока список need_reload
+    не опустеет. Этапы выполняются последовательно в процессе - параллельность даёт количество процессов.
+    """
+    source = f'YoutubeTranscript_{index}'
+    processor = VideoProcessor(source, serial=True)
+    store = work_lease.get_store()
+    count = count_videos = 0
+    common.write_log_db('Start', source, f'Начало работы процесса пула ({store.owner})',
+                        file_name=common.get_computer_name())
+    while True:
+        try:
+            leased = store.claim()
+            pending = not leased and store.has_pending()
+        except RuntimeError as er:
+            common.write_log_db('Error', source, 'Ошибка при захвате видео\n' + str(er),
+                                file_name=common.get_computer_name())
+            break
+        if not leased:
+            if not pending:
+                break
+            # свободных видео нет, но есть арендованные другими: если их процесс остановился, аренда истечёт
+            time.sleep(work_lease.lease_poll)
+            continue
+        ids = [data['id'] for data in leased]
+        keeper = work_lease.LeaseKeeper(store, ids).start()
+        try:
+            count += processor.run(leased, common.get_admin_token(), keeper)
+            count_videos += len(processor.done)
+        finally:
+            keeper.stop()
+            # необработанные видео (ошибка записи, потерянная аренда) сразу становятся доступны другим процессам
+            store.release(ids, done=processor.done)
+        if processor.db_error:
+            # БД не принимает результаты - иначе процесс снова захватит те же видео
+            common.write_log_db('Error', source, processor.db_error, file_name=common.get_computer_name())
+            break
+    common.write_log_db('info', source, f'Процесс пула завершён: обработано видео {count_videos}, '
+                                        f'с упоминаниями {count}', file_name=common.get_computer_name())
+    common.flush_logs()
+
+
+def run_workers(count):
+    """
+    Запускает count процессов пула и ждёт, пока они разберут список need_reload.
+    Процессы на других машинах, запущенные так же, делят с ними список через аренду.
+    """
+    processes = [multiprocessing.Process(target=run_worker, args=(index,), name=f'youtube_worker_{index}')
+                 for index in range(count)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
 # if __name__ == "__main__":
 #     main()
 
-if __name__ == "__main__":
+if __name__ == "__main__" and '--workers' in sys.argv:
+    # пул процессов с арендой видео: python youtube_sentiment_analyzer.py --workers N
+    run_workers(int(sys.argv[sys.argv.index('--workers') + 1]))
+elif __name__ == "__main__":
     YoutubeTranscript('YoutubeTranscript', 'youtube_transcript', 'period',
          "Поток 'Определение отношения из видео youtube' по игре URBAN HEAT").start()
     while True:
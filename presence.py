@@ -0,0 +1,223 @@
+"""
+Агрегация событий присутствия (on_presence_update) участников Discord.
+
+Вместо строки discord_his_status_members на каждое переключение online/offline в памяти ведутся
+сессии участников (online с ... по ...). Сессия - время в любом статусе, кроме offline: idle и dnd считаются
+online (прежде строки писались только при переходах в статусы online и offline, и переход online -> idle
+не был виден; теперь строка online означает начало присутствия, offline - его конец). Уход в offline
+подтверждается только через presence_debounce секунд: если участник за это время вернулся, переключения
+схлопываются и сессия продолжается.
+Запись в БД (через common_bot.writer пакетами) зависит от presence_mode:
+ - 'status'   - начало и конец сессии строками discord_his_status_members (прежняя таблица, без дребезга);
+                участники, online при запуске и при остановке бота, строк не получают - перезапуск не создаёт
+                ложных переключений;
+ - 'sessions' - закрытые сессии строками discord_his_sessions_members (member_id, online_from, online_to, seconds);
+ - 'hours'    - секунды online участника за каждый час строками discord_his_online_members (member_id, hour, seconds).
+При presence_raw_events дополнительно пишутся все исходные события, как раньше.
+"""
+import time
+import asyncio
+import datetime
+
+import common
+import common_async
+import common_bot
+import config
+
+source = "presence"
+
+presence_mode = getattr(config, 'presence_mode', 'status')  # 'status', 'sessions' или 'hours'
+presence_debounce = float(getattr(config, 'presence_debounce', 60))  # окно подтверждения ухода в offline, сек
+presence_raw_events = getattr(config, 'presence_raw_events', False)  # писать и каждое исходное событие
+presence_tick = float(getattr(config, 'presence_tick', 5))  # период проверки закрываемых сессий, сек
+
+hour = datetime.timedelta(hours=1)
+
+
+class Session:
+    __slots__ = ('member_id', 'display_name', 'online_from', 'offline_at', 'credited_to')
+
+    def __init__(self, member_id, display_name, online_from):
+        self.member_id = member_id
+        self.display_name = display_name
+        self.online_from = online_from
+        self.offline_at = None  # время ухода в offline, ожидающего подтверждения
+        self.credited_to = online_from  # до какого момента сессия учтена в почасовых суммах
+
+
+def get_hour(at):
+    return at.replace(minute=0, second=0, microsecond=0)
+
+
+class PresenceAggregator:
+    """
+    Сессии присутствия участников с подавлением дребезга и пакетной записью итогов.
+
+    :param mode: Что записывать в БД: 'status', 'sessions' или 'hours' (см. описание модуля).
+    :param debounce: Окно подтверждения ухода в offline, сек.
+    :param raw_events: Дополнительно писать каждое исходное событие в discord_his_status_members.
+    """
+
+    def __init__(self, mode=None, debounce=None, raw_events=None):
+        self.mode = mode or presence_mode
+        self.debounce = datetime.timedelta(seconds=presence_debounce if debounce is None else debounce)
+        self.raw_events = presence_raw_events if raw_events is None else raw_events
+        self.sessions = {}  # member_id -> Session
+        self.hours = {}  # (member_id, начало часа) -> секунд online
+        self.task = None
+        self.count_events = 0
+        self.count_coalesced = 0  # возвратов online в окне подтверждения
+        self.count_rows = 0
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+        return self
+
+    async def update(self, member, at=None):
+        """
+        Учитывает смену статуса участника (вызывается из on_presence_update).
+        """
+        status = member.status.value  # 'online', 'offline', 'idle', 'dnd'
+        at = at or datetime.datetime.utcnow()
+        self.count_events += 1
+        if self.raw_events and status in ('online', 'offline'):
+            await common_bot.insert_status_member(member)
+
+        member_id = str(member.id)
+        session = self.sessions.get(member_id)
+        if status != 'offline':
+            if session is None:
+                session = self.sessions[member_id] = Session(member_id, member.display_name, at)
+                if self.mode == 'status':
+                    await self._emit('discord_his_status_members', self._get_status_values(session, 'online', at))
+            elif session.offline_at is not None:
+                session.offline_at = None  # вернулся до подтверждения ухода
+                self.count_coalesced += 1
+        elif session is not None and session.offline_at is None:
+            session.offline_at = at
+
+    async def seed(self, members):
+        """
+        Открывает сессии участников, уже находящихся online при запуске бота (без строки online в режиме
+        'status': она осталась от предыдущего запуска).
+        """
+        now = datetime.datetime.utcnow()
+        for member in members:
+            member_id = str(member.id)
+            if member.status.value != 'offline' and member_id not in self.sessions:
+                self.sessions[member_id] = Session(member_id, member.display_name, now)
+
+    async def close(self):
+        """
+        Закрывает сессии текущим моментом и записывает почасовые суммы (при остановке бота).
+        В режиме 'status' записываются только неподтверждённые уходы в offline: участник, который online,
+        строки offline не получает (после запуска seed продолжит его сессию).
+        """
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        now = datetime.datetime.utcnow()
+        for session in list(self.sessions.values()):
+            if self.mode == 'status' and session.offline_at is None:
+                continue
+            await self._close(session, session.offline_at or now)
+        await self._flush_hours(now, force=True)
+        print(time.ctime(), f'{source}: {self.get_stats()}', flush=True)
+
+    def get_stats(self):
+        return (f'событий: {self.count_events}, схлопнуто: {self.count_coalesced}, записано строк: {self.count_rows}, '
+                f'открытых сессий: {len(self.sessions)}')
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(presence_tick)
+            try:
+                await self._tick(datetime.datetime.utcnow())
+            except Exception as er:
+                print(time.ctime(), f'{source}: Exception {er}', flush=True)
+
+    async def _tick(self, now):
+        for session in list(self.sessions.values()):
+            if session.offline_at is not None and now - session.offline_at >= self.debounce:
+                await self._close(session, session.offline_at)
+        await self._flush_hours(now)
+
+    async def _close(self, session, online_to):
+        del self.sessions[session.member_id]
+        if self.mode == 'status':
+            await self._emit('discord_his_status_members', self._get_status_values(session, 'offline', online_to))
+        elif self.mode == 'sessions':
+            await self._emit('discord_his_sessions_members', {
+                "member_id": session.member_id,
+                "display_name": session.display_name,
+                "online_from": session.online_from.isoformat(),
+                "online_to": online_to.isoformat(),
+                "seconds": int((online_to - session.online_from).total_seconds()),
+            })
+        else:
+            self._credit(session, online_to)
+
+    def _credit(self, session, to):
+        """
+        Распределяет время сессии с credited_to до to по часам.
+        """
+        start = session.credited_to
+        while start < to:
+            end = min(to, get_hour(start) + hour)
+            key = (session.member_id, get_hour(start))
+            self.hours[key] = self.hours.get(key, 0) + (end - start).total_seconds()
+            start = end
+        session.credited_to = max(session.credited_to, to)
+
+    async def _flush_hours(self, now, force=False):
+        """
+        Записывает суммы за завершившиеся часы (при force - и за текущий).
+        """
+        if self.mode != 'hours':
+            return
+        for session in self.sessions.values():
+            # открытые сессии учитываются до момента ухода в offline (если он ожидает подтверждения) или до now
+            self._credit(session, session.offline_at or now)
+        current = get_hour(now)
+        for key in [key for key in self.hours if force or self._is_complete(key, current)]:
+            seconds = self.hours.pop(key)
+            await self._emit('discord_his_online_members', {
+                "member_id": key[0],
+                "hour": key[1].isoformat(),
+                "seconds": int(seconds),
+            })
+
+    def _is_complete(self, key, current):
+        """
+        Час участника завершён: прошёл и не может пополниться сессией, ожидающей подтверждения ухода.
+        """
+        member_id, start = key
+        if start >= current:
+            return False
+        session = self.sessions.get(member_id)
+        return session is None or session.credited_to >= start + hour
+
+    @staticmethod
+    def _get_status_values(session, status, at):
+        return {
+            "member_id": session.member_id,
+            "display_name": session.display_name,
+            "status": status,
+            "at_date_time": at.isoformat(),
+        }
+
+    async def _emit(self, object_code, values):
+        self.count_rows += 1
+        if common_bot.writer is not None:
+            await common_bot.writer.put(object_code, values)
+            return
+        result = await common_bot.put_entities(object_code, [values])
+        if not result.ok:
+            await common_async.write_log_db(
+                'ERROR', source, f'❌ Ошибка записи {object_code} в БД: {result.get_first_error()}',
+                file_name=common.get_computer_name())
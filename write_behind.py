@@ -0,0 +1,161 @@
+"""
+Отложенная (write-behind) пакетная запись событий Discord в БД.
+
+Обработчики событий бота кладут строки в asyncio-очередь и сразу возвращаются; фоновая задача собирает
+строки в пакеты (по количеству или по времени) и записывает каждый пакет многострочными запросами v2/entity
+(common_async.put_entities).
+"""
+import time
+import random
+import asyncio
+
+import common
+import common_async
+import config
+
+source = "write_behind"
+
+write_behind_batch_size = int(getattr(config, 'write_behind_batch_size', 200))  # макс. строк в одном запросе
+write_behind_interval = float(getattr(config, 'write_behind_interval', 0.5))  # макс. ожидание наполнения пакета, сек
+write_behind_queue_size = int(getattr(config, 'write_behind_queue_size', 10000))  # при заполнении put() ждёт
+write_behind_retries = int(getattr(config, 'write_behind_retries', 5))  # повторы записи пакета при ошибке
+write_behind_retry_delay = float(getattr(config, 'write_behind_retry_delay', 1))  # базовая пауза перед повтором, сек
+write_behind_retry_max_delay = float(getattr(config, 'write_behind_retry_max_delay', 30))
+
+
+class WriteBehindQueue:
+    """
+    Очередь отложенной записи с фоновой выгрузкой пакетами.
+
+    :param batch_size: Максимальное количество строк в одном запросе.
+    :param interval: Максимальное время ожидания наполнения пакета, сек.
+    :param queue_size: Размер очереди; при её заполнении put() ожидает освобождения места (backpressure).
+    :param retries: Количество повторов записи пакета при ошибке (пауза с экспоненциальным ростом и jitter).
+    """
+
+    def __init__(self, batch_size=None, interval=None, queue_size=None, retries=None):
+        self.batch_size = batch_size or write_behind_batch_size
+        self.interval = write_behind_interval if interval is None else interval
+        self.retries = write_behind_retries if retries is None else retries
+        self.queue = asyncio.Queue(queue_size or write_behind_queue_size)
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.closing = False
+        self.closed = False
+        self.count_rows = 0  # записано строк
+        self.count_requests = 0  # выполнено запросов v2/entity
+        self.count_retries = 0
+        self.count_failed = 0  # строк, которые не удалось записать
+        self.count_waits = 0  # сколько раз put() ждал места в очереди
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._flusher())
+        return self
+
+    async def put(self, object_code, values, datas=''):
+        """
+        Ставит строку в очередь записи. Если очередь заполнена - ждёт освобождения места.
+        После остановки очереди строка записывается сразу.
+        """
+        if self.closed:
+            await self._send(object_code, [(values, datas)])
+            return
+        if self.queue.full():
+            self.count_waits += 1
+        await self.queue.put((object_code, values, datas))
+        if self.queue.qsize() >= self.batch_size:
+            self.wakeup.set()
+
+    async def drain(self, timeout=30):
+        """
+        Записывает всё, что осталось в очереди, и останавливает фоновую задачу.
+        """
+        if self.task is None or self.closed:
+            return
+        self.closing = True
+        self.wakeup.set()
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(time.ctime(), f'{source}: не записано строк при остановке: {self.queue.qsize()}', flush=True)
+        self.closed = True
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        print(time.ctime(), f'{source}: {self.get_stats()}', flush=True)
+
+    def get_stats(self):
+        return (f'строк: {self.count_rows}, запросов: {self.count_requests}, повторов: {self.count_retries}, '
+                f'ошибок: {self.count_failed}, ожиданий очереди: {self.count_waits}')
+
+    async def _collect(self):
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.closing:
+                break
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _flusher(self):
+        while True:
+            batch = await self._collect()
+            try:
+                groups = {}  # object_code -> [(values, datas)], порядок строк сохраняется
+                for object_code, values, datas in batch:
+                    groups.setdefault(object_code, []).append((values, datas))
+                for object_code, rows in groups.items():
+                    await self._send(object_code, rows)
+            except Exception as er:
+                self.count_failed += len(batch)
+                print(time.ctime(), f'{source}: Exception {er}', flush=True)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def _send(self, object_code, rows):
+        """
+        Записывает строки через common_async.put_entities (части по размеру, деление отвергнутой части);
+        строки, не записанные из-за сбоя сети или сервера, повторяются с паузой.
+        """
+        for attempt in range(self.retries + 1):
+            result = await common_async.put_entities(object_code, rows)
+            self.count_requests += result.count_requests
+            self.count_rows += len(rows) - result.count_errors
+            if result.ok:
+                return True
+            # отвергнутые API строки (4xx) не повторяются - повтор не поможет
+            rejected = sum(result.rejected)
+            if rejected:
+                self.count_failed += rejected
+                await self._log_error(object_code, rejected, next(
+                    error for error, is_rejected in zip(result.errors, result.rejected) if is_rejected))
+            rows = [row for row, error, is_rejected in zip(rows, result.errors, result.rejected)
+                    if error and not is_rejected]
+            if not rows:
+                return False
+            if attempt < self.retries:
+                self.count_retries += 1
+                delay = min(write_behind_retry_max_delay, write_behind_retry_delay * 2 ** attempt)
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+        self.count_failed += len(rows)
+        await self._log_error(object_code, len(rows), result.get_first_error())
+        return False
+
+    async def _log_error(self, object_code, count, error):
+        await common_async.write_log_db(
+            'ERROR', source, f'❌ Ошибка записи {count} строк {object_code} в БД: {error}',
+            file_name=common.get_computer_name())